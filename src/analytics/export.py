@@ -0,0 +1,236 @@
+"""Columnar snapshots of the subscription data for analytics.
+
+    python -m analytics.export [directory] [--full]
+
+Writes zstd-compressed Parquet files under ANALYTICS_SNAPSHOT_DIR, so the
+churn, cohort and plan-mix reports in analytics/queries.py never query the
+production database. Each run only reads what changed since the previous
+one:
+
+- subscription_changes: the change log (db/changes.py), appended by seq.
+- subscriptions: the rows the new changes touched, appended with the seq of
+  their latest change (_seq); readers keep the row with the highest _seq per
+  id. The first run copies every row.
+- deactivated_users: the ids of deactivated users, copied in full every run
+  (there is no log of deactivations to follow, and the list is short).
+- magazines and plans: copied in full every run; the catalog is small.
+
+Once a shard has more than ANALYTICS_COMPACT_FILES files for an appended
+table, they are rewritten into one, so the file count stays bounded however
+often the export runs.
+
+Rows are streamed in batches of ANALYTICS_BATCH_SIZE. The watermarks and the
+list of files are kept per shard in manifest.json, which is replaced only
+after the new files are complete, so readers never see a partial run and an
+interrupted run is simply repeated. pyarrow is optional: pip install pyarrow.
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import func, literal, select
+
+from db.changes import sequence_changes
+from models import Magazine, Plan, Subscription, SubscriptionChange, User
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+ANALYTICS_SNAPSHOT_DIR = os.getenv("ANALYTICS_SNAPSHOT_DIR", "./snapshots")
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "10000"))
+ANALYTICS_COMPACT_FILES = int(os.getenv("ANALYTICS_COMPACT_FILES", "16"))
+MANIFEST = "manifest.json"
+TABLES = ("subscription_changes", "subscriptions", "deactivated_users", "magazines", "plans")
+# Tables that every run appends to, and that compaction merges.
+APPENDED_TABLES = ("subscription_changes", "subscriptions")
+
+changes = SubscriptionChange.__table__
+subscriptions = Subscription.__table__
+users = User.__table__
+
+
+def schemas():
+    return {
+        "subscription_changes": pa.schema([
+            ("seq", pa.int64()), ("op", pa.string()), ("subscription_id", pa.int64()),
+            ("user_id", pa.int64()), ("changed_at", pa.timestamp("us")),
+        ]),
+        "subscriptions": pa.schema([
+            ("id", pa.int64()), ("user_id", pa.int64()), ("magazine_id", pa.int64()), ("plan_id", pa.int64()),
+            ("price", pa.float64()), ("price_at_renewal", pa.float64()), ("next_renewal_date", pa.date32()),
+            ("is_active", pa.bool_()), ("version", pa.int64()), ("_seq", pa.int64()),
+        ]),
+        "deactivated_users": pa.schema([("id", pa.int64())]),
+        "magazines": pa.schema([("id", pa.int64()), ("name", pa.string()), ("base_price", pa.float64())]),
+        "plans": pa.schema([("id", pa.int64()), ("title", pa.string()), ("renewal_period", pa.int64())]),
+    }
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Analytics snapshots need pyarrow: pip install pyarrow")
+
+
+def read_manifest(directory: str):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"shards": {}, "catalog": {}}
+
+
+def _write_manifest(directory: str, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _stream(db, stmt, batch_size: int):
+    # Server-side cursor on Postgres, so a big table is never held in memory.
+    result = db.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+    for rows in result.mappings().partitions():
+        yield [dict(row) for row in rows]
+
+
+def _write(directory: str, name: str, schema, batches):
+    """Write the batches to one Parquet file; returns its path relative to directory, or None if empty."""
+    path = os.path.join(directory, name)
+    writer = None
+    try:
+        for rows in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(path + ".tmp", schema, compression="zstd")
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        return None
+    os.replace(path + ".tmp", path)
+    return name
+
+
+def _compact(directory: str, name: str, schema, paths, batch_size: int):
+    """Merge the files at `paths` into one, batch by batch; returns its path."""
+    def batches():
+        for path in paths:
+            for batch in pq.ParquetFile(os.path.join(directory, path)).iter_batches(batch_size=batch_size):
+                yield batch.to_pylist()
+    return _write(directory, name, schema, batches())
+
+
+def export_shard(db, directory: str, shard: str, state, full: bool, batch_size: int, run: str,
+                 compact_files: int = ANALYTICS_COMPACT_FILES):
+    """Append what changed on one shard since `state`'s watermarks; returns the new state."""
+    tables = schemas()
+    seq = 0 if full else state.get("seq", 0)
+    parts = {table: [] if full else list(state.get("parts", {}).get(table, [])) for table in APPENDED_TABLES}
+    # Everything up to here is exported by this run; later changes by the next.
+    sequence_changes(db)
+    high = db.execute(select(func.max(changes.c.seq))).scalar() or 0
+
+    new_changes = (
+        select(changes.c.seq, changes.c.op, changes.c.subscription_id, changes.c.user_id, changes.c.changed_at)
+        .where(changes.c.seq > seq, changes.c.seq <= high)
+        .order_by(changes.c.seq)
+    )
+    if full or "seq" not in state:
+        # Rows written before the change log existed have no changes to find them by.
+        changed = select(*subscriptions.c, literal(high).label("_seq")).order_by(subscriptions.c.id)
+    else:
+        latest = (
+            select(changes.c.subscription_id, func.max(changes.c.seq).label("_seq"))
+            .where(changes.c.seq > seq, changes.c.seq <= high)
+            .group_by(changes.c.subscription_id)
+            .subquery()
+        )
+        changed = (
+            select(*subscriptions.c, latest.c._seq)
+            .join(latest, latest.c.subscription_id == subscriptions.c.id)
+            .order_by(subscriptions.c.id)
+        )
+    deactivated = select(users.c.id).where(users.c.is_active.is_(False)).order_by(users.c.id)
+
+    for table, stmt in (("subscription_changes", new_changes), ("subscriptions", changed)):
+        written = _write(directory, f"{table}/{shard}-{run}.parquet", tables[table], _stream(db, stmt, batch_size))
+        if written:
+            parts[table].append(written)
+        if len(parts[table]) > compact_files:
+            parts[table] = [_compact(directory, f"{table}/{shard}-{run}-compacted.parquet", tables[table], parts[table], batch_size)]
+    written = _write(directory, f"deactivated_users/{shard}-{run}.parquet", tables["deactivated_users"],
+                     _stream(db, deactivated, batch_size))
+    parts["deactivated_users"] = [written] if written else []
+    db.rollback()
+    return {"seq": high, "parts": parts}
+
+
+def export_catalog(db, directory: str, run: str):
+    tables = schemas()
+    parts = {}
+    for table, stmt in (
+        ("magazines", select(Magazine.id, Magazine.name, Magazine.base_price).order_by(Magazine.id)),
+        ("plans", select(Plan.id, Plan.title, Plan.renewal_period).order_by(Plan.id)),
+    ):
+        # An empty table still gets a file, so readers find the columns.
+        rows = [dict(row) for row in db.execute(stmt).mappings()]
+        path = f"{table}/{run}.parquet"
+        pq.write_table(pa.Table.from_pylist(rows, schema=tables[table]), os.path.join(directory, path), compression="zstd")
+        parts[table] = [path]
+    db.rollback()
+    return parts
+
+
+def export(session_factories, directory: str = ANALYTICS_SNAPSHOT_DIR, full: bool = False,
+           batch_size: int = ANALYTICS_BATCH_SIZE, compact_files: int = ANALYTICS_COMPACT_FILES):
+    """Bring the snapshot in `directory` up to date with every shard; returns the manifest."""
+    require_pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    for table in TABLES:
+        os.makedirs(os.path.join(directory, table), exist_ok=True)
+    previous = read_manifest(directory)
+    run = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    manifest = {"exported_at": run, "shards": {}, "catalog": {}}
+
+    for shard, session_factory in enumerate(session_factories):
+        with session_factory() as db:
+            if shard == 0:
+                manifest["catalog"] = export_catalog(db, directory, run)
+            state = previous["shards"].get(str(shard), {})
+            manifest["shards"][str(shard)] = export_shard(
+                db, directory, str(shard), state, full, batch_size, run, compact_files)
+    _write_manifest(directory, manifest)
+    _remove_unlisted(directory, manifest)
+    return manifest
+
+
+def manifest_files(manifest):
+    files = [path for paths in manifest["catalog"].values() for path in paths]
+    for state in manifest["shards"].values():
+        files.extend(path for paths in state["parts"].values() for path in paths)
+    return files
+
+
+def _remove_unlisted(directory: str, manifest):
+    # Files replaced by this run, and leftovers of interrupted runs.
+    keep = set(manifest_files(manifest))
+    for table in TABLES:
+        for name in os.listdir(os.path.join(directory, table)):
+            path = f"{table}/{name}"
+            if path not in keep and name.endswith((".parquet", ".tmp")):
+                os.remove(os.path.join(directory, path))
+
+
+if __name__ == "__main__":
+    from db.database import SessionLocal
+    from db.sharding import shard_router
+
+    args = [arg for arg in sys.argv[1:] if arg != "--full"]
+    factories = shard_router.session_factories if shard_router is not None else [SessionLocal]
+    result = export(factories, args[0] if args else ANALYTICS_SNAPSHOT_DIR, full="--full" in sys.argv[1:])
+    for shard, state in result["shards"].items():
+        print(f"Shard {shard}: changes up to seq {state['seq']}")
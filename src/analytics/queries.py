@@ -0,0 +1,139 @@
+"""Churn, cohort and plan-mix reports from the snapshots written by analytics/export.py.
+
+    python -m analytics.queries churn|cohorts|plan-mix [directory]
+
+Reads the files listed in the snapshot's manifest through memory maps and
+computes with Arrow compute kernels; the database is never queried.
+
+Churn and cohorts are derived from the change log, so subscriptions that
+were created before it existed do not count towards them.
+"""
+import json
+import os
+import sys
+
+from analytics.export import ANALYTICS_SNAPSHOT_DIR, read_manifest, require_pyarrow, schemas
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+
+def load(directory: str, table: str):
+    """One table of the snapshot as an Arrow table."""
+    require_pyarrow()
+    manifest = read_manifest(directory)
+    if table in manifest["catalog"]:
+        paths = manifest["catalog"][table]
+    else:
+        paths = [path for state in manifest["shards"].values() for path in state["parts"].get(table, [])]
+    if not paths:
+        return schemas()[table].empty_table()
+    return pa.concat_tables([pq.read_table(os.path.join(directory, path), memory_map=True) for path in paths])
+
+
+def current_subscriptions(directory: str):
+    """The latest exported version of every subscription."""
+    table = load(directory, "subscriptions")
+    latest = table.group_by("id").aggregate([("_seq", "max")]).rename_columns(["id", "_seq"])
+    return table.join(latest, keys=["id", "_seq"], join_type="inner")
+
+
+def plan_mix(directory: str = ANALYTICS_SNAPSHOT_DIR):
+    """Active subscriptions and revenue per plan, with each plan's share of them."""
+    active = current_subscriptions(directory).filter(pc.field("is_active"))
+    by_plan = active.group_by("plan_id").aggregate([("id", "count"), ("price", "sum")])
+    plans = load(directory, "plans").select(["id", "title"]).rename_columns(["plan_id", "title"])
+    by_plan = by_plan.join(plans, keys="plan_id", join_type="left outer").sort_by("plan_id")
+    total = max(len(active), 1)
+    return [
+        {
+            "plan_id": row["plan_id"],
+            "title": row["title"],
+            "active_subscriptions": row["id_count"],
+            "revenue": row["price_sum"],
+            "share": row["id_count"] / total,
+        }
+        for row in by_plan.to_pylist()
+    ]
+
+
+def churn(directory: str = ANALYTICS_SNAPSHOT_DIR):
+    """Per month: subscriptions started, cancelled, and cancelled / active at the start of the month.
+
+    A modification replaces a subscription with a new one; that is neither
+    a start nor a cancellation.
+    """
+    events = load(directory, "subscription_changes")
+    months = pc.floor_temporal(events["changed_at"], unit="month")
+    counts = (
+        pa.table({"month": months, "op": events["op"], "seq": events["seq"]})
+        .group_by(["month", "op"])
+        .aggregate([("seq", "count")])
+        .to_pylist()
+    )
+    by_month = {}
+    for row in counts:
+        by_month.setdefault(row["month"], {})[row["op"]] = row["seq_count"]
+
+    report, active = [], 0
+    for month in sorted(by_month):
+        ops = by_month[month]
+        started = ops.get("created", 0) - ops.get("replaced", 0)
+        cancelled = ops.get("cancelled", 0)
+        report.append({
+            "month": month.strftime("%Y-%m"),
+            "active_at_start": active,
+            "started": started,
+            "cancelled": cancelled,
+            "churn_rate": cancelled / active if active else None,
+        })
+        active += started - cancelled
+    return report
+
+
+def cohorts(directory: str = ANALYTICS_SNAPSHOT_DIR):
+    """Users by the month of their first subscription, and how many still have an active one.
+
+    A deactivated user is not retained, whatever their subscriptions say.
+    """
+    events = load(directory, "subscription_changes")
+    created = events.filter(pc.equal(events["op"], "created"))
+    first = created.group_by("user_id").aggregate([("changed_at", "min")])
+    active = current_subscriptions(directory).filter(pc.field("is_active"))
+    deactivated = load(directory, "deactivated_users")["id"]
+    retained = pc.and_(
+        pc.is_in(first["user_id"], value_set=pc.unique(active["user_id"])),
+        pc.invert(pc.is_in(first["user_id"], value_set=deactivated)),
+    )
+    by_cohort = (
+        pa.table({
+            "cohort": pc.floor_temporal(first["changed_at_min"], unit="month"),
+            "retained": pc.cast(retained, pa.int64()),
+        })
+        .group_by("cohort")
+        .aggregate([("retained", "count"), ("retained", "sum")])
+        .sort_by("cohort")
+    )
+    return [
+        {
+            "cohort": row["cohort"].strftime("%Y-%m"),
+            "users": row["retained_count"],
+            "active_users": row["retained_sum"],
+            "retention": row["retained_sum"] / row["retained_count"],
+        }
+        for row in by_cohort.to_pylist()
+    ]
+
+
+REPORTS = {"churn": churn, "cohorts": cohorts, "plan-mix": plan_mix}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in REPORTS:
+        sys.exit("Usage: python -m analytics.queries churn|cohorts|plan-mix [directory]")
+    for row in REPORTS[sys.argv[1]](*sys.argv[2:]):
+        print(json.dumps(row, default=str))
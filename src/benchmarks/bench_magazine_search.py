@@ -0,0 +1,89 @@
+"""Search and typeahead latency over a large magazine catalog.
+
+Run from src/:  python -m benchmarks.bench_magazine_search [magazines] [queries]
+
+Before timing, every typeahead prefix is checked against a scan of all the
+keys, so a trie that drops keys fails the run instead of getting faster.
+"""
+import bisect
+import random
+import sys
+import time
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from benchmarks.common import bench_client, make_engine
+from benchmarks.stats import summarize, timed
+from models import Magazine
+from search import MagazineSearchIndex, magazine_index, search_magazines
+
+TOPICS = ["tech", "garden", "science", "travel", "cooking", "finance", "music", "sports", "history", "design",
+          "health", "photography", "gaming", "fashion", "architecture", "wildlife", "cinema", "poetry"]
+KINDS = ["weekly", "monthly", "review", "digest", "journal", "quarterly", "today", "insider", "times", "world"]
+
+
+def make_rows(count: int, rng: random.Random):
+    for i in range(count):
+        topic, kind = rng.choice(TOPICS), rng.choice(KINDS)
+        yield {
+            "name": f"{topic.title()} {kind.title()} {i}",
+            "description": f"A {kind} magazine about {topic} and {rng.choice(TOPICS)}",
+            "base_price": rng.randint(3, 20),
+            "discount_quarterly": 0.05,
+            "discount_half_yearly": 0.1,
+            "discount_annual": 0.15,
+        }
+
+
+def check_completions(names, prefixes, limit: int = 10):
+    """Compare the index's completions with the first `limit` matches of a sorted scan."""
+    keys = sorted((key, magazine_id) for magazine_id, name in names.items() for key in MagazineSearchIndex._keys(name))
+    for prefix in sorted(set(prefixes)):
+        expected = {}
+        for key, magazine_id in keys[bisect.bisect_left(keys, (prefix,)):]:
+            if not key.startswith(prefix) or len(expected) >= limit:
+                break
+            expected.setdefault(magazine_id, None)
+        found = [match["id"] for match in magazine_index.complete(prefix, limit)]
+        if found != list(expected):
+            sys.exit(f"autocomplete {prefix!r} returned {found}, expected {list(expected)}")
+
+
+def main(magazines: int = 100_000, queries: int = 1000):
+    rng = random.Random(42)
+    engine = make_engine()
+    with Session(engine) as db:
+        start = time.perf_counter()
+        rows = list(make_rows(magazines, rng))
+        for offset in range(0, len(rows), 10_000):
+            db.execute(insert(Magazine), rows[offset:offset + 10_000])
+        db.commit()
+        print(f"loaded {magazines} magazines (with full-text index) in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        magazine_index.load(db)
+        print(f"built typeahead trie in {time.perf_counter() - start:.2f}s")
+
+        prefixes = [rng.choice(TOPICS + KINDS)[:rng.randint(1, 4)] for _ in range(queries)]
+        names = dict(db.execute(select(Magazine.id, Magazine.name)).all())
+        # Names added after the load go into buckets that have already split.
+        for i, topic in enumerate(TOPICS):
+            names[magazines + 1 + i] = f"Zebra {topic.title()}"
+            magazine_index.put(magazines + 1 + i, names[magazines + 1 + i])
+        check_completions(names, prefixes + ["zebra", "zebra t", *TOPICS, *KINDS])
+        print(f"checked {len(set(prefixes))} prefixes against a full scan")
+        summarize("trie autocomplete (in process)", timed(lambda i: magazine_index.complete(prefixes[i]), queries))
+
+        terms = [f"{rng.choice(TOPICS)} {rng.choice(KINDS)}" for _ in range(queries)]
+        summarize("full-text search (in process)", timed(lambda i: search_magazines(db, terms[i]), queries))
+
+    with bench_client(engine) as client:
+        summarize("GET /magazines/autocomplete", timed(
+            lambda i: client.get("/magazines/autocomplete", params={"prefix": prefixes[i]}), queries))
+        summarize("GET /magazines/search", timed(
+            lambda i: client.get("/magazines/search", params={"q": terms[i]}), queries))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,96 @@
+"""Soak test that flags endpoints whose memory keeps growing.
+
+Run from src/:  python -m benchmarks.bench_memory_soak [rounds] [requests_per_round]
+
+Each endpoint is called `requests_per_round` times per round. After every
+round the garbage collector runs and the memory still traced by
+tracemalloc is recorded. An endpoint is flagged GROWING when memory rose in
+most rounds and by more than GROWTH_THRESHOLD_BYTES per request overall;
+caches that fill up once and then stay flat are not flagged. Process RSS is
+printed alongside, though allocator fragmentation makes it noisier.
+"""
+import gc
+import resource
+import sys
+import tracemalloc
+
+import diagnostics
+from benchmarks.common import bench_client, make_engine
+
+WARMUP_ROUNDS = 2
+GROWTH_THRESHOLD_BYTES = 64
+GROWING_ROUND_FRACTION = 0.8
+
+
+def rss_kib():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def soak(name, fn, rounds: int, requests: int):
+    samples = []
+    for round_number in range(WARMUP_ROUNDS + rounds):
+        for i in range(requests):
+            fn(round_number * requests + i)
+        gc.collect()
+        if round_number >= WARMUP_ROUNDS:
+            samples.append(tracemalloc.get_traced_memory()[0])
+
+    rising = sum(1 for before, after in zip(samples, samples[1:]) if after > before)
+    per_request = (samples[-1] - samples[0]) / ((rounds - 1) * requests)
+    growing = rising >= GROWING_ROUND_FRACTION * (rounds - 1) and per_request > GROWTH_THRESHOLD_BYTES
+    print(
+        f"{name:<40} growth/request={per_request:10.1f}B rising rounds={rising}/{rounds - 1}"
+        f" rss={rss_kib()}KiB{'  GROWING' if growing else ''}"
+    )
+    return growing
+
+
+def main(rounds: int = 10, requests: int = 100):
+    if rounds < 2:
+        sys.exit("Need at least two rounds")
+    engine = make_engine()
+    diagnostics.enable(frames=1)
+    with bench_client(engine) as client:
+        client.post("/users/register", json={"username": "soak", "email": "soak@example.com", "password": "secret"})
+        token = client.post("/users/login", json={"username": "soak", "password": "secret"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        plan = client.post("/plans/", json={"title": "Monthly", "description": "Monthly plan", "renewal_period": 1}).json()
+        magazines = [
+            client.post("/magazines/", json={
+                "name": f"Soak Weekly {i}",
+                "description": "A magazine for soak tests",
+                "base_price": 5.0,
+                "discount_quarterly": 0.1,
+                "discount_half_yearly": 0.2,
+                "discount_annual": 0.3,
+            }).json()
+            for i in range(50)
+        ]
+        subscription = {"user_id": 1, "magazine_id": magazines[0]["id"], "plan_id": plan["id"], "price": 10.0}
+        for _ in range(200):
+            client.post("/subscriptions/", json=subscription)
+
+        endpoints = [
+            ("GET /magazines/", lambda i: client.get("/magazines/")),
+            ("GET /magazines/{magazine_id}", lambda i: client.get(f"/magazines/{magazines[i % 50]['id']}")),
+            ("GET /magazines/search", lambda i: client.get("/magazines/search", params={"q": "soak"})),
+            ("GET /plans/", lambda i: client.get("/plans/")),
+            ("GET /subscriptions/", lambda i: client.get("/subscriptions/", params={"limit": 100})),
+            ("GET /users/me", lambda i: client.get("/users/me", headers=headers)),
+            ("GET /users/me/subscriptions", lambda i: client.get("/users/me/subscriptions", headers=headers)),
+            ("POST /subscriptions/", lambda i: client.post("/subscriptions/", json=subscription)),
+        ]
+        flagged = [name for name, fn in endpoints if soak(name, fn, rounds, requests)]
+        print("Sessions:", diagnostics.session_stats())
+    diagnostics.disable()
+    if flagged:
+        print("Unbounded growth:", ", ".join(flagged))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,120 @@
+"""Latency under overload, with and without the adaptive concurrency limit.
+
+Run from src/ with DATABASE_URL pointing at a database the app can use:
+
+    python -m benchmarks.bench_overload [seconds] [concurrency]
+
+Starts the app in one uvicorn process per run and measures p99 under light
+load. It then offers `concurrency` clients' worth of traffic: mostly
+magazine lookups, with /users/me (protected) and the full subscription
+export (shed first) mixed in. Latencies are those of the requests that were
+served; shed requests count separately and their clients wait out
+Retry-After before the next request. With the limiter on, the served p99
+should stay within BOUND_FACTOR of the light-load p99.
+"""
+import itertools
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks.bench_server_configs import free_port, wait_ready
+from benchmarks.stats import percentile, summarize
+
+BOUND_FACTOR = 5
+# (class, weight, path); /users/me also needs the token header.
+MIX = [("normal", 7, "/magazines/{id}"), ("critical", 1, "/users/me"), ("sheddable", 2, "/subscriptions/")]
+
+
+def prepare(base_url: str):
+    with httpx.Client(base_url=base_url) as client:
+        suffix = str(int(time.time()))
+        client.post("/users/register", json={"username": f"overload{suffix}", "email": f"overload{suffix}@example.com", "password": "secret"})
+        token = client.post("/users/login", json={"username": f"overload{suffix}", "password": "secret"}).json()["access_token"]
+        plan = client.post("/plans/", json={"title": f"Overload {suffix}", "description": "Monthly plan", "renewal_period": 1}).json()
+        ids = [
+            client.post("/magazines/", json={
+                "name": f"Overload Weekly {suffix} {i}",
+                "description": "A magazine for overload tests",
+                "base_price": 5.0,
+                "discount_quarterly": 0.1,
+                "discount_half_yearly": 0.2,
+                "discount_annual": 0.3,
+            }).json()["id"]
+            for i in range(20)
+        ]
+        for magazine_id in ids * 10:
+            client.post("/subscriptions/", json={"user_id": 1, "magazine_id": magazine_id, "plan_id": plan["id"], "price": 10.0})
+    return token, ids
+
+
+def offer_load(base_url: str, token: str, ids, seconds: float, concurrency: int):
+    schedule = [(name, path) for name, weight, path in MIX for _ in range(weight)]
+    served, shed = defaultdict(list), defaultdict(int)
+    stop = time.monotonic() + seconds
+
+    with httpx.Client(base_url=base_url, limits=httpx.Limits(max_connections=concurrency), timeout=60) as client:
+        def worker(n):
+            for i in itertools.count(n):
+                if time.monotonic() >= stop:
+                    return
+                name, path = schedule[i % len(schedule)]
+                start = time.perf_counter()
+                response = client.get(
+                    path.format(id=ids[i % len(ids)]),
+                    headers={"Authorization": f"Bearer {token}"} if name == "critical" else None,
+                )
+                if response.status_code == 503:
+                    shed[name] += 1
+                    # Well-behaved clients come back after Retry-After.
+                    time.sleep(min(float(response.headers.get("Retry-After", 1)), max(stop - time.monotonic(), 0)))
+                else:
+                    served[name].append((time.perf_counter() - start) * 1000)
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(worker, range(concurrency)))
+    return served, shed
+
+
+def run(limited: bool, seconds: float, concurrency: int):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "CONCURRENCY_LIMIT_ENABLED": "1" if limited else "0"}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env,
+    )
+    try:
+        wait_ready(base_url)
+        token, ids = prepare(base_url)
+        light, _ = offer_load(base_url, token, ids, seconds / 3, 4)
+        light_p99 = percentile([sample for samples in light.values() for sample in samples], 0.99)
+        served, shed = offer_load(base_url, token, ids, seconds, concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+
+    label = "limiter on" if limited else "limiter off"
+    print(f"{label}: light-load p99 {light_p99:.1f}ms")
+    for name, _, path in MIX:
+        if served[name]:
+            summarize(f"  {name} {path}", served[name])
+        print(f"  {name:<10} served={len(served[name]):<7} shed={shed[name]}")
+    overload_p99 = percentile([sample for samples in served.values() for sample in samples], 0.99)
+    bounded = overload_p99 <= BOUND_FACTOR * light_p99
+    print(f"  overload p99 {overload_p99:.1f}ms: {'bounded' if bounded else 'UNBOUNDED'} (limit {BOUND_FACTOR}x light load)")
+    return bounded
+
+
+def main(seconds: float = 30, concurrency: int = 256):
+    run(False, seconds, concurrency)
+    if not run(True, seconds, concurrency):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*(float(arg) if i == 0 else int(arg) for i, arg in enumerate(sys.argv[1:])))
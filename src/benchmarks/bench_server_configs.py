@@ -0,0 +1,106 @@
+"""Throughput, latency and memory of server.py under different configurations.
+
+Run from src/ with DATABASE_URL pointing at a database the app can use:
+
+    python -m benchmarks.bench_server_configs [requests] [concurrency]
+
+Each configuration is started as a separate `python -m server` process.
+Memory is reported as the total PSS of the master and its workers, so pages
+shared copy-on-write after preloading are only counted once.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks.stats import summarize
+
+CONFIGS = [
+    ("asyncio/h11, no preload", ["--loop", "asyncio", "--http", "h11", "--no-preload"]),
+    ("uvloop/httptools, no preload", ["--loop", "uvloop", "--http", "httptools", "--no-preload"]),
+    ("uvloop/httptools, preload", ["--loop", "uvloop", "--http", "httptools"]),
+]
+PATHS = ["/plans/", "/magazines/"]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + PATHS[0]).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+def process_tree(pid: int):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return pids
+    for child in children:
+        pids.extend(process_tree(child))
+    return pids
+
+
+def total_pss_mb(pid: int):
+    total_kb = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return total_kb / 1024
+
+
+def load(base_url: str, requests: int, concurrency: int):
+    with httpx.Client(base_url=base_url, limits=httpx.Limits(max_connections=concurrency)) as client:
+        def one(i):
+            start = time.perf_counter()
+            client.get(PATHS[i % len(PATHS)])
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(one, range(requests)))
+        return samples, requests / (time.perf_counter() - start)
+
+
+def main(requests: int = 5000, concurrency: int = 32):
+    for name, args in CONFIGS:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = subprocess.Popen(
+            [sys.executable, "-m", "server", "--bind", f"127.0.0.1:{port}", *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy(),
+        )
+        try:
+            wait_ready(base_url)
+            load(base_url, concurrency * 10, concurrency)  # warm up
+            samples, rps = load(base_url, requests, concurrency)
+            summarize(name, samples)
+            print(f"{'':<40} {rps:8.0f} req/s, PSS {total_pss_mb(process.pid):.1f} MB")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,108 @@
+"""Optimistic (version compare-and-swap) vs pessimistic (SELECT ... FOR UPDATE)
+read-modify-write updates under contention.
+
+Run from src/:  python -m benchmarks.bench_update_contention [updates] [threads] [rows]
+
+Every thread bumps base_price on one of `rows` magazines `updates` times; fewer
+rows means more contention. Lost updates are counted by comparing the final
+prices with the number of increments. SQLite ignores FOR UPDATE and serializes
+writers itself, so set BENCH_DATABASE_URL to a Postgres database for a
+meaningful comparison.
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import make_engine
+from benchmarks.stats import summarize
+from models import Magazine
+
+
+def optimistic(engine, magazine_id: int):
+    retries = 0
+    while True:
+        try:
+            with engine.connect() as conn:
+                price, version = conn.execute(
+                    select(Magazine.base_price, Magazine.version).where(Magazine.id == magazine_id)
+                ).one()
+                conn.rollback()
+                swapped = conn.execute(
+                    update(Magazine)
+                    .where(Magazine.id == magazine_id, Magazine.version == version)
+                    .values(base_price=price + 1, version=version + 1)
+                ).rowcount
+                conn.commit()
+            if swapped:
+                return retries
+        except OperationalError:
+            pass
+        retries += 1
+
+
+def pessimistic(engine, magazine_id: int):
+    retries = 0
+    while True:
+        try:
+            with engine.begin() as conn:
+                price = conn.execute(
+                    select(Magazine.base_price).where(Magazine.id == magazine_id).with_for_update()
+                ).scalar_one()
+                conn.execute(update(Magazine).where(Magazine.id == magazine_id).values(base_price=price + 1))
+            return retries
+        except OperationalError:
+            # SQLite only: a busy database rather than a lock wait.
+            retries += 1
+
+
+def unprotected(engine, magazine_id: int):
+    # The old behaviour: read, then write whatever was computed.
+    with engine.connect() as conn:
+        price = conn.execute(select(Magazine.base_price).where(Magazine.id == magazine_id)).scalar_one()
+        conn.rollback()
+        conn.execute(update(Magazine).where(Magazine.id == magazine_id).values(base_price=price + 1))
+        conn.commit()
+    return 0
+
+
+def run(name, strategy, updates: int, threads: int, rows: int):
+    engine = make_engine()
+    with engine.begin() as conn:
+        conn.execute(insert(Magazine), [
+            {"name": f"Contended {i}", "description": "Contention benchmark", "base_price": 0}
+            for i in range(rows)
+        ])
+        ids = conn.execute(select(Magazine.id).order_by(Magazine.id)).scalars().all()
+
+    def one(i):
+        start = time.perf_counter()
+        retries = strategy(engine, ids[i % rows])
+        return (time.perf_counter() - start) * 1000, retries
+
+    total = updates * threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    with engine.connect() as conn:
+        applied = sum(conn.execute(select(Magazine.base_price)).scalars())
+    summarize(name, [latency for latency, _ in results])
+    print(
+        f"{'':<40} {total / elapsed:8.0f} updates/s, "
+        f"retries={sum(retries for _, retries in results)}, lost updates={total - applied}"
+    )
+    engine.dispose()
+
+
+def main(updates: int = 200, threads: int = 8, rows: int = 1):
+    run("unprotected read-modify-write", unprotected, updates, threads, rows)
+    run("optimistic (version CAS)", optimistic, updates, threads, rows)
+    run("pessimistic (FOR UPDATE)", pessimistic, updates, threads, rows)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
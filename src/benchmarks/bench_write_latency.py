@@ -0,0 +1,58 @@
+"""Write latency per endpoint.
+
+Run from src/:  python -m benchmarks.bench_write_latency [iterations]
+"""
+import sys
+
+from benchmarks.common import StatementCounter, bench_client, make_engine
+from benchmarks.stats import summarize, timed
+
+
+def main(iterations: int = 200):
+    engine = make_engine()
+    counter = StatementCounter(engine)
+    with bench_client(engine) as client:
+        plan = client.post("/plans/", json={"title": "Monthly", "description": "Monthly plan", "renewal_period": 1}).json()
+        magazine = client.post("/magazines/", json={
+            "name": "Bench Weekly",
+            "description": "A magazine for benchmarks",
+            "base_price": 5.0,
+            "discount_quarterly": 0.1,
+            "discount_half_yearly": 0.2,
+            "discount_annual": 0.3,
+        }).json()
+        subscription = {"user_id": 1, "magazine_id": magazine["id"], "plan_id": plan["id"], "price": 10.0}
+        ids = [client.post("/subscriptions/", json=subscription).json()["id"] for _ in range(iterations)]
+
+        def run(name, fn):
+            counter.count = 0
+            samples = timed(fn, iterations)
+            summarize(name, samples, counter.count)
+
+        run("POST /users/register", lambda i: client.post("/users/register", json={
+            "username": f"bench{i}", "email": f"bench{i}@example.com", "password": "secret"}))
+        run("DELETE /users/deactivate/{username}", lambda i: client.delete(f"/users/deactivate/bench{i}"))
+        run("PUT /magazines/{magazine_id}", lambda i: client.put(f"/magazines/{magazine['id']}", json={
+            "name": "Bench Weekly",
+            "description": f"Revision {i}",
+            "base_price": 5.0,
+            "discount_quarterly": 0.1,
+            "discount_half_yearly": 0.2,
+            "discount_annual": 0.3,
+        }))
+        run("PUT /plans/{plan_id}", lambda i: client.put(f"/plans/{plan['id']}", json={
+            "title": "Monthly", "description": f"Revision {i}", "renewal_period": 1}))
+        run("POST /subscriptions/", lambda i: client.post("/subscriptions/", json=subscription))
+        # A PUT deactivates the subscription and creates a new one; the
+        # DELETE run cancels those, so it measures cancelling active rows.
+        replacements = ids[:]
+
+        def replace(i):
+            replacements[i] = client.put(f"/subscriptions/{ids[i]}", json=subscription).json()["id"]
+
+        run("PUT /subscriptions/{subscription_id}", replace)
+        run("DELETE /subscriptions/{subscription_id}", lambda i: client.delete(f"/subscriptions/{replacements[i]}"))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,51 @@
+import os
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from db.database import connect_args, get_db
+from main import app
+from models import Base
+from plans import plan_registry
+
+# Benchmarks run against SQLite by default; point BENCH_DATABASE_URL at a
+# Postgres database to measure real round trips.
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL", "sqlite:///./bench.db")
+
+
+def make_engine(url: str = BENCH_DATABASE_URL):
+    engine = create_engine(url, connect_args={"check_same_thread": False} if url.startswith("sqlite") else connect_args(url))
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    plan_registry.clear()
+    return engine
+
+
+@contextmanager
+def bench_client(engine):
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        with TestClient(app) as client:
+            yield client
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
@@ -0,0 +1,24 @@
+import statistics
+import time
+
+
+def timed(fn, iterations: int):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def percentile(samples, fraction: float):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def summarize(name: str, samples, statements: int = None):
+    p50 = statistics.median(samples)
+    line = f"{name:<40} n={len(samples):<6} p50={p50:8.3f}ms p95={percentile(samples, 0.95):8.3f}ms p99={percentile(samples, 0.99):8.3f}ms"
+    if statements is not None:
+        line += f" statements/op={statements / len(samples):.1f}"
+    print(line)
@@ -0,0 +1,239 @@
+"""Bulk user import from CSV or NDJSON.
+
+Usage (from src/):  python -m bulk_import users.csv [--format csv|ndjson] [--batch-size 1000]
+"""
+import argparse
+import csv
+import io
+import json
+from itertools import islice
+from typing import Optional
+
+from pydantic import BaseModel, EmailStr, Field, ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models import User
+
+IMPORT_COLUMNS = ("username", "email", "password", "address", "phone", "is_active")
+
+
+class UserImportRow(BaseModel):
+    username: str = Field(min_length=1, max_length=50)
+    email: EmailStr = Field(max_length=100)
+    password: str = Field(min_length=1, max_length=100)
+    address: Optional[str] = Field(default=None, max_length=200)
+    phone: Optional[str] = Field(default=None, max_length=15)
+
+
+def detect_format(filename: str):
+    return "ndjson" if filename.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+def iter_records(stream, fmt: str):
+    # Yields (row number, record) without reading the whole file into memory.
+    if fmt == "csv":
+        for row_number, record in enumerate(csv.DictReader(stream), start=2):
+            yield row_number, {key: value or None for key, value in record.items()}
+    elif fmt == "ndjson":
+        for row_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield row_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield row_number, e
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _validation_message(error: ValidationError):
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+
+
+class UserImporter:
+    """Imports users through a Shards object (db/sharding.py).
+
+    With sharding on, every row gets an id from the allocator, its username
+    and email are claimed in the directory, and it is written to the shard
+    that owns the id.
+    """
+
+    def __init__(self, shards, batch_size: int = 1000):
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not {batch_size}")
+        self.shards = shards
+        self.batch_size = batch_size
+        self.imported = 0
+        self.errors = []
+        self._seen_usernames = set()
+        self._seen_emails = set()
+
+    def run(self, records):
+        for batch in _batched(records, self.batch_size):
+            self._import_batch(batch)
+        return self.report()
+
+    def report(self):
+        errors = sorted(self.errors, key=lambda error: error["row"])
+        return {"imported": self.imported, "failed": len(errors), "errors": errors}
+
+    def _error(self, row_number, message):
+        self.errors.append({"row": row_number, "error": message})
+
+    def _import_batch(self, batch):
+        candidates = []
+        for row_number, record in batch:
+            if isinstance(record, Exception):
+                self._error(row_number, f"Invalid JSON: {record}")
+                continue
+            try:
+                row = UserImportRow(**record)
+            except (ValidationError, TypeError) as e:
+                message = _validation_message(e) if isinstance(e, ValidationError) else str(e)
+                self._error(row_number, message)
+                continue
+            if row.username in self._seen_usernames:
+                self._error(row_number, f"Duplicate username in import: {row.username}")
+                continue
+            if row.email in self._seen_emails:
+                self._error(row_number, f"Duplicate email in import: {row.email}")
+                continue
+            self._seen_usernames.add(row.username)
+            self._seen_emails.add(row.email)
+            candidates.append((row_number, row))
+
+        if not candidates:
+            return
+
+        # Resolve conflicts with existing users with one query per column.
+        usernames = [row.username for _, row in candidates]
+        emails = [row.email for _, row in candidates]
+        db, directory = self.shards.directory()
+        taken_usernames = set(db.scalars(select(directory.c.username).where(directory.c.username.in_(usernames))))
+        taken_emails = set(db.scalars(select(directory.c.email).where(directory.c.email.in_(emails))))
+
+        rows = []
+        for row_number, row in candidates:
+            if row.username in taken_usernames:
+                self._error(row_number, f"Username already exists: {row.username}")
+            elif row.email in taken_emails:
+                self._error(row_number, f"Email already exists: {row.email}")
+            else:
+                rows.append((row_number, {**row.model_dump(), "is_active": True}))
+
+        if not rows:
+            return
+        for _, values in rows:
+            user_id = self.shards.new_id("users")
+            if user_id is not None:
+                values["id"] = user_id
+        try:
+            self._write([values for _, values in rows])
+            self.imported += len(rows)
+        except IntegrityError:
+            # A concurrent registration won a race with this batch; retry the
+            # rows one by one so only the conflicting ones are reported.
+            self._insert_one_by_one(rows)
+
+    def _write(self, rows):
+        self.shards.claim_users([(values.get("id"), values["username"], values["email"]) for values in rows])
+        by_shard = {}
+        for values in rows:
+            by_shard.setdefault(self.shards.for_user(values.get("id")), []).append(values)
+        committed = set()
+        try:
+            for db, shard_rows in by_shard.items():
+                load_users(db, shard_rows)
+                db.commit()
+                committed.update(values.get("id") for values in shard_rows)
+        except Exception:
+            for db in by_shard:
+                db.rollback()
+            self.shards.release_users([values.get("id") for values in rows if values.get("id") not in committed])
+            raise
+
+    def _insert_one_by_one(self, rows):
+        for row_number, values in rows:
+            try:
+                self._write([values])
+                self.imported += 1
+            except IntegrityError as e:
+                self._error(row_number, f"Conflict: {e.orig}")
+
+
+def load_users(db, rows):
+    if db.get_bind().dialect.name == "postgresql":
+        _copy_users(db, rows)
+    else:
+        db.execute(insert(User), rows)
+
+
+def _copy_users(db, rows):
+    # Sharded imports come with ids from the allocator.
+    columns = ("id",) + IMPORT_COLUMNS if "id" in rows[0] else IMPORT_COLUMNS
+    if db.get_bind().dialect.driver == "psycopg":
+        cursor = db.connection().connection.driver_connection.cursor()
+        with cursor, cursor.copy(f"COPY users ({', '.join(columns)}) FROM STDIN") as copy:
+            for values in rows:
+                copy.write_row([values[name] for name in columns])
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for values in rows:
+        writer.writerow(["\\N" if values[name] is None else values[name] for name in columns])
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY users ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def import_users(shards, stream, fmt: str, batch_size: int = 1000):
+    return UserImporter(shards, batch_size).run(iter_records(stream, fmt))
+
+
+def _batch_size(value: str):
+    size = int(value)
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {size}")
+    return size
+
+
+def main(argv=None):
+    from db.database import SessionLocal
+    from db.sharding import Shards, SingleShard, shard_router
+
+    parser = argparse.ArgumentParser(description="Bulk import users from CSV or NDJSON")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    parser.add_argument("--batch-size", type=_batch_size, default=1000)
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    shards = Shards(shard_router) if shard_router is not None else SingleShard(db)
+    try:
+        with open(args.path, newline="", encoding="utf-8") as stream:
+            report = import_users(shards, stream, args.format or detect_format(args.path), args.batch_size)
+    finally:
+        if shard_router is not None:
+            shards.close()
+        db.close()
+    for error in report["errors"]:
+        print(f"row {error['row']}: {error['error']}")
+    print(f"Imported {report['imported']} users, {report['failed']} failed")
+
+
+if __name__ == "__main__":
+    main()
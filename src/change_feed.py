@@ -0,0 +1,101 @@
+"""Wakes GET /subscriptions/changes listeners when the change log grows.
+
+Listeners are futures on the event loop, so an idle long-poll or SSE client
+costs no thread and no database connection. One shared poller per process
+numbers the changes committed since its last pass (see db/changes.py),
+checks the newest seq of every shard and wakes the listeners when it moved,
+every CHANGE_FEED_POLL_SECONDS however many clients are listening. Readers
+never number changes themselves, so a write shows up in the feed within one
+interval, whichever process made it.
+"""
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+
+from db.changes import latest_seq, sequence_changes
+
+CHANGE_FEED_POLL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_SECONDS", "1"))
+CHANGE_FEED_HEARTBEAT_SECONDS = float(os.getenv("CHANGE_FEED_HEARTBEAT_SECONDS", "15"))
+
+
+class ChangeNotifier:
+    def __init__(self):
+        self.generation = 0
+        self.latest_seqs = None
+        self._waiters = set()
+
+    def wake(self):
+        self.generation += 1
+        waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self, generation: int, timeout: float):
+        """Wait for a wake-up after `generation`; False on timeout.
+
+        Read `generation` before querying the log, so a change committed
+        between the query and this call is not missed.
+        """
+        if self.generation != generation:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.discard(waiter)
+
+    @property
+    def listeners(self):
+        return len(self._waiters)
+
+
+change_notifier = ChangeNotifier()
+
+
+@asynccontextmanager
+async def change_poller(shards_scope, interval: float = CHANGE_FEED_POLL_SECONDS):
+    """Numbers new changes and wakes the listeners, for the lifetime of the app.
+
+    shards_scope() yields a Shards object (see db/sharding.py).
+    """
+    def newest_seq(db):
+        sequence_changes(db)
+        return latest_seq(db)
+
+    def newest():
+        with shards_scope() as shards:
+            return shards.scatter(newest_seq)
+
+    async def loop():
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    seqs = await asyncio.to_thread(newest)
+                    if seqs != change_notifier.latest_seqs:
+                        change_notifier.latest_seqs = seqs
+                        change_notifier.wake()
+                except Exception as e:
+                    print(f"Change feed poll failed: {e}")
+
+    stop = asyncio.Event()
+    task = asyncio.create_task(loop())
+    try:
+        yield task
+    finally:
+        stop.set()
+        await task
+
+
+def sse_event(change):
+    return f"id: {change['cursor']}\nevent: change\ndata: {json.dumps(change, default=str)}\n\n"
+
+
+SSE_HEARTBEAT = ": keepalive\n\n"
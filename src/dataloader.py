@@ -0,0 +1,63 @@
+"""Batches per-id lookups made during one event-loop tick.
+
+Code that resolves rows one id at a time (e.g. the magazine of every
+subscription in a page) calls `await loader.load(id)`; every load issued
+before the loop gets back to its queue is collected and handed to one
+batch_load(ids) call, which runs a single IN query. Results are cached for
+the loader's lifetime, so create one loader per request.
+
+More than max_batch_size ids are split into several batches, which run one
+after another: batch_load usually queries the request's session, and a
+Session must not be used from two threads at once.
+"""
+import asyncio
+import os
+
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", "100"))
+
+
+class DataLoader:
+    def __init__(self, batch_load, max_batch_size: int = BATCH_MAX_IDS):
+        # batch_load is an async callable taking a list of distinct keys and
+        # returning {key: value}; keys it leaves out resolve to None.
+        self._batch_load = batch_load
+        self.max_batch_size = max_batch_size
+        self._cache = {}
+        self._queue = []
+        self._running = asyncio.Lock()
+        self.batches = 0
+
+    def load(self, key):
+        future = self._cache.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._cache[key] = loop.create_future()
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            self._queue.append(key)
+        return future
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*(self.load(key) for key in keys))
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, []
+        for start in range(0, len(queue), self.max_batch_size):
+            asyncio.ensure_future(self._run(queue[start:start + self.max_batch_size]))
+
+    async def _run(self, keys):
+        try:
+            async with self._running:
+                self.batches += 1
+                found = await self._batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                # Not cached, so a later load retries.
+                future = self._cache.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._cache[key]
+            if not future.done():
+                future.set_result(found.get(key))
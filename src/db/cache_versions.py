@@ -0,0 +1,87 @@
+"""Cross-worker invalidation of the in-memory catalog caches.
+
+Every worker process holds its own copy of the cached tables (the plan
+registry in plans.py, the typeahead index in search.py). A trigger bumps the
+table's row in cache_versions on every write that matters to the cache,
+whichever process or tool makes it (see models.py), so the writes themselves
+cost no extra statement. Each worker checks the versions every
+CACHE_REFRESH_SECONDS and brings the caches whose version moved up to date,
+so a write on another worker shows up here within one interval. The plans
+are reloaded in full; the typeahead index applies just the name changes
+recorded since (MagazineSearchIndex.update). Subscription writes do not wait
+for that: a plan this worker has not seen yet is read from the database
+(PlanRegistry.get_or_load).
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select
+
+from models import CacheVersion
+
+CACHE_REFRESH_SECONDS = float(os.getenv("CACHE_REFRESH_SECONDS", "1"))
+
+cache_versions = CacheVersion.__table__
+
+
+def read_versions(db):
+    return dict(db.execute(select(cache_versions.c.name, cache_versions.c.version)).all())
+
+
+class CacheRefresher:
+    """Updates the caches whose table changed since they were loaded."""
+
+    def __init__(self, loaders, updaters=None):
+        # {table name: load(db)}, and {table name: update(db)} for caches
+        # that can apply just what changed since they were loaded.
+        self.loaders = loaders
+        self.updaters = updaters or {}
+        self.versions = {}
+
+    def load(self, db):
+        self._reload(db, read_versions(db), list(self.loaders), self.loaders)
+
+    def refresh(self, db):
+        """Update the stale caches; returns their names."""
+        versions = read_versions(db)
+        stale = [name for name in self.loaders if versions.get(name) != self.versions.get(name)]
+        self._reload(db, versions, stale, {**self.loaders, **self.updaters})
+        return stale
+
+    def _reload(self, db, versions, names, loaders):
+        # The versions are read before the tables: a write that lands in
+        # between bumps them again and is picked up by the next refresh.
+        for name in names:
+            loaders[name](db)
+            self.versions[name] = versions.get(name)
+
+
+@asynccontextmanager
+async def cache_refresh_job(refresher: CacheRefresher, session_scope, interval: float = CACHE_REFRESH_SECONDS):
+    """Runs refresher.refresh() every `interval` seconds for the lifetime of the app."""
+    if interval <= 0:
+        yield None
+        return
+
+    def run():
+        with session_scope() as db:
+            return refresher.refresh(db)
+
+    async def loop():
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    await asyncio.to_thread(run)
+                except Exception as e:
+                    print(f"Cache refresh failed: {e}")
+
+    stop = asyncio.Event()
+    task = asyncio.create_task(loop())
+    try:
+        yield task
+    finally:
+        stop.set()
+        await task
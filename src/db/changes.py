@@ -0,0 +1,188 @@
+"""The subscription change log behind GET /subscriptions/changes.
+
+Every write in db/subscriptions.py records what it did here, in the same
+transaction, so a client that has seen everything up to seq N only needs the
+rows after N. Ops: "created", "replaced" (deactivated by a modification; the
+new row has its own "created") and "cancelled".
+
+With sharding on, every shard keeps its own log and seqs, so the feed's
+cursor holds one seq per shard: "12,5,9". Without sharding it is the seq.
+
+Writers insert their rows without a seq. Numbering them at insert time would
+let a reader see seq 12 before seq 11 commits and skip 11 for good, unless
+every writer held a lock until its commit. Instead sequence_changes() numbers
+the rows that have committed since it last ran, in a short transaction of
+its own; only those transactions are serialized, so seqs appear gap-free and
+in order. Only the change poller runs it, once per CHANGE_FEED_POLL_SECONDS
+(see change_feed.py); feed reads never take the lock.
+
+prune_changes() drops changes older than CHANGE_LOG_RETENTION_DAYS; a cursor
+from before then gets ChangeCursorExpired, while 0 starts at the oldest
+change left.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, update
+
+from models import Subscription, SubscriptionChange
+
+changes = SubscriptionChange.__table__
+subscriptions = Subscription.__table__
+
+CHANGE_LOG_RETENTION_DAYS = float(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+CHANGE_LOG_PRUNE_SECONDS = float(os.getenv("CHANGE_LOG_PRUNE_SECONDS", "3600"))
+
+# Any constants work; they only have to be the same for every process.
+CHANGE_LOG_LOCK = 0x5c4a11
+CHANGE_LOG_PRUNE_LOCK = 0x5c4a13
+
+
+class ChangeCursorExpired(ValueError):
+    """The changes after a cursor have been pruned."""
+
+
+def record_changes(db, entries):
+    """Record (op, subscription row) entries with one INSERT."""
+    now = datetime.utcnow()
+    rows = [
+        {"op": op, "subscription_id": row["id"], "user_id": row["user_id"], "changed_at": now}
+        for op, row in entries
+    ]
+    db.execute(insert(changes), rows)
+
+
+def sequence_changes(db):
+    """Give the committed changes without a seq the next ones; returns how many."""
+    if db.get_bind().dialect.name == "postgresql":
+        # Held until the commit below, so the next run reads this run's seqs.
+        db.execute(select(func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)))
+    last = select(func.coalesce(func.max(changes.c.seq), 0)).scalar_subquery()
+    pending = (
+        select(changes.c.id, (last + func.row_number().over(order_by=changes.c.id)).label("seq"))
+        .where(changes.c.seq.is_(None))
+        .subquery()
+    )
+    result = db.execute(update(changes).where(changes.c.id == pending.c.id).values(seq=pending.c.seq))
+    db.commit()
+    return result.rowcount
+
+
+def prune_changes(db, retention_days: float = CHANGE_LOG_RETENTION_DAYS):
+    """Delete changes older than the retention window; returns how many.
+
+    The newest change is always kept: the next seqs continue from it.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        # Every worker runs the job; one pass per database is enough.
+        if not db.execute(select(func.pg_try_advisory_xact_lock(CHANGE_LOG_PRUNE_LOCK))).scalar():
+            db.rollback()
+            return 0
+    newest = select(func.max(changes.c.seq)).scalar_subquery()
+    result = db.execute(
+        delete(changes).where(
+            changes.c.changed_at < datetime.utcnow() - timedelta(days=retention_days),
+            changes.c.seq < newest,
+        )
+    )
+    db.commit()
+    return result.rowcount
+
+
+def fetch_changes(db, since: int, limit: int):
+    stmt = (
+        select(changes.c.seq, changes.c.op, changes.c.changed_at, *subscriptions.c)
+        .join(subscriptions, subscriptions.c.id == changes.c.subscription_id)
+        .where(changes.c.seq > since)
+        .order_by(changes.c.seq)
+        .limit(limit)
+    )
+    page = [
+        {
+            "seq": row["seq"],
+            "op": row["op"],
+            "changed_at": row["changed_at"],
+            "subscription": {name: row[name] for name in subscriptions.c.keys()},
+        }
+        for row in db.execute(stmt).mappings()
+    ]
+    if page and since and page[0]["seq"] != since + 1:
+        # Seqs have no gaps, so the next one is missing only if it was pruned
+        # (checked against the oldest) or its subscription is gone.
+        if db.execute(select(func.min(changes.c.seq))).scalar() > since + 1:
+            raise ChangeCursorExpired(f"Changes after seq {since} have been pruned")
+    return page
+
+
+def latest_seq(db):
+    return db.execute(select(func.max(changes.c.seq))).scalar() or 0
+
+
+@asynccontextmanager
+async def pruning_job(shards_scope, interval: float = CHANGE_LOG_PRUNE_SECONDS):
+    """Runs prune_changes() on every shard every `interval` seconds for the lifetime of the app."""
+    if interval <= 0:
+        yield None
+        return
+
+    def run():
+        with shards_scope() as shards:
+            return sum(shards.scatter(prune_changes))
+
+    async def loop():
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    pruned = await asyncio.to_thread(run)
+                    if pruned:
+                        print(f"Pruned {pruned} subscription changes")
+                except Exception as e:
+                    print(f"Change log pruning failed: {e}")
+
+    stop = asyncio.Event()
+    task = asyncio.create_task(loop())
+    try:
+        yield task
+    finally:
+        stop.set()
+        await task
+
+
+def parse_cursor(cursor: str, shard_count: int):
+    """The per-shard seqs of a feed cursor; ValueError if it is malformed.
+
+    Shards missing from the cursor (added since it was issued) start at 0.
+    """
+    seqs = [int(seq) for seq in str(cursor).split(",")]
+    if len(seqs) > shard_count or any(seq < 0 for seq in seqs):
+        raise ValueError(f"Invalid change feed cursor: {cursor}")
+    return seqs + [0] * (shard_count - len(seqs))
+
+
+def format_cursor(seqs):
+    return seqs[0] if len(seqs) == 1 else ",".join(map(str, seqs))
+
+
+def fetch_shard_changes(shards, seqs, limit: int):
+    """Up to `limit` changes after the per-shard `seqs`, oldest first; returns (changes, new seqs).
+
+    Every shard's changes stay in seq order. Each change carries the cursor
+    to resume after it.
+    """
+    sessions = shards.all()
+    index = {db: shard for shard, db in enumerate(sessions)}
+    pages = shards.scatter(lambda db: fetch_changes(db, seqs[index[db]], limit), sessions)
+    seqs = list(seqs)
+    tagged = ([(shard, change) for change in page] for shard, page in enumerate(pages))
+    merged = heapq.merge(*tagged, key=lambda item: item[1]["changed_at"])
+    result = []
+    for shard, change in itertools.islice(merged, limit):
+        seqs[shard] = change["seq"]
+        result.append({**change, "cursor": format_cursor(seqs)})
+    return result, seqs
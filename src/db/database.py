@@ -1,13 +1,52 @@
-from sqlalchemy import create_engine, MetaData
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, make_url, MetaData
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 # from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 # from databases import Database
 
 import models
+from deadlines import DeadlineQueuePool
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+psycopg2://app_user:app_password@db/app")
+# "psycopg2" or "psycopg" (psycopg 3); overrides the driver in DATABASE_URL.
+DB_DRIVER = os.getenv("DB_DRIVER")
+if DB_DRIVER:
+    DATABASE_URL = make_url(DATABASE_URL).set(drivername=f"postgresql+{DB_DRIVER}").render_as_string(hide_password=False)
+
+# psycopg 3 prepares a statement server-side once a connection has run it this
+# many times. SQLAlchemy renders the same SQL for every call of a given query,
+# so the hot lookups stop being re-planned. "none" disables it, e.g. behind a
+# transaction-pooling PgBouncer.
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "2")
+
+# Per-process pool settings. server.py derives these from a global connection
+# budget so that workers x (pool size + overflow) stays under max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+
 
-DATABASE_URL = "postgresql+psycopg2://app_user:app_password@db/app"
+def connect_args(url):
+    if make_url(url).get_driver_name() == "psycopg":
+        threshold = None if DB_PREPARE_THRESHOLD.lower() == "none" else int(DB_PREPARE_THRESHOLD)
+        return {"prepare_threshold": threshold}
+    return {}
 
-engine = create_engine(DATABASE_URL)
+
+engine = create_engine(
+    DATABASE_URL,
+    # Checkouts during a request give up at the request's deadline.
+    poolclass=DeadlineQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    connect_args=connect_args(DATABASE_URL),
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Async support
@@ -26,6 +65,28 @@ def get_db():
     finally:
         db.close()
 
+def dialect_insert(db):
+    # insert() with on_conflict_do_update for the session's database.
+    return postgresql_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+
+
+@contextmanager
+def pipeline(db):
+    """Send the statements run inside the block without waiting for each result.
+
+    Uses psycopg 3 pipeline mode and is a no-op on other drivers. Only for
+    statements whose results are not read (no SELECT, no RETURNING): psycopg
+    does not hand SQLAlchemy a result until the pipeline is synced, at the end
+    of the block. Errors surface at the latest when the block exits.
+    executemany() is already pipelined by psycopg 3 and needs no block.
+    """
+    if db.get_bind().dialect.driver != "psycopg":
+        yield
+        return
+    with db.connection().connection.driver_connection.pipeline():
+        yield
+
+
 def initialize_database():
     print("Creating tables")
     models.Base.metadata.create_all(bind=engine)
\ No newline at end of file
@@ -0,0 +1,15 @@
+def query_budget(max_queries):
+    """Declare how many SQL statements a route may issue per request.
+
+    The test suite fails any request that goes over its route's budget (see
+    tests/query_counter.py). Use None for routes whose statement count
+    depends on the size of the input.
+    """
+    def decorator(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorator
+
+
+def get_query_budget(endpoint, default=...):
+    return getattr(endpoint, "query_budget", default)
@@ -0,0 +1,198 @@
+"""Active subscriber and revenue rollups per magazine x plan.
+
+Subscription writes apply their deltas in the same transaction (see
+db/subscriptions.py), so reading the report never scans subscriptions.
+reconcile() recomputes one database's rollups from scratch and fixes any
+drift; reconcile_shards() does so on every shard. It runs periodically inside
+the app (in one worker at a time: the others skip a database that is already
+being reconciled) and can be run by hand:
+
+    python -m db.rollups
+"""
+import asyncio
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from sqlalchemy import bindparam, delete, func, select, text
+
+from db.database import dialect_insert, pipeline
+from models import Plan, Subscription, SubscriptionRollup
+from plans import plan_registry
+
+rollups = SubscriptionRollup.__table__
+MEASURES = ("active_subscribers", "revenue", "monthly_revenue")
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("ROLLUP_RECONCILE_SECONDS", "3600"))
+
+# Any constant works; it only has to be the same for every worker.
+RECONCILE_LOCK = 0x5c4a12
+
+
+def _upsert(db, values, increment: bool):
+    stmt = dialect_insert(db)(rollups).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[rollups.c.magazine_id, rollups.c.plan_id],
+        set_={
+            name: (rollups.c[name] + stmt.excluded[name]) if increment else stmt.excluded[name]
+            for name in MEASURES
+        },
+    )
+    db.execute(stmt)
+
+
+def apply_deltas(db, changes):
+    """Apply (subscription row, +1/-1) changes as one multi-row upsert."""
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for row, sign in changes:
+        plan = plan_registry.get(row["plan_id"])
+        total = totals[(row["magazine_id"], row["plan_id"])]
+        total[0] += sign
+        total[1] += sign * row["price"]
+        total[2] += sign * row["price"] / plan.renewal_period if plan else 0.0
+    # In key order, so concurrent upserts lock the rows they share in the
+    # same order and cannot deadlock on each other.
+    values = [
+        {"magazine_id": magazine_id, "plan_id": plan_id, **dict(zip(MEASURES, total))}
+        for (magazine_id, plan_id), total in sorted(totals.items())
+        if any(total)
+    ]
+    if values:
+        _upsert(db, values, increment=True)
+
+
+def get_rollups(db, magazine_id: int = None):
+    stmt = select(rollups).order_by(rollups.c.magazine_id, rollups.c.plan_id)
+    if magazine_id is not None:
+        stmt = stmt.where(rollups.c.magazine_id == magazine_id)
+    return db.execute(stmt).mappings().all()
+
+
+def merge_rollups(pages):
+    """Sum the rollups read from several shards."""
+    if len(pages) == 1:
+        return pages[0]
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for page in pages:
+        for row in page:
+            total = totals[(row["magazine_id"], row["plan_id"])]
+            for i, name in enumerate(MEASURES):
+                total[i] += row[name]
+    return [
+        {"magazine_id": magazine_id, "plan_id": plan_id, **dict(zip(MEASURES, total))}
+        for (magazine_id, plan_id), total in sorted(totals.items())
+    ]
+
+
+def reconcile(db):
+    """Recompute the rollups from subscriptions; returns how many rows changed.
+
+    Returns 0 without doing anything if another process is reconciling the
+    same database.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        # Every worker runs the job on the same schedule; only the first to
+        # get here does the work instead of each taking the table lock in turn.
+        if not db.execute(select(func.pg_try_advisory_xact_lock(RECONCILE_LOCK))).scalar():
+            db.rollback()
+            return 0
+        # Writers queue behind this lock instead of applying deltas that the
+        # scan below would then overwrite.
+        db.execute(text("LOCK TABLE subscription_rollups IN EXCLUSIVE MODE"))
+    expected = {
+        (row.magazine_id, row.plan_id): (row.active_subscribers, float(row.revenue), float(row.monthly_revenue))
+        for row in db.execute(
+            select(
+                Subscription.magazine_id,
+                Subscription.plan_id,
+                func.count().label("active_subscribers"),
+                func.sum(Subscription.price).label("revenue"),
+                func.sum(Subscription.price * 1.0 / Plan.renewal_period).label("monthly_revenue"),
+            )
+            .join(Plan, Plan.id == Subscription.plan_id)
+            .where(Subscription.is_active.is_(True))
+            .group_by(Subscription.magazine_id, Subscription.plan_id)
+        )
+    }
+    current = {
+        (row["magazine_id"], row["plan_id"]): tuple(row[name] for name in MEASURES)
+        for row in get_rollups(db)
+    }
+
+    changed = [
+        {"magazine_id": magazine_id, "plan_id": plan_id, **dict(zip(MEASURES, measures))}
+        for (magazine_id, plan_id), measures in expected.items()
+        if not _close(current.get((magazine_id, plan_id)), measures)
+    ]
+    stale = [{"stale_magazine_id": magazine_id, "stale_plan_id": plan_id}
+             for magazine_id, plan_id in current if (magazine_id, plan_id) not in expected]
+    with pipeline(db):
+        if changed:
+            _upsert(db, changed, increment=False)
+        if stale:
+            db.execute(
+                delete(rollups).where(
+                    rollups.c.magazine_id == bindparam("stale_magazine_id"),
+                    rollups.c.plan_id == bindparam("stale_plan_id"),
+                ),
+                stale,
+            )
+    db.commit()
+    return len(changed) + len(stale)
+
+
+def reconcile_shards(shards):
+    """reconcile() on every shard (see db/sharding.py); returns how many rows changed."""
+    return sum(shards.scatter(reconcile))
+
+
+def _close(current, expected):
+    return current is not None and current[0] == expected[0] and all(
+        abs(a - b) < 1e-6 for a, b in zip(current[1:], expected[1:])
+    )
+
+
+@asynccontextmanager
+async def reconciliation_job(shards_scope, interval: float = RECONCILE_INTERVAL_SECONDS):
+    """Runs reconcile_shards() every `interval` seconds for the lifetime of the app."""
+    if interval <= 0:
+        yield None
+        return
+
+    def run():
+        with shards_scope() as shards:
+            return reconcile_shards(shards)
+
+    async def loop():
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    corrected = await asyncio.to_thread(run)
+                    if corrected:
+                        print(f"Rollup reconciliation corrected {corrected} rows")
+                except Exception as e:
+                    print(f"Rollup reconciliation failed: {e}")
+
+    stop = asyncio.Event()
+    task = asyncio.create_task(loop())
+    try:
+        yield task
+    finally:
+        stop.set()
+        await task
+
+
+if __name__ == "__main__":
+    from db.database import SessionLocal
+    from db.sharding import Shards, SingleShard, shard_router
+
+    db = SessionLocal()
+    shards = Shards(shard_router) if shard_router is not None else SingleShard(db)
+    try:
+        plan_registry.load(db)
+        print(f"Corrected {reconcile_shards(shards)} rollup rows")
+    finally:
+        if shard_router is not None:
+            shards.close()
+        db.close()
@@ -0,0 +1,384 @@
+"""Shards users and their subscriptions by user_id over several databases.
+
+Enabled by SHARD_URLS, a comma-separated list of database URLs whose first
+entry must be DATABASE_URL:
+
+- The first shard uses the app's engine; every other shard gets a pool
+  sized like it (DB_POOL_SIZE and DB_MAX_OVERFLOW, which server.py derives
+  from DB_CONNECTION_BUDGET), so each shard database sees at most the
+  budget.
+
+- A user and all of their subscriptions live on the shard that owns the user
+  id on a consistent-hash ring, so adding a shard moves about 1/N of users.
+- Magazines and plans are written to the first shard and replicated to the
+  others, so every shard can enforce the subscriptions' foreign keys. Run
+  `python -m db.sharding sync-catalog` to repair a replica after a failed write.
+- User and subscription ids come from blocks reserved on the first shard
+  (id_allocations), so they are unique across shards.
+- Usernames and emails are claimed in the first shard's user_directory
+  before the user is written, so they are unique across shards too. Run
+  `python -m db.sharding sync-directory`, with registrations stopped, to
+  rebuild it from the users on every shard.
+- Reads that span shards run on every shard in parallel and are merged.
+
+Endpoints take a Shards object from get_shards(); without SHARD_URLS it is a
+SingleShard that resolves everything to the request's get_db session.
+"""
+import bisect
+import contextvars
+import hashlib
+import heapq
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import Depends
+from sqlalchemy import create_engine, delete, insert, make_url, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from db.database import (
+    DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, connect_args, dialect_insert, engine, get_db,
+)
+from deadlines import DeadlineQueuePool
+from models import Base, IdAllocation, Magazine, Plan, User, UserDirectory
+
+SHARD_URLS = [url.strip() for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "100"))
+
+CATALOG_TABLES = (Magazine.__table__, Plan.__table__)
+id_allocations = IdAllocation.__table__
+user_directory = UserDirectory.__table__
+users = User.__table__
+
+
+def _hash(key: str):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring with `vnodes` points per shard.
+
+    Points depend only on the shard's index, so appending a shard leaves
+    the existing points in place and only takes over keys next to its own.
+    """
+
+    def __init__(self, shard_count: int, vnodes: int = SHARD_VNODES):
+        points = sorted(
+            (_hash(f"shard-{shard}-{vnode}"), shard) for shard in range(shard_count) for vnode in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._shards[index % len(self._shards)]
+
+
+class IdAllocator:
+    """Hands out ids from blocks reserved in the first shard's id_allocations."""
+
+    def __init__(self, session_factory, block_size: int = ID_BLOCK_SIZE):
+        self._session_factory = session_factory
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_id(self, name: str) -> int:
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                block = self._blocks[name] = self._reserve(name)
+            block[0] += 1
+            return block[0] - 1
+
+    def _reserve(self, name: str):
+        with self._session_factory() as db:
+            stmt = dialect_insert(db)(id_allocations).values(name=name, next_id=1 + self.block_size)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[id_allocations.c.name],
+                set_={"next_id": id_allocations.c.next_id + self.block_size},
+            ).returning(id_allocations.c.next_id)
+            end = db.execute(stmt).scalar_one()
+            db.commit()
+        return [end - self.block_size, end]
+
+
+class ShardRouter:
+    def __init__(self, engines, vnodes: int = SHARD_VNODES, block_size: int = ID_BLOCK_SIZE):
+        self.engines = list(engines)
+        self.session_factories = [
+            sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in self.engines
+        ]
+        self.ring = HashRing(len(self.engines), vnodes)
+        self.ids = IdAllocator(self.session_factories[0], block_size)
+        self.executor = ThreadPoolExecutor(4 * len(self.engines), thread_name_prefix="shard")
+
+    @classmethod
+    def from_urls(cls, urls, **kwargs):
+        return cls([shard_engine(url) for url in urls], **kwargs)
+
+    def create_all(self):
+        for engine in self.engines:
+            Base.metadata.create_all(bind=engine)
+
+    def shard_for_user(self, user_id: int) -> int:
+        return self.ring.shard_for(user_id)
+
+    def dispose_pools(self, close: bool = True):
+        """Drop every shard's pooled connections; close=False in a forked child."""
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+    def dispose(self):
+        self.executor.shutdown()
+        self.dispose_pools()
+
+
+def _same_database(url, other):
+    # DB_DRIVER may have changed DATABASE_URL's driver, so compare the rest.
+    url, other = make_url(url), make_url(other)
+    return url.get_backend_name() == other.get_backend_name() and url.translate_connect_args() == other.translate_connect_args()
+
+
+def shard_engine(url: str):
+    if _same_database(url, DATABASE_URL):
+        # One pool per database and process, not two.
+        return engine
+    if url.startswith("sqlite"):
+        # Scatter-gather uses a session from a worker thread.
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(
+        url,
+        poolclass=DeadlineQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        connect_args=connect_args(url),
+    )
+
+
+class Shards:
+    """The shard sessions of one request, opened on first use."""
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+        self._sessions = {}
+
+    def session(self, shard: int):
+        if shard not in self._sessions:
+            self._sessions[shard] = self.router.session_factories[shard]()
+        return self._sessions[shard]
+
+    @property
+    def catalog(self):
+        return self.session(0)
+
+    def all(self):
+        return [self.session(shard) for shard in range(len(self.router.engines))]
+
+    def replicas(self):
+        return self.all()[1:]
+
+    def for_user(self, user_id: int):
+        return self.session(self.router.shard_for_user(user_id))
+
+    def new_id(self, name: str):
+        return self.router.ids.next_id(name)
+
+    def claim_users(self, users):
+        """Reserve the (user_id, username, email) of new users; IntegrityError if any is taken."""
+        db = self.catalog
+        try:
+            db.execute(insert(user_directory), [
+                {"user_id": user_id, "username": username, "email": email} for user_id, username, email in users
+            ])
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise
+
+    def release_users(self, user_ids):
+        """Give up the claims of users whose write failed."""
+        db = self.catalog
+        db.rollback()
+        db.execute(delete(user_directory).where(user_directory.c.user_id.in_(user_ids)))
+        db.commit()
+
+    def directory(self):
+        """(session, table) whose username, email and user_id columns cover every user."""
+        return self.catalog, user_directory
+
+    def group_by_user(self, user_ids):
+        """{session: user ids it owns}, to look up many users with one query per shard."""
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.for_user(user_id), []).append(user_id)
+        return groups
+
+    def scatter(self, fn, sessions=None):
+        """fn(session) on every shard in parallel; results in shard order."""
+        sessions = self.all() if sessions is None else sessions
+        # Run in copies of the caller's context so the request deadline applies.
+        contexts = [contextvars.copy_context() for _ in sessions]
+        return list(self.router.executor.map(lambda context, db: context.run(fn, db), contexts, sessions))
+
+    def find(self, fn):
+        """(session, result) for the first shard where fn returns something."""
+        for db, result in zip(self.all(), self.scatter(fn)):
+            if result is not None:
+                return db, result
+        return None, None
+
+    def locate(self, fn):
+        """The session of the shard holding a row, or None; fn looks it up."""
+        return self.find(fn)[0]
+
+    def close(self):
+        for db in self._sessions.values():
+            db.close()
+
+
+class SingleShard:
+    """The Shards interface over the one database when sharding is off."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def session(self, shard: int):
+        return self.db
+
+    @property
+    def catalog(self):
+        return self.db
+
+    def all(self):
+        return [self.db]
+
+    def replicas(self):
+        return []
+
+    def for_user(self, user_id):
+        return self.db
+
+    def new_id(self, name: str):
+        return None  # the database assigns it
+
+    def claim_users(self, users):
+        pass  # the users table's unique constraints are enough
+
+    def release_users(self, user_ids):
+        pass
+
+    def directory(self):
+        # Same columns as user_directory; the planner inlines the subquery.
+        return self.db, select(users.c.id.label("user_id"), users.c.username, users.c.email).subquery("user_directory")
+
+    def group_by_user(self, user_ids):
+        return {self.db: list(user_ids)}
+
+    def scatter(self, fn, sessions=None):
+        return [fn(db) for db in ([self.db] if sessions is None else sessions)]
+
+    def find(self, fn):
+        return self.db, fn(self.db)
+
+    def locate(self, fn):
+        # There is nowhere else to look; callers find out it is missing when
+        # they read or write it.
+        return self.db
+
+
+shard_router = ShardRouter.from_urls(SHARD_URLS) if SHARD_URLS else None
+
+
+def get_shards(db=Depends(get_db)):
+    if shard_router is None:
+        yield SingleShard(db)
+        return
+    shards = Shards(shard_router)
+    try:
+        yield shards
+    finally:
+        shards.close()
+
+
+def merge_sorted(pages, key, limit: int = None):
+    """Merge per-shard lists that are each sorted by key."""
+    merged = heapq.merge(*pages, key=key)
+    return list(merged if limit is None else itertools.islice(merged, limit))
+
+
+def replicate_catalog_rows(shards, table, rows):
+    """Copy catalog rows written on the first shard to every other shard."""
+    if not rows:
+        return
+
+    def write(db):
+        stmt = dialect_insert(db)(table).values(rows)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={name: stmt.excluded[name] for name in rows[0] if name != "id"},
+        ))
+        db.commit()
+    shards.scatter(write, shards.replicas())
+
+
+def replicate_catalog_delete(shards, table, row_id: int):
+    def write(db):
+        db.execute(delete(table).where(table.c.id == row_id))
+        db.commit()
+    shards.scatter(write, shards.replicas())
+
+
+def sync_catalog(router: ShardRouter):
+    """Make every shard's catalog tables match the first shard's."""
+    shards = Shards(router)
+    try:
+        for table in CATALOG_TABLES:
+            rows = [dict(row) for row in shards.catalog.execute(select(table)).mappings()]
+            ids = [row["id"] for row in rows]
+            replicate_catalog_rows(shards, table, rows)
+
+            def prune(db):
+                db.execute(delete(table).where(table.c.id.not_in(ids)))
+                db.commit()
+            shards.scatter(prune, shards.replicas())
+    finally:
+        shards.close()
+
+
+def sync_directory(router: ShardRouter):
+    """Rebuild user_directory from the users on every shard.
+
+    Raises IntegrityError if two shards hold the same username or email.
+    """
+    shards = Shards(router)
+    try:
+        pages = shards.scatter(lambda db: [
+            dict(row) for row in db.execute(select(User.id.label("user_id"), User.username, User.email)).mappings()
+        ])
+        db = shards.catalog
+        db.execute(delete(user_directory))
+        rows = [row for page in pages for row in page]
+        if rows:
+            db.execute(insert(user_directory), rows)
+        db.commit()
+    finally:
+        shards.close()
+
+
+if __name__ == "__main__":
+    if shard_router is None:
+        sys.exit("SHARD_URLS is not set")
+    if sys.argv[1:] == ["create"]:
+        shard_router.create_all()
+    elif sys.argv[1:] == ["sync-catalog"]:
+        sync_catalog(shard_router)
+    elif sys.argv[1:] == ["sync-directory"]:
+        sync_directory(shard_router)
+    else:
+        sys.exit("Usage: python -m db.sharding create|sync-catalog|sync-directory")
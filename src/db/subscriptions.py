@@ -0,0 +1,102 @@
+from sqlalchemy import insert, literal, select, true, update
+
+from db.changes import record_changes
+from db.rollups import apply_deltas
+from models import Subscription
+
+subscriptions = Subscription.__table__
+
+# Columns written when a subscription row is created.
+WRITE_COLUMNS = ("user_id", "magazine_id", "plan_id", "price", "price_at_renewal", "next_renewal_date", "is_active")
+
+# Columns of the replaced row that modify_subscription needs: the rollups
+# are keyed and summed on magazine, plan and price; the change log records
+# the id and user.
+OLD_COLUMNS = ("id", "user_id", "magazine_id", "plan_id", "price")
+
+
+def _row_values(values: dict):
+    row = {"price_at_renewal": 0, "is_active": True}
+    row.update(values)
+    # Sharded deployments allocate ids up front (see db/sharding.py).
+    columns = WRITE_COLUMNS + ("id",) if row.get("id") is not None else WRITE_COLUMNS
+    return {name: row[name] for name in columns}
+
+
+def create_subscription(db, values: dict):
+    stmt = insert(subscriptions).values(**_row_values(values)).returning(*subscriptions.c)
+    created = db.execute(stmt).mappings().one()
+    apply_deltas(db, [(created, 1)])
+    record_changes(db, [("created", created)])
+    return created
+
+
+def get_subscription(db, subscription_id: int):
+    return db.execute(select(subscriptions).where(subscriptions.c.id == subscription_id)).mappings().first()
+
+
+def cancel_subscription(db, subscription_id: int):
+    # Only an active row moves the rollups; cancelling twice is a no-op.
+    cancelled = db.execute(_deactivate(subscription_id).returning(*subscriptions.c)).mappings().first()
+    if cancelled is not None:
+        apply_deltas(db, [(cancelled, -1)])
+        record_changes(db, [("cancelled", cancelled)])
+        return cancelled
+    return get_subscription(db, subscription_id)
+
+
+def modify_subscription(db, subscription_id: int, values: dict, versions=None):
+    # Business rule: modifying a subscription deactivates it and creates a new
+    # one. Returns the new row, or None if there was no active subscription at
+    # one of the given versions (any version when versions is None).
+    row = _row_values(values)
+    if db.get_bind().dialect.name == "postgresql":
+        result = db.execute(_modify_cte(subscription_id, row, versions)).mappings().first()
+        if result is None:
+            return None
+        created = {name: result[name] for name in subscriptions.c.keys()}
+        deactivated = {name: result[f"old_{name}"] for name in OLD_COLUMNS}
+    else:
+        # SQLite has no data-modifying CTEs, so fall back to two statements in
+        # the same transaction.
+        deactivated = db.execute(
+            _deactivate(subscription_id, versions).returning(*(subscriptions.c[name] for name in OLD_COLUMNS))
+        ).mappings().first()
+        if deactivated is None:
+            return None
+        created = db.execute(insert(subscriptions).values(**row).returning(*subscriptions.c)).mappings().one()
+    apply_deltas(db, [(deactivated, -1), (created, 1)])
+    record_changes(db, [("replaced", deactivated), ("created", created)])
+    return created
+
+
+def _deactivate(subscription_id: int, versions=None):
+    stmt = (
+        update(subscriptions)
+        .where(subscriptions.c.id == subscription_id, subscriptions.c.is_active.is_(True))
+        .values(is_active=False, version=subscriptions.c.version + 1)
+    )
+    if versions is not None:
+        stmt = stmt.where(subscriptions.c.version.in_(versions))
+    return stmt
+
+
+def _modify_cte(subscription_id: int, row: dict, versions=None):
+    # WITH old AS (UPDATE ... RETURNING ...), new AS (INSERT ... SELECT ... FROM old RETURNING *)
+    # SELECT new.*, old.* FROM new, old
+    old = _deactivate(subscription_id, versions).returning(
+        *(subscriptions.c[name] for name in OLD_COLUMNS)
+    ).cte("old")
+    new_row = select(
+        *(literal(value, subscriptions.c[name].type).label(name) for name, value in row.items())
+    ).select_from(old)
+    new = (
+        insert(subscriptions)
+        .from_select(list(row), new_row)
+        .returning(*subscriptions.c)
+        .cte("new")
+    )
+    return (
+        select(*new.c, *(old.c[name].label(f"old_{name}") for name in OLD_COLUMNS))
+        .select_from(new.join(old, true()))
+    )
@@ -48,15 +48,11 @@ class DBTransactions:
             if email is None:
                 email = generate_random_email()
             db_session.add(User(username=username, email=email, password=password, address=address, phone=phone))
-            db_session.commit()
-            db_session.close()
             return {"message": "User registered successfully"}
     
     def add_magazine(self, name: str, desc: str):
         with self.session_scope() as db_session:
             db_session.add(Magazine(name=name, description=desc))
-            db_session.commit()
-            db_session.close()
             return {"message": "User registered successfully"}
     
     def login(self, email: str, password: str):
@@ -0,0 +1,240 @@
+"""Per-request deadlines, propagated to the database.
+
+Every request gets a deadline: the route's budget (the @deadline decorator,
+overridden by ROUTE_DEADLINES, else REQUEST_DEADLINE_SECONDS), shortened
+by the client's X-Request-Timeout header if that is sooner. While the
+request runs:
+
+- each transaction starts with SET LOCAL statement_timeout set to the time
+  left (with psycopg2, in the same round trip as its first statement), so
+  Postgres cancels queries nobody is waiting for any more;
+- waiting for a pool connection gives up at the deadline (DeadlineQueuePool);
+- a transaction that would start after the deadline is not started.
+
+DeadlineMiddleware turns all three into a 504 and counts them per route for
+GET /metrics/deadlines. Threads are never interrupted, so a handler busy
+with something other than the database runs to completion.
+"""
+import contextvars
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool, QueuePool
+from starlette.routing import Match
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+# "GET /magazines/=2,POST /users/import=600"; "none" disables the deadline.
+ROUTE_DEADLINES = {
+    route.strip(): None if seconds.strip().lower() == "none" else float(seconds)
+    for route, _, seconds in (
+        entry.rpartition("=") for entry in os.getenv("ROUTE_DEADLINES", "").split(",") if entry.strip()
+    )
+}
+DEADLINE_HEADER = "x-request-timeout"
+
+# SQLSTATE query_canceled, raised when statement_timeout fires.
+QUERY_CANCELED = "57014"
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=504, detail="Request deadline exceeded")
+
+
+def deadline(seconds):
+    """Declare a route's deadline in seconds; None for long-lived routes."""
+    def decorator(endpoint):
+        endpoint.deadline = seconds
+        return endpoint
+    return decorator
+
+
+def route_deadline(method: str, route):
+    key = f"{method} {route.path}"
+    if key in ROUTE_DEADLINES:
+        return ROUTE_DEADLINES[key]
+    return getattr(route.endpoint, "deadline", REQUEST_DEADLINE_SECONDS)
+
+
+def remaining():
+    """Seconds left until the current deadline, or None without one."""
+    expires = _deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+@contextmanager
+def deadline_scope(seconds):
+    token = _deadline.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+# connection.info key: the statement_timeout (ms) still to be sent in the
+# current transaction.
+_PENDING_TIMEOUT = "pending_statement_timeout"
+
+
+@event.listens_for(Session, "after_begin")
+def _apply_statement_timeout(session, transaction, connection):
+    connection.info.pop(_PENDING_TIMEOUT, None)
+    left = remaining()
+    if left is None:
+        return
+    if left <= 0:
+        raise DeadlineExceeded()
+    if connection.dialect.name == "postgresql":
+        # Sent with the first statement (_send_statement_timeout) rather than
+        # on its own, which would cost every transaction another round trip.
+        connection.info[_PENDING_TIMEOUT] = max(int(left * 1000), 1)
+
+
+@event.listens_for(Engine, "before_cursor_execute", retval=True)
+def _send_statement_timeout(conn, cursor, statement, parameters, context, executemany):
+    timeout = conn.info.pop(_PENDING_TIMEOUT, None)
+    if timeout is None:
+        return statement, parameters
+    # SET LOCAL lasts until the transaction ends; the next one sets its own.
+    set_timeout = f"SET LOCAL statement_timeout = {timeout}"
+    if conn.dialect.driver == "psycopg2":
+        # psycopg2 binds parameters client-side and sends both statements in
+        # one query; the cursor ends up on the last result, the statement's.
+        return f"{set_timeout}; {statement}", parameters
+    # psycopg 3 would leave the cursor on the first result, the SET's, so it
+    # gets a round trip of its own.
+    cursor.execute(set_timeout)
+    return statement, parameters
+
+
+@event.listens_for(Pool, "checkin")
+def _forget_statement_timeout(dbapi_connection, connection_record):
+    # A transaction that ran no statement must not hand its timeout on.
+    connection_record.info.pop(_PENDING_TIMEOUT, None)
+
+
+class DeadlineQueuePool(QueuePool):
+    """QueuePool whose checkouts wait no longer than the current deadline."""
+
+    @property
+    def _timeout(self):
+        left = remaining()
+        return self._configured_timeout if left is None else max(min(self._configured_timeout, left), 0)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._configured_timeout = value
+
+    def recreate(self):
+        # The new pool takes the configured timeout, not this request's.
+        with deadline_scope(None):
+            return super().recreate()
+
+
+def is_deadline_error(error):
+    if isinstance(error, DeadlineExceeded):
+        return True
+    if isinstance(error, exc.TimeoutError):
+        return remaining() is not None  # the pool gave up waiting
+    if isinstance(error, exc.DBAPIError):
+        orig = error.orig
+        return (getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)) == QUERY_CANCELED
+    return False
+
+
+class _RouteDeadlines:
+    __slots__ = ("requests", "exceeded")
+
+    def __init__(self):
+        self.requests = self.exceeded = 0
+
+    def as_dict(self):
+        return {"requests": self.requests, "exceeded": self.exceeded}
+
+
+route_deadlines = defaultdict(_RouteDeadlines)
+
+
+def stats():
+    return {route: counts.as_dict() for route, counts in sorted(route_deadlines.items())}
+
+
+def find_route(app, scope):
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+def _client_timeout(scope):
+    for name, value in scope["headers"]:
+        if name == DEADLINE_HEADER.encode():
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                return None
+    return None
+
+
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = find_route(scope["app"], scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        budget = route_deadline(scope["method"], route)
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        client_timeout = _client_timeout(scope)
+        if client_timeout is not None:
+            budget = min(budget, client_timeout)
+
+        counts = route_deadlines[f"{scope['method']} {route.path}"]
+        counts.requests += 1
+        started = False
+
+        async def send_and_count(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                if message["status"] == 504:
+                    counts.exceeded += 1
+            await send(message)
+
+        if budget <= 0:
+            await _send_timeout(send_and_count)
+            return
+        with deadline_scope(budget):
+            try:
+                await self.app(scope, receive, send_and_count)
+            except Exception as e:
+                if started or not is_deadline_error(e):
+                    raise
+                await _send_timeout(send_and_count)
+
+
+async def _send_timeout(send):
+    body = json.dumps({"detail": "Request deadline exceeded"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 504,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
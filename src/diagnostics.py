@@ -0,0 +1,186 @@
+"""Opt-in memory diagnostics for tracking down worker RSS growth.
+
+Set DIAGNOSTICS=1 to start tracemalloc in each worker and enable the
+/debug/memory endpoints:
+
+- POST /debug/memory/snapshots takes a snapshot; GET .../{id}/diff compares
+  the current heap with it, grouped by allocating line.
+- GET /debug/memory/requests reports every route's peak allocation and net
+  growth per request, recorded by MemoryMiddleware.
+- GET /debug/memory/sessions counts live sessions, their identity maps and
+  ORM instances that outlived their session.
+
+tracemalloc slows allocation-heavy code down noticeably, so leave this off
+in normal operation. The peak is process-wide, so with concurrent requests
+a route's peak includes whatever else was running at the time.
+"""
+import gc
+import itertools
+import os
+import tracemalloc
+import weakref
+from collections import Counter, OrderedDict, defaultdict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Base
+
+DIAGNOSTICS_ENABLED = os.getenv("DIAGNOSTICS", "").lower() in ("1", "true", "yes")
+DIAGNOSTICS_TRACE_FRAMES = int(os.getenv("DIAGNOSTICS_TRACE_FRAMES", "10"))
+DIAGNOSTICS_MAX_SNAPSHOTS = int(os.getenv("DIAGNOSTICS_MAX_SNAPSHOTS", "5"))
+
+_sessions = weakref.WeakSet()
+_snapshot_ids = itertools.count(1)
+snapshots = OrderedDict()
+
+
+def _track_session(session, transaction, connection):
+    _sessions.add(session)
+
+
+def enable(frames: int = DIAGNOSTICS_TRACE_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    if not event.contains(Session, "after_begin", _track_session):
+        event.listen(Session, "after_begin", _track_session)
+
+
+def disable():
+    tracemalloc.stop()
+    if event.contains(Session, "after_begin", _track_session):
+        event.remove(Session, "after_begin", _track_session)
+    _sessions.clear()
+    snapshots.clear()
+    route_memory.clear()
+
+
+def enabled():
+    return tracemalloc.is_tracing()
+
+
+def take_snapshot():
+    snapshot_id = next(_snapshot_ids)
+    snapshots[snapshot_id] = _filtered(tracemalloc.take_snapshot())
+    while len(snapshots) > DIAGNOSTICS_MAX_SNAPSHOTS:
+        snapshots.popitem(last=False)
+    return snapshot_id
+
+
+def _filtered(snapshot):
+    # Leave out tracemalloc's own bookkeeping.
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+
+def _stat(stat, size_diff=None, count_diff=None):
+    frame = stat.traceback[0]
+    row = {"location": f"{frame.filename}:{frame.lineno}", "size": stat.size, "count": stat.count}
+    if size_diff is not None:
+        row.update(size_diff=size_diff, count_diff=count_diff)
+    return row
+
+
+def top_allocations(snapshot_id: int, limit: int):
+    return [_stat(stat) for stat in snapshots[snapshot_id].statistics("lineno")[:limit]]
+
+
+def diff(snapshot_id: int, limit: int):
+    """The lines whose allocations grew the most since the snapshot."""
+    current = _filtered(tracemalloc.take_snapshot())
+    stats = current.compare_to(snapshots[snapshot_id], "lineno")
+    return [_stat(stat, stat.size_diff, stat.count_diff) for stat in stats[:limit]]
+
+
+def traced_memory():
+    current, peak = tracemalloc.get_traced_memory()
+    return {"current": current, "peak": peak}
+
+
+class _RouteMemory:
+    __slots__ = ("requests", "peak_max", "peak_total", "growth_total")
+
+    def __init__(self):
+        self.requests = self.peak_max = self.peak_total = self.growth_total = 0
+
+    def record(self, peak: int, growth: int):
+        self.requests += 1
+        self.peak_max = max(self.peak_max, peak)
+        self.peak_total += peak
+        self.growth_total += growth
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "peak_max": self.peak_max,
+            "peak_mean": self.peak_total / self.requests if self.requests else 0,
+            "growth_total": self.growth_total,
+            "growth_mean": self.growth_total / self.requests if self.requests else 0,
+        }
+
+
+route_memory = defaultdict(_RouteMemory)
+UNMATCHED = "unmatched"
+
+
+def request_stats():
+    return {route: stats.as_dict() for route, stats in sorted(route_memory.items())}
+
+
+class MemoryMiddleware:
+    """Records each request's peak allocation above the memory in use when it started.
+
+    Does nothing unless tracemalloc is tracing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracemalloc.is_tracing():
+            await self.app(scope, receive, send)
+            return
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if tracemalloc.is_tracing():
+                end, peak = tracemalloc.get_traced_memory()
+                route = scope.get("route")
+                # Requests that matched no route share one entry; keyed by
+                # their raw path and method, the dict would grow without bound.
+                key = f"{scope['method']} {route.path}" if route is not None else UNMATCHED
+                route_memory[key].record(max(peak - start, 0), end - start)
+
+
+def session_stats():
+    """Live sessions and the ORM instances held in memory, by class."""
+    gc.collect()
+    sessions = list(_sessions)
+    identity_map = Counter()
+    for session in sessions:
+        for obj in session.identity_map.values():
+            identity_map[type(obj).__name__] += 1
+
+    instances, detached = Counter(), Counter()
+    # Exact type lookups; isinstance() over every object in the heap is slow.
+    mapped = {mapper.class_ for mapper in Base.registry.mappers}
+    for obj in gc.get_objects():
+        if type(obj) in mapped:
+            name = type(obj).__name__
+            instances[name] += 1
+            if inspect(obj).detached:
+                detached[name] += 1
+
+    return {
+        "sessions": len(sessions),
+        "sessions_in_transaction": sum(1 for session in sessions if session.in_transaction()),
+        "identity_map": dict(identity_map),
+        "identity_map_total": sum(identity_map.values()),
+        "orm_instances": dict(instances),
+        # Instances whose session has closed but that something still references.
+        "detached_instances": dict(detached),
+    }
@@ -0,0 +1,183 @@
+"""Adaptive concurrency limit with priority-based load shedding.
+
+Instead of letting a traffic spike queue up in the threadpool and on pool
+checkout, each worker admits at most `limit` requests at a time and
+answers the rest straight away with 503 and Retry-After.
+
+The limit adapts to observed latency (AIMD). Every route keeps its own
+baseline: the fastest response it gave over the last LATENCY_WINDOW
+requests. While responses stay within CONCURRENCY_LATENCY_TOLERANCE of
+their route's baseline and the limit is in use, it grows by one per `limit`
+completions. When a response is slower than that, requests are queueing
+somewhere, so the limit is multiplied by CONCURRENCY_BACKOFF, at most once
+per `limit` completions.
+
+Routes are admitted by priority (see @shed_priority):
+
+- CRITICAL (login, token refresh, /users/me) may go CRITICAL_HEADROOM above
+  the limit, so users can still sign in while the rest is shed. Sign-ups and
+  password reset mails are NORMAL: a burst of them must not eat that
+  headroom;
+- NORMAL uses the limit;
+- SHEDDABLE (bulk imports and exports) only gets SHEDDABLE_SHARE of it and
+  is the first to be turned away;
+- EXEMPT routes (the change feed, metrics) are never limited or measured.
+"""
+import json
+import math
+import os
+import time
+from collections import defaultdict
+
+from deadlines import find_route
+
+CONCURRENCY_LIMIT_ENABLED = os.getenv("CONCURRENCY_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+CONCURRENCY_INITIAL_LIMIT = float(os.getenv("CONCURRENCY_INITIAL_LIMIT", "20"))
+CONCURRENCY_MIN_LIMIT = float(os.getenv("CONCURRENCY_MIN_LIMIT", "4"))
+CONCURRENCY_MAX_LIMIT = float(os.getenv("CONCURRENCY_MAX_LIMIT", "200"))
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "2"))
+# Slowdowns smaller than this never count, however fast the baseline is.
+CONCURRENCY_LATENCY_SLACK_MS = float(os.getenv("CONCURRENCY_LATENCY_SLACK_MS", "20"))
+CONCURRENCY_BACKOFF = float(os.getenv("CONCURRENCY_BACKOFF", "0.9"))
+CONCURRENCY_RETRY_AFTER_SECONDS = int(os.getenv("CONCURRENCY_RETRY_AFTER_SECONDS", "1"))
+LATENCY_WINDOW = 500
+
+CRITICAL, NORMAL, SHEDDABLE, EXEMPT = "critical", "normal", "sheddable", "exempt"
+CRITICAL_HEADROOM = 1.5
+SHEDDABLE_SHARE = 0.5
+
+
+def shed_priority(priority: str):
+    """Declare a route's priority class; routes default to NORMAL."""
+    def decorator(endpoint):
+        endpoint.shed_priority = priority
+        return endpoint
+    return decorator
+
+
+class _Baseline:
+    """Windowed minimum latency of one route."""
+
+    __slots__ = ("current", "previous", "samples")
+
+    def __init__(self):
+        self.current = self.previous = math.inf
+        self.samples = 0
+
+    def observe(self, latency: float):
+        self.current = min(self.current, latency)
+        self.samples += 1
+        if self.samples >= LATENCY_WINDOW:
+            # Forget old minimums so the baseline follows lasting changes.
+            self.previous, self.current, self.samples = self.current, math.inf, 0
+
+    @property
+    def value(self):
+        return min(self.current, self.previous)
+
+
+class AdaptiveLimiter:
+    """Admission control for one worker; only used from the event loop."""
+
+    def __init__(
+        self,
+        initial: float = CONCURRENCY_INITIAL_LIMIT,
+        minimum: float = CONCURRENCY_MIN_LIMIT,
+        maximum: float = CONCURRENCY_MAX_LIMIT,
+        tolerance: float = CONCURRENCY_LATENCY_TOLERANCE,
+        slack: float = CONCURRENCY_LATENCY_SLACK_MS / 1000,
+        backoff: float = CONCURRENCY_BACKOFF,
+    ):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.slack = slack
+        self.backoff = backoff
+        self.in_flight = 0
+        self._since_decrease = 0
+        self._baselines = defaultdict(_Baseline)
+        self.admitted = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def capacity(self, priority: str):
+        if priority == CRITICAL:
+            return self.limit * CRITICAL_HEADROOM
+        if priority == SHEDDABLE:
+            return self.limit * SHEDDABLE_SHARE
+        return self.limit
+
+    def try_acquire(self, priority: str):
+        if self.in_flight >= max(self.capacity(priority), 1):
+            self.shed[priority] += 1
+            return False
+        self.in_flight += 1
+        self.admitted[priority] += 1
+        return True
+
+    def release(self, route: str, latency: float):
+        self.in_flight -= 1
+        baseline = self._baselines[route]
+        baseline.observe(latency)
+        self._since_decrease += 1
+        if latency > max(baseline.value * self.tolerance, baseline.value + self.slack):
+            if self._since_decrease >= self.limit:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._since_decrease = 0
+        elif self.in_flight + 1 >= self.limit * SHEDDABLE_SHARE:
+            # Only grow while the limit is actually being used.
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "admitted": dict(self.admitted),
+            "shed": dict(self.shed),
+        }
+
+
+limiter = AdaptiveLimiter()
+UNMATCHED = "unmatched"
+
+
+class ConcurrencyLimitMiddleware:
+    def __init__(self, app, limiter: AdaptiveLimiter = limiter, enabled: bool = CONCURRENCY_LIMIT_ENABLED):
+        self.app = app
+        self.limiter = limiter
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+        route = find_route(scope["app"], scope)
+        priority = getattr(route.endpoint, "shed_priority", NORMAL) if route is not None else NORMAL
+        if priority == EXEMPT:
+            await self.app(scope, receive, send)
+            return
+        if not self.limiter.try_acquire(priority):
+            await _send_overloaded(send, CONCURRENCY_RETRY_AFTER_SECONDS * (2 if priority == SHEDDABLE else 1))
+            return
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # Requests that matched no route share one baseline; keyed by
+            # their raw path, scanners would grow _baselines without bound.
+            key = f"{scope['method']} {route.path}" if route is not None else UNMATCHED
+            self.limiter.release(key, time.monotonic() - start)
+
+
+async def _send_overloaded(send, retry_after: int):
+    body = json.dumps({"detail": "Server is overloaded, retry later"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -1,30 +1,125 @@
-from fastapi import FastAPI, Path, Depends, HTTPException, Security
-from typing import Optional
+from fastapi import FastAPI, Path, Depends, HTTPException, Header, Query, Response, Security, UploadFile, File
+from contextlib import asynccontextmanager, contextmanager
+from typing import Literal, Optional
 from fastapi.security import HTTPBearer, OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from sqlalchemy import MetaData
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import MetaData, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from typing import List, Dict
 import json
 from db.database import initialize_database, SessionLocal, engine, get_db
 from models import User, Magazine, Plan, Subscription
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from auth import verify_password, create_access_token, create_refresh_token, verify_token
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 import secrets
 from db.transactions import DBTransactions
+from db import subscriptions as subscription_writes
+from db.cache_versions import CacheRefresher, cache_refresh_job
+from db.rollups import get_rollups, merge_rollups, reconciliation_job
+from db.sharding import (
+    Shards, get_shards, merge_sorted, replicate_catalog_delete, replicate_catalog_rows, shard_router,
+)
+from db.query_budget import query_budget
+from deadlines import deadline
+import load_shedding
+from load_shedding import CRITICAL, EXEMPT, SHEDDABLE, shed_priority
+from plans import PlanEntry, plan_registry
+import deadlines
+import diagnostics
+import singleflight
+from singleflight import SingleFlight
+from dataloader import BATCH_MAX_IDS, DataLoader
+from bulk_import import detect_format, import_users
+from search import magazine_index, search_magazines
+from reset_delivery import delivery_workers, enqueue_reset
+import io
+import asyncio
+from fastapi.responses import StreamingResponse
+from db.changes import (
+    ChangeCursorExpired, fetch_shard_changes, format_cursor, parse_cursor, pruning_job,
+)
+from change_feed import SSE_HEARTBEAT, CHANGE_FEED_HEARTBEAT_SECONDS, change_notifier, change_poller, sse_event
+from operator import itemgetter
 from pydantic import BaseModel, EmailStr
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-app = FastAPI()
+
+@contextmanager
+def background_session():
+    # Sessions for work done outside a request; honours dependency overrides
+    # so the tests' database is used under TestClient.
+    db_dependency = app.dependency_overrides.get(get_db, get_db)()
+    try:
+        yield next(db_dependency)
+    finally:
+        db_dependency.close()
+
+
+@contextmanager
+def background_shards():
+    # The Shards of work done outside a request, e.g. jobs that cover every
+    # shard; honours dependency overrides like background_session.
+    with background_session() as db:
+        override = app.dependency_overrides.get(get_shards)
+        shards_dependency = get_shards(db) if override is None else override()
+        try:
+            yield next(shards_dependency)
+        finally:
+            shards_dependency.close()
+
+
+# Reloads the plan registry and the typeahead index in every worker when
+# another one changes plans or magazines.
+catalog_caches = CacheRefresher(
+    {"plans": plan_registry.load, "magazines": magazine_index.load},
+    updaters={"magazines": magazine_index.update},
+)
+
+
+def warm_caches():
+    # Seed the in-memory caches. server.py calls this in the gunicorn master
+    # before forking so that workers share the loaded pages copy-on-write.
+    with background_session() as db:
+        catalog_caches.load(db)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The plan endpoints and subscription writes read from the plan registry
+    # instead of querying the plans table; typeahead reads from the magazine
+    # index.
+    if not (plan_registry.loaded and magazine_index.loaded):
+        warm_caches()
+    async with (
+        delivery_workers(background_shards),
+        reconciliation_job(background_shards),
+        change_poller(background_shards),
+        pruning_job(background_shards),
+        cache_refresh_job(catalog_caches, background_session),
+    ):
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
+# A no-op unless DIAGNOSTICS is set.
+app.add_middleware(diagnostics.MemoryMiddleware)
+app.add_middleware(deadlines.DeadlineMiddleware)
+# Outermost, so shed requests cost as little as possible.
+app.add_middleware(load_shedding.ConcurrencyLimitMiddleware)
+if diagnostics.DIAGNOSTICS_ENABLED:
+    diagnostics.enable()
 security = HTTPBearer()
 initialize_database()
+if shard_router is not None:
+    shard_router.create_all()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 class RegisterRequest(BaseModel):
     username: str
     password: str
-    email: Optional[EmailStr] = None
+    email: EmailStr
     address: Optional[str] = None
     phone: Optional[str] = None
 
@@ -45,6 +140,12 @@ class MagazineCreate(BaseModel):
     discount_half_yearly: float
     discount_annual: float
 
+class MagazineUpdate(MagazineCreate):
+    version: Optional[int] = None
+
+class MagazineResponse(MagazineCreate):
+    version: int
+
 class PlanModel(BaseModel):
     title: str
     description: str
@@ -62,11 +163,14 @@ class SubscriptionCreate(BaseModel):
     plan_id: int
     price: float
     # price_at_renewal: int
-    next_renewal_date: datetime
+    next_renewal_date: Optional[datetime] = None
 
     class Config:
         orm_mode = True
 
+class SubscriptionUpdate(SubscriptionCreate):
+    version: Optional[int] = None
+
 class SubscriptionResponse(BaseModel):
     id: int
     user_id: int
@@ -76,10 +180,151 @@ class SubscriptionResponse(BaseModel):
     price_at_renewal: float
     next_renewal_date: datetime
     is_active: bool
+    version: int
+
+class MagazineDetails(BaseModel):
+    id: int
+    name: str
+    description: str
+    base_price: float
+    discount_quarterly: Optional[float] = None
+    discount_half_yearly: Optional[float] = None
+    discount_annual: Optional[float] = None
+
+class MySubscriptionResponse(BaseModel):
+    id: int
+    price: float
+    price_at_renewal: float
+    next_renewal_date: datetime
+    is_active: bool
+    magazine: MagazineDetails
+    plan: Optional[PlanResponse] = None
+
+class MySubscriptionsPage(BaseModel):
+    items: List[MySubscriptionResponse]
+    next_after: Optional[int] = None
+
+class SubscriptionListItem(SubscriptionResponse):
+    # Only present when asked for with ?expand=
+    magazine: Optional[MagazineDetails] = None
+    plan: Optional[PlanResponse] = None
+
+class BatchIds(BaseModel):
+    ids: List[int]
+
+class UserSummary(BaseModel):
+    id: int
+    username: str
+    is_active: bool
+
+class MagazineBatch(BaseModel):
+    items: Dict[int, MagazineDetails]
+    missing: List[int]
+
+class PlanBatch(BaseModel):
+    items: Dict[int, PlanResponse]
+    missing: List[int]
+
+class UserBatch(BaseModel):
+    items: Dict[int, UserSummary]
+    missing: List[int]
+
+class SubscriptionRollupResponse(BaseModel):
+    magazine_id: int
+    plan_id: int
+    active_subscribers: int
+    revenue: float
+    monthly_revenue: float
+
+def etag(version: int):
+    return f'"{version}"'
+
+def _expected_versions(if_match: Optional[str], version: Optional[int]):
+    # Returns the versions an update may replace and the status to answer
+    # with when the row has moved on: a stale If-Match is a failed
+    # precondition, a stale version in the body a conflict.
+    if if_match is not None:
+        if if_match.strip() == "*":
+            return None, 412
+        # If-Match uses strong comparison, so weak tags never match.
+        tags = (tag.strip() for tag in if_match.split(","))
+        return [int(tag.strip('"')) for tag in tags if tag.strip('"').isdigit() and tag.startswith('"')], 412
+    if version is not None:
+        return [version], 409
+    return None, None
+
+def _raise_stale(current_version: Optional[int], status_code: Optional[int], detail: str):
+    if current_version is None or status_code is None:
+        raise HTTPException(status_code=404, detail=detail)
+    raise HTTPException(
+        status_code=status_code,
+        detail="Resource was modified concurrently",
+        headers={"ETag": etag(current_version)},
+    )
+
+magazine_reads = SingleFlight("magazines")
+user_reads = SingleFlight("users")
+
+def _shared_read(group: SingleFlight, key, fn):
+    # Concurrent identical reads share one query; fn must return plain data
+    # because every waiting request receives the same result. The leader's
+    # deadline is its own: a waiter whose deadline has not passed runs the
+    # query itself rather than fail with it, and waits no longer than its
+    # own deadline.
+    left = deadlines.remaining()
+    timeout = group.timeout if left is None else min(group.timeout, max(left, 0))
+    try:
+        return group.do(key, fn, timeout=timeout, retry=deadlines.is_deadline_error)
+    except TimeoutError:
+        left = deadlines.remaining()
+        if left is not None and left <= 0:
+            raise deadlines.DeadlineExceeded()
+        raise HTTPException(status_code=504, detail="Timed out waiting for a shared lookup")
+
+def _first_dict(result):
+    row = result.mappings().first()
+    return None if row is None else dict(row)
+
+def _forget_magazine_reads(magazine_id: Optional[int] = None):
+    magazine_reads.forget("all")
+    if magazine_id is not None:
+        magazine_reads.forget(("id", magazine_id))
+
+def _batch_ids(ids: Optional[str], body: Optional[BatchIds]):
+    # Batch lookups take ?ids=1,2,3 or a {"ids": [...]} body.
+    if body is not None:
+        values = body.ids
+    else:
+        try:
+            values = [int(value) for value in (ids or "").split(",") if value.strip()]
+        except ValueError:
+            raise HTTPException(status_code=422, detail="ids must be a comma-separated list of integers")
+    values = list(dict.fromkeys(values))
+    if not values:
+        raise HTTPException(status_code=422, detail="No ids given")
+    if len(values) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {BATCH_MAX_IDS} ids per request")
+    return values
+
+def _batch_response(ids: List[int], found: Dict[int, object]):
+    return {"items": found, "missing": [id for id in ids if id not in found]}
+
+def _magazines_by_id(db: Session, ids):
+    stmt = select(Magazine.__table__).where(Magazine.id.in_(ids))
+    return {row["id"]: dict(row) for row in db.execute(stmt).mappings()}
+
+def _users_by_id(shards: Shards, ids):
+    groups = shards.group_by_user(ids)
+
+    def lookup(db):
+        stmt = select(User.id, User.username, User.is_active).where(User.id.in_(groups[db]))
+        return [dict(row) for row in db.execute(stmt).mappings()]
+    return {row["id"]: row for page in shards.scatter(lookup, list(groups)) for row in page}
 
 data_transaction = DBTransactions(engine)
 
 @app.get("/models/")
+@query_budget(None)  # schema reflection, not a request path
 def list_models(db: SessionLocal = Depends(get_db)):
     meta = MetaData()
     meta.reflect(bind=engine)
@@ -87,6 +332,7 @@ def list_models(db: SessionLocal = Depends(get_db)):
     return {"models": list(tables)}
 
 @app.get("/models/{model_name}")
+@query_budget(None)  # schema reflection, not a request path
 def get_model(model_name: str, db: SessionLocal = Depends(get_db)):
     meta = MetaData()
     meta.reflect(bind=engine)
@@ -96,21 +342,62 @@ def get_model(model_name: str, db: SessionLocal = Depends(get_db)):
     return {"model": model_name, "columns": list(meta.tables[model_name].columns.keys())}
 
 @app.post("/users/register", response_model=None)
-def register(request: RegisterRequest, db: Session = Depends(get_db)):
+@query_budget(1)
+def register(request: RegisterRequest, shards: Shards = Depends(get_shards)):
     try:
-        db_user = User(**request.dict())
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        values = request.dict()
+        user_id = shards.new_id("users")
+        if user_id is not None:
+            values["id"] = user_id
+        # Sharded, the username and email are claimed on the first shard
+        # first; each shard's unique constraints only cover its own users.
+        shards.claim_users([(user_id, request.username, request.email)])
+        db = shards.for_user(user_id)
+        try:
+            stmt = insert(User).values(**values).returning(*User.__table__.c)
+            db_user = dict(db.execute(stmt).mappings().one())
+            db.commit()
+        except Exception:
+            db.rollback()
+            shards.release_users([user_id])
+            raise
         return db_user
     except Exception as e:
+        if deadlines.is_deadline_error(e):
+            raise
+        if _is_unique_violation(e):
+            raise HTTPException(status_code=409, detail="Username or email already registered")
         print(e)
         raise HTTPException(status_code=500, detail="Error registering user")
 
+UNIQUE_VIOLATION = "23505"
+
+def _is_unique_violation(error):
+    # Other integrity errors (a NOT NULL column, say) are not a taken name.
+    if not isinstance(error, IntegrityError):
+        return False
+    orig = error.orig
+    if (getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)) == UNIQUE_VIOLATION:
+        return True
+    return getattr(orig, "sqlite_errorname", None) == "SQLITE_CONSTRAINT_UNIQUE"
+
+@app.post("/users/import")
+@query_budget(None)  # two lookups and one load per batch
+@deadline(600)
+@shed_priority(SHEDDABLE)
+def bulk_import_users(file: UploadFile = File(...), format: Optional[str] = None, batch_size: int = Query(1000, ge=1), shards: Shards = Depends(get_shards)):
+    fmt = format or detect_format(file.filename or "")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=422, detail="Format must be csv or ndjson")
+    stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    return import_users(shards, stream, fmt, batch_size)
+
 @app.post("/users/login", response_model=None)
-def login(request: LoginRequest, db: Session = Depends(get_db)):
+@query_budget(1)
+@shed_priority(CRITICAL)
+def login(request: LoginRequest, shards: Shards = Depends(get_shards)):
     try:
-        user = db.query(User).filter(User.username == request.username).first()
+        _, user = shards.find(lambda db: db.query(User).filter(User.username == request.username).first())
         if user and verify_password(request.password, user.password):
             access_token = create_access_token({"sub": user.username})
             refresh_token = create_refresh_token({"sub": user.username})
@@ -124,26 +411,28 @@ def login(request: LoginRequest, db: Session = Depends(get_db)):
         else:
             raise HTTPException(status_code=401, detail="Invalid credentials")
     except Exception as e:
+        if deadlines.is_deadline_error(e):
+            raise
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/users/reset-password")
+@query_budget(1)
 def reset_password(email: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == email).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    reset_token = create_refresh_token({"sub": user.username})  # Replace with actual token generation logic
-    print(f"Generated reset token for {user.email}: {reset_token}")
+    # Delivery happens in reset_delivery's workers. The response does not
+    # depend on whether the email is registered.
+    enqueue_reset(db, email)
     return {"message": "Password reset email sent"}
 
 @app.post("/users/token/refresh")
-def user_token_refresh(token: str = Security(oauth2_scheme), db: Session = Depends(get_db)):
+@query_budget(1)
+@shed_priority(CRITICAL)
+def user_token_refresh(token: str = Security(oauth2_scheme), shards: Shards = Depends(get_shards)):
     payload = verify_token(token)
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = db.query(User).filter(User.username == payload.get("sub")).first()
+    _, user = shards.find(lambda db: db.query(User).filter(User.username == payload.get("sub")).first())
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -153,165 +442,516 @@ def user_token_refresh(token: str = Security(oauth2_scheme), db: Session = Depen
 
 
 @app.get("/users/me")
-def verify_user_token(token: str = Security(oauth2_scheme), db: Session = Depends(get_db)):
+@query_budget(1)
+@shed_priority(CRITICAL)
+def verify_user_token(token: str = Security(oauth2_scheme), shards: Shards = Depends(get_shards)):
     payload = verify_token(token)
     print(payload)
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = db.query(User).filter(User.username == payload.get("sub")).first()
+    username = payload.get("sub")
+    user = _shared_read(
+        user_reads, username,
+        lambda: shards.find(lambda db: db.execute(select(User.username).where(User.username == username)).scalar())[1],
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"username": user.username, "status": 200}
+    return {"username": user, "status": 200}
+
+@app.api_route("/users/batch", methods=["GET", "POST"], response_model=UserBatch)
+@query_budget(1)
+def get_users_by_ids(
+    ids: Optional[str] = Query(None, description="Comma-separated user ids"),
+    body: Optional[BatchIds] = None,
+    token: str = Security(oauth2_scheme),
+    shards: Shards = Depends(get_shards),
+):
+    if not verify_token(token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user_ids = _batch_ids(ids, body)
+    # One IN query per shard that owns any of the ids.
+    return _batch_response(user_ids, _users_by_id(shards, user_ids))
+
+@app.get("/users/me/subscriptions", response_model=MySubscriptionsPage)
+@query_budget(2)
+def get_my_subscriptions(
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[int] = Query(None, description="Return subscriptions with an id greater than this"),
+    token: str = Security(oauth2_scheme),
+    shards: Shards = Depends(get_shards),
+):
+    payload = verify_token(token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    # The user's subscriptions live on the same shard as the user.
+    db, user_id = shards.find(lambda db: db.query(User.id).filter(User.username == payload.get("sub")).scalar())
+    if user_id is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # Keyset pagination over the (user_id, is_active, id) index; magazines are
+    # joined in the same query and plans come from the in-memory registry.
+    query = (
+        db.query(Subscription)
+        .options(joinedload(Subscription.magazine))
+        .filter(Subscription.user_id == user_id, Subscription.is_active.is_(True))
+    )
+    if after is not None:
+        query = query.filter(Subscription.id > after)
+    rows = query.order_by(Subscription.id).limit(limit + 1).all()
+
+    items = [
+        {
+            "id": sub.id,
+            "price": sub.price,
+            "price_at_renewal": sub.price_at_renewal,
+            "next_renewal_date": sub.next_renewal_date,
+            "is_active": sub.is_active,
+            "magazine": sub.magazine,
+            "plan": plan_registry.get(sub.plan_id),
+        }
+        for sub in rows[:limit]
+    ]
+    next_after = rows[limit - 1].id if len(rows) > limit else None
+    return {"items": items, "next_after": next_after}
 
 @app.delete("/users/deactivate/{username}")
-def deactivate_user(username: str, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == username).first()
+@query_budget(1)
+def deactivate_user(username: str, shards: Shards = Depends(get_shards)):
+    stmt = update(User).where(User.username == username).values(is_active=False).returning(*User.__table__.c)
+    db, db_user = shards.find(lambda db: db.execute(stmt).mappings().first())
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    db_user.is_active = False  # Assuming there is an `is_active` field in the User model
+    db_user = dict(db_user)
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 
 @app.post("/magazines/", response_model=None)
-def create_magazine(magazine: MagazineCreate, db: Session = Depends(get_db)):
-    db_magazine = Magazine(**magazine.dict())
-    db.add(db_magazine)
+@query_budget(1)
+def create_magazine(magazine: MagazineCreate, shards: Shards = Depends(get_shards)):
+    db = shards.catalog
+    stmt = insert(Magazine).values(**magazine.dict()).returning(*Magazine.__table__.c)
+    db_magazine = dict(db.execute(stmt).mappings().one())
     db.commit()
-    db.refresh(db_magazine)
+    replicate_catalog_rows(shards, Magazine.__table__, [db_magazine])
+    magazine_index.put(db_magazine["id"], db_magazine["name"])
+    _forget_magazine_reads()
     return db_magazine
 
 @app.get("/magazines/", response_model=List[MagazineCreate])
+@query_budget(1)
 def get_magazines(db: Session = Depends(get_db)):
     try:
-        magazines = db.query(Magazine).all()
-        return magazines
+        return _shared_read(
+            magazine_reads, "all",
+            lambda: [dict(row) for row in db.execute(select(Magazine.__table__)).mappings()],
+        )
+    except HTTPException:
+        raise
     except Exception as e:
+        if deadlines.is_deadline_error(e):
+            raise
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/magazines/search", response_model=List[MagazineDetails])
+@query_budget(1)
+def search_magazine_catalog(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100), db: Session = Depends(get_db)):
+    return search_magazines(db, q, limit)
+
+@app.get("/magazines/autocomplete")
+@query_budget(0)
+def autocomplete_magazines(prefix: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=50)):
+    return magazine_index.complete(prefix, limit)
     
-@app.put("/magazines/{magazine_id}", response_model=MagazineCreate)
-def update_magazine(magazine_id: int, magazine: MagazineCreate, db: Session = Depends(get_db)):
-    db_magazine = db.query(Magazine).filter(Magazine.id == magazine_id).first()
+@app.api_route("/magazines/batch", methods=["GET", "POST"], response_model=MagazineBatch)
+@query_budget(1)
+def get_magazines_by_ids(
+    ids: Optional[str] = Query(None, description="Comma-separated magazine ids"),
+    body: Optional[BatchIds] = None,
+    db: Session = Depends(get_db),
+):
+    magazine_ids = _batch_ids(ids, body)
+    return _batch_response(magazine_ids, _magazines_by_id(db, magazine_ids))
+
+@app.put("/magazines/{magazine_id}", response_model=MagazineResponse)
+@query_budget(2)
+def update_magazine(
+    magazine_id: int,
+    magazine: MagazineUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    shards: Shards = Depends(get_shards),
+):
+    # Compare-and-swap on the version instead of locking the row.
+    db = shards.catalog
+    versions, stale_status = _expected_versions(if_match, magazine.version)
+    stmt = (
+        update(Magazine)
+        .where(Magazine.id == magazine_id)
+        .values(**magazine.dict(exclude={"version"}), version=Magazine.version + 1)
+        .returning(*Magazine.__table__.c)
+    )
+    if versions is not None:
+        stmt = stmt.where(Magazine.version.in_(versions))
+    db_magazine = db.execute(stmt).mappings().first()
     if db_magazine is None:
-        raise HTTPException(status_code=404, detail="Magazine not found")
-    
-    for key, value in magazine.dict().items():
-        setattr(db_magazine, key, value)
-    
+        current_version = db.execute(select(Magazine.version).where(Magazine.id == magazine_id)).scalar()
+        _raise_stale(current_version, stale_status, "Magazine not found")
+    db_magazine = dict(db_magazine)
     db.commit()
-    db.refresh(db_magazine)
+    replicate_catalog_rows(shards, Magazine.__table__, [db_magazine])
+    response.headers["ETag"] = etag(db_magazine["version"])
+    magazine_index.put(magazine_id, db_magazine["name"])
+    _forget_magazine_reads(magazine_id)
     return db_magazine
 
-@app.delete("/magazines/{magazine_id}", response_model=MagazineCreate)
-def delete_magazine(magazine_id: int, db: Session = Depends(get_db)):
-    db_magazine = db.query(Magazine).filter(Magazine.id == magazine_id).first()
+@app.delete("/magazines/{magazine_id}", response_model=MagazineResponse)
+@query_budget(1)
+def delete_magazine(magazine_id: int, shards: Shards = Depends(get_shards)):
+    db = shards.catalog
+    stmt = delete(Magazine).where(Magazine.id == magazine_id).returning(*Magazine.__table__.c)
+    db_magazine = db.execute(stmt).mappings().first()
     if db_magazine is None:
         raise HTTPException(status_code=404, detail="Magazine not found")
-    
-    db.delete(db_magazine)
+    db_magazine = dict(db_magazine)
     db.commit()
+    replicate_catalog_delete(shards, Magazine.__table__, magazine_id)
+    magazine_index.discard(magazine_id)
+    _forget_magazine_reads(magazine_id)
     return db_magazine
 
-@app.get("/magazines/{magazine_id}", response_model=MagazineCreate)
-def get_magazine_by_id(magazine_id: int, db: Session = Depends(get_db)):
-    db_magazine = db.query(Magazine).filter(Magazine.id == magazine_id).first()
+@app.get("/magazines/{magazine_id}", response_model=MagazineResponse)
+@query_budget(1)
+def get_magazine_by_id(magazine_id: int, response: Response, db: Session = Depends(get_db)):
+    db_magazine = _shared_read(
+        magazine_reads, ("id", magazine_id),
+        lambda: _first_dict(db.execute(select(Magazine.__table__).where(Magazine.id == magazine_id))),
+    )
     if db_magazine is None:
         raise HTTPException(status_code=404, detail="Magazine not found")
+    response.headers["ETag"] = etag(db_magazine["version"])
     return db_magazine
 
 @app.post("/plans/", response_model=PlanResponse)
-def create_plan(plan: PlanModel, db: Session = Depends(get_db)):
+@query_budget(1)
+def create_plan(plan: PlanModel, shards: Shards = Depends(get_shards)):
     if plan.renewal_period == 0:
         raise HTTPException(status_code=422, detail="Renewal period cannot be zero")
-    db_plan = Plan(**plan.dict())
-    db.add(db_plan)
+    db = shards.catalog
+    stmt = insert(Plan).values(**plan.dict()).returning(*Plan.__table__.c)
+    row = dict(db.execute(stmt).mappings().one())
     db.commit()
-    db.refresh(db_plan)
+    replicate_catalog_rows(shards, Plan.__table__, [row])
+    db_plan = PlanEntry(**row)
+    plan_registry.put(db_plan)
     return db_plan
 
 @app.get("/plans/", response_model=List[PlanResponse])
-def get_all_plans(db: Session = Depends(get_db)):
-    plans = db.query(Plan).all()
-    return plans
+@query_budget(0)
+def get_all_plans():
+    return plan_registry.all()
+
+@app.api_route("/plans/batch", methods=["GET", "POST"], response_model=PlanBatch)
+@query_budget(0)
+def get_plans_by_ids(ids: Optional[str] = Query(None, description="Comma-separated plan ids"), body: Optional[BatchIds] = None):
+    plan_ids = _batch_ids(ids, body)
+    plans = (plan_registry.get(plan_id) for plan_id in plan_ids)
+    return _batch_response(plan_ids, {plan.id: plan for plan in plans if plan is not None})
 
 @app.put("/plans/{plan_id}", response_model=PlanResponse)
-def update_plan(plan_id: int, plan: PlanModel, db: Session = Depends(get_db)):
-    db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
-    if db_plan is None:
+@query_budget(1)
+def update_plan(plan_id: int, plan: PlanModel, shards: Shards = Depends(get_shards)):
+    if plan.renewal_period == 0:
+        raise HTTPException(status_code=422, detail="Renewal period cannot be zero")
+    db = shards.catalog
+    stmt = update(Plan).where(Plan.id == plan_id).values(**plan.dict()).returning(*Plan.__table__.c)
+    row = db.execute(stmt).mappings().first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Plan not found")
-    
-    for key, value in plan.dict().items():
-        setattr(db_plan, key, value)
-    
+    row = dict(row)
     db.commit()
-    db.refresh(db_plan)
+    replicate_catalog_rows(shards, Plan.__table__, [row])
+    db_plan = PlanEntry(**row)
+    plan_registry.put(db_plan)
     return db_plan
 
 @app.delete("/plans/{plan_id}", response_model=PlanResponse)
-def delete_plan(plan_id: int, db: Session = Depends(get_db)):
-    db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
+@query_budget(1)
+def delete_plan(plan_id: int, shards: Shards = Depends(get_shards)):
+    db = shards.catalog
+    stmt = delete(Plan).where(Plan.id == plan_id).returning(*Plan.__table__.c)
+    db_plan = db.execute(stmt).mappings().first()
     if db_plan is None:
         raise HTTPException(status_code=404, detail="Plan not found")
-    
-    db.delete(db_plan)
+    db_plan = dict(db_plan)
     db.commit()
+    replicate_catalog_delete(shards, Plan.__table__, plan_id)
+    plan_registry.discard(plan_id)
     return db_plan
 
 @app.get("/plans/{plan_id}", response_model=PlanResponse)
-def get_magazine_by_id(plan_id: int, db: Session = Depends(get_db)):
-    db_plan = db.query(Plan).filter(Plan.id == plan_id).first()
-    if db_plan is None:
-        raise HTTPException(status_code=404, detail="Magazine not found")
-    return db_plan
+@query_budget(0)
+def get_plan_by_id(plan_id: int):
+    plan = plan_registry.get(plan_id)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return plan
+
+def _resolve_renewal_date(shards: Shards, subscription: SubscriptionCreate):
+    # The plan may have been created on another worker since the registry
+    # was last refreshed.
+    if plan_registry.get_or_load(shards.catalog, subscription.plan_id) is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    if subscription.next_renewal_date is not None:
+        return subscription.next_renewal_date
+    return plan_registry.next_renewal_date(subscription.plan_id, date.today())
+
+def _subscription_shard(shards: Shards, subscription_id: int):
+    db = shards.locate(
+        lambda db: db.execute(select(Subscription.id).where(Subscription.id == subscription_id)).scalar()
+    )
+    if db is None:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+    return db
 
 @app.post("/subscriptions/", response_model=SubscriptionResponse)
-def create_subscription(subscription: SubscriptionCreate, db: Session = Depends(get_db)):
-    db_subscription = Subscription(**subscription.dict())
-    db.add(db_subscription)
+@query_budget(4)  # 3, plus reading a plan this worker has not seen yet
+def create_subscription(subscription: SubscriptionCreate, shards: Shards = Depends(get_shards)):
+    values = subscription.dict()
+    values["next_renewal_date"] = _resolve_renewal_date(shards, subscription)
+    values["id"] = shards.new_id("subscriptions")
+    db = shards.for_user(subscription.user_id)
+    db_subscription = dict(subscription_writes.create_subscription(db, values))
     db.commit()
-    db.refresh(db_subscription)
     return db_subscription
 
-@app.get("/subscriptions/", response_model=List[SubscriptionResponse])
-def get_all_subscriptions(db: Session = Depends(get_db)):
-    subs = db.query(Subscription).all()
-    return subs
+@app.get("/subscriptions/", response_model=List[SubscriptionListItem], response_model_exclude_unset=True)
+@query_budget(2)  # the page, plus one IN query for its magazines with ?expand=magazine
+@shed_priority(SHEDDABLE)
+async def get_all_subscriptions(
+    # Capped so that a page's magazines fit in one batch.
+    limit: int = Query(BATCH_MAX_IDS, ge=1, le=BATCH_MAX_IDS),
+    after: Optional[int] = Query(None, description="Return subscriptions with an id greater than this"),
+    expand: Optional[str] = Query(None, description="Comma-separated related rows to embed: magazine, plan"),
+    shards: Shards = Depends(get_shards),
+):
+    fields = {field.strip() for field in (expand or "").split(",") if field.strip()}
+    if fields - {"magazine", "plan"}:
+        raise HTTPException(status_code=422, detail="expand takes magazine and/or plan")
+
+    # Every shard returns its first `limit` rows in id order; merging them
+    # yields the first `limit` overall.
+    stmt = select(Subscription.__table__).order_by(Subscription.id).limit(limit)
+    if after is not None:
+        stmt = stmt.where(Subscription.id > after)
+    pages = await asyncio.to_thread(shards.scatter, lambda db: [dict(row) for row in db.execute(stmt).mappings()])
+    rows = merge_sorted(pages, key=itemgetter("id"), limit=limit)
+
+    if "magazine" in fields:
+        # The per-row lookups are coalesced into one IN query, run in a
+        # worker thread on the request's session.
+        magazines = DataLoader(lambda ids: asyncio.to_thread(_magazines_by_id, shards.catalog, ids))
+        for row, magazine in zip(rows, await magazines.load_many(row["magazine_id"] for row in rows)):
+            row["magazine"] = magazine
+    if "plan" in fields:
+        for row in rows:
+            row["plan"] = plan_registry.get(row["plan_id"])
+    return rows
+
+def _fetch_changes(seqs, limit: int):
+    # Changes show up once the poller has numbered them (change_feed.py); it
+    # wakes the waiting readers when it has.
+    with background_shards() as shards:
+        try:
+            return fetch_shard_changes(shards, seqs, limit)
+        except ChangeCursorExpired:
+            raise HTTPException(status_code=410, detail="Changes after this cursor were pruned; start again from 0")
+
+def _change_cursor(cursor: str):
+    with background_shards() as shards:
+        shard_count = len(shards.all())
+    try:
+        return parse_cursor(cursor, shard_count)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid change feed cursor")
+
+async def _changes_after(seqs, limit: int):
+    # The generation is read before the query, for change_notifier.wait().
+    generation = change_notifier.generation
+    changes, seqs = await asyncio.to_thread(_fetch_changes, seqs, limit)
+    return generation, changes, seqs
+
+async def _change_stream(first_page, limit: int, timeout: float):
+    # The first page is fetched before the response starts, so that an
+    # expired cursor still gets its 410.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    generation, changes, seqs = first_page
+    while True:
+        for change in changes:
+            yield sse_event(change)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        if len(changes) < limit and not await change_notifier.wait(generation, min(remaining, CHANGE_FEED_HEARTBEAT_SECONDS)):
+            yield SSE_HEARTBEAT
+        generation, changes, seqs = await _changes_after(seqs, limit)
+
+@app.get("/subscriptions/changes")
+@query_budget(None)  # one query per batch of changes until the wait times out
+@deadline(None)  # bounded by its own timeout parameter
+@shed_priority(EXEMPT)
+async def get_subscription_changes(
+    since: str = Query("0", description="Cursor of the last change seen: its seq, or one seq per shard"),
+    limit: int = Query(100, ge=1, le=1000),
+    mode: Literal["poll", "longpoll", "sse"] = "poll",
+    timeout: float = Query(30, ge=0, le=300, description="How long longpoll waits, or sse streams, before returning"),
+    last_event_id: Optional[str] = Header(None),
+):
+    # Clients keep the cursor of the last change they saw and ask for what
+    # came after it. Waiting happens on the event loop, not in a thread.
+    if mode == "sse":
+        # EventSource reconnects with Last-Event-ID set to the last cursor.
+        seqs = _change_cursor(since if last_event_id is None else last_event_id)
+        return StreamingResponse(
+            _change_stream(await _changes_after(seqs, limit), limit, timeout),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    seqs = _change_cursor(since)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        generation, changes, seqs = await _changes_after(seqs, limit)
+        remaining = deadline - loop.time()
+        if changes or mode == "poll" or remaining <= 0:
+            break
+        if not await change_notifier.wait(generation, remaining):
+            break
+    return {"changes": changes, "next": format_cursor(seqs)}
 
 @app.put("/subscriptions/{subscription_id}", response_model=SubscriptionResponse)
-def update_subscription(subscription_id: int, subscription: SubscriptionCreate, db: Session = Depends(get_db)):
-    db_subscription = db.query(Subscription).filter(Subscription.id == subscription_id).first()
+@query_budget(5)  # 4, plus reading a plan this worker has not seen yet
+def update_subscription(
+    subscription_id: int,
+    subscription: SubscriptionUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    shards: Shards = Depends(get_shards),
+):
+    # Modifying a subscription deactivates it and creates a new one (see the
+    # business rules in assignment.md), so the response carries the new id.
+    versions, stale_status = _expected_versions(if_match, subscription.version)
+    values = subscription.dict()
+    values["next_renewal_date"] = _resolve_renewal_date(shards, subscription)
+    db = _subscription_shard(shards, subscription_id)
+    if db is not shards.for_user(subscription.user_id):
+        # Both rows are written in one transaction, so they must share a shard.
+        raise HTTPException(status_code=422, detail="Cannot move a subscription to a user on another shard")
+    values["id"] = shards.new_id("subscriptions")
+    db_subscription = subscription_writes.modify_subscription(db, subscription_id, values, versions)
     if db_subscription is None:
-        raise HTTPException(status_code=404, detail="Subscription not found")
-    
-    for key, value in subscription.dict().items():
-        setattr(db_subscription, key, value)
-    
+        current = subscription_writes.get_subscription(db, subscription_id)
+        if current is None or not current["is_active"]:
+            raise HTTPException(status_code=404, detail="Subscription not found")
+        _raise_stale(current["version"], stale_status, "Subscription not found")
+    db_subscription = dict(db_subscription)
     db.commit()
-    db.refresh(db_subscription)
+    response.headers["ETag"] = etag(db_subscription["version"])
     return db_subscription
 
 @app.delete("/subscriptions/{subscription_id}", response_model=SubscriptionResponse)
-def delete_subscription(subscription_id: int, db: Session = Depends(get_db)):
-    db_subscription = db.query(Subscription).filter(Subscription.id == subscription_id).first()
+@query_budget(3)
+def delete_subscription(subscription_id: int, shards: Shards = Depends(get_shards)):
+    db = _subscription_shard(shards, subscription_id)
+    db_subscription = subscription_writes.cancel_subscription(db, subscription_id)
     if db_subscription is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
-    
-    db_subscription.is_active = False
-    # db.delete(db_subscription)
+    db_subscription = dict(db_subscription)
     db.commit()
-    db.refresh(db_subscription)
     return db_subscription
 
 @app.get("/subscriptions/{subscription_id}", response_model=SubscriptionResponse)
-def get_subscription_by_id(subscription_id: int, db: Session = Depends(get_db)):
-    db_subscription = db.query(Subscription).filter(Subscription.id == subscription_id).first()
+@query_budget(1)
+def get_subscription_by_id(subscription_id: int, response: Response, shards: Shards = Depends(get_shards)):
+    _, db_subscription = shards.find(lambda db: subscription_writes.get_subscription(db, subscription_id))
     if db_subscription is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
-    return db_subscription
+    response.headers["ETag"] = etag(db_subscription["version"])
+    return dict(db_subscription)
+
+@app.get("/metrics/singleflight")
+@query_budget(0)
+@shed_priority(EXEMPT)
+def get_singleflight_metrics():
+    # calls = executions + coalesced for every group.
+    return singleflight.stats()
+
+@app.get("/metrics/concurrency")
+@query_budget(0)
+@shed_priority(EXEMPT)
+def get_concurrency_metrics():
+    # The current adaptive limit and requests admitted and shed per priority.
+    return load_shedding.limiter.stats()
+
+@app.get("/metrics/deadlines")
+@query_budget(0)
+@shed_priority(EXEMPT)
+def get_deadline_metrics():
+    # Requests per route and how many of them ran out of time (504).
+    return deadlines.stats()
+
+def _require_diagnostics():
+    if not diagnostics.enabled():
+        raise HTTPException(status_code=404, detail="Diagnostics are disabled")
+
+@app.post("/debug/memory/snapshots")
+@query_budget(0)
+@shed_priority(SHEDDABLE)
+def take_memory_snapshot(limit: int = Query(20, ge=1, le=200)):
+    _require_diagnostics()
+    snapshot_id = diagnostics.take_snapshot()
+    return {
+        "id": snapshot_id,
+        **diagnostics.traced_memory(),
+        "top": diagnostics.top_allocations(snapshot_id, limit),
+    }
+
+@app.get("/debug/memory/snapshots/{snapshot_id}/diff")
+@query_budget(0)
+@shed_priority(SHEDDABLE)
+def diff_memory_snapshot(snapshot_id: int, limit: int = Query(20, ge=1, le=200)):
+    _require_diagnostics()
+    if snapshot_id not in diagnostics.snapshots:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    return {**diagnostics.traced_memory(), "diff": diagnostics.diff(snapshot_id, limit)}
+
+@app.get("/debug/memory/requests")
+@query_budget(0)
+@shed_priority(SHEDDABLE)
+def get_request_memory():
+    # Bytes; growth is what each request left allocated when it finished.
+    _require_diagnostics()
+    return diagnostics.request_stats()
+
+@app.get("/debug/memory/sessions")
+@query_budget(0)
+@shed_priority(SHEDDABLE)
+def get_session_memory():
+    _require_diagnostics()
+    return diagnostics.session_stats()
+
+@app.get("/reports/subscriptions", response_model=List[SubscriptionRollupResponse])
+@query_budget(1)
+@shed_priority(SHEDDABLE)
+def get_subscription_report(magazine_id: Optional[int] = None, shards: Shards = Depends(get_shards)):
+    # Active subscribers and revenue per magazine x plan, read from the
+    # rollups kept by the subscription writes rather than scanning them.
+    return merge_rollups(shards.scatter(lambda db: get_rollups(db, magazine_id)))
 
 # magazines = [
 #     {"name": "Magazine A", "plans": ["1", "2"], "discounts": {"1": 0.1, "2": 0.2}},
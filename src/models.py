@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, MetaData
+from sqlalchemy import Column, Integer, String, MetaData, DDL, event
 # from .database import Base
 from sqlalchemy.orm import declarative_base
 from sqlalchemy import Column, Integer, String, Float
-from sqlalchemy import ForeignKey, Boolean, Date
+from sqlalchemy import ForeignKey, Boolean, Date, DateTime, Index
 from sqlalchemy.orm import relationship
 
 metadata = MetaData()
@@ -18,6 +18,7 @@ class User(Base):
     password = Column(String(100), nullable=False)
     address = Column(String(200), nullable=True)
     phone = Column(String(15), nullable=True)
+    is_active = Column(Boolean, nullable=False, default=True)
 
 
 class Magazine(Base):
@@ -31,6 +32,39 @@ class Magazine(Base):
     discount_half_yearly = Column(Float, nullable=False, default=10.0)
     discount_quarterly = Column(Float, nullable=True)
     discount_annual = Column(Float, nullable=True)
+    # Bumped by every update; writers compare-and-swap on it (see main.py).
+    version = Column(Integer, nullable=False, default=1)
+
+
+# Full-text search indexes for /magazines/search. Postgres gets a GIN index on
+# the tsvector the search query ranks by plus a trigram index for fuzzy name
+# matches; SQLite gets an FTS5 table kept in sync by triggers.
+MAGAZINE_SEARCH_DOCUMENT = "to_tsvector('english', name || ' ' || description)"
+
+_magazine_search_ddl = {
+    'postgresql': [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        f"CREATE INDEX IF NOT EXISTS ix_magazines_search ON magazines USING gin ({MAGAZINE_SEARCH_DOCUMENT})",
+        "CREATE INDEX IF NOT EXISTS ix_magazines_name_trgm ON magazines USING gin (name gin_trgm_ops)",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS magazines_fts "
+        "USING fts5(name, description, content='magazines', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_insert AFTER INSERT ON magazines BEGIN "
+        "INSERT INTO magazines_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_delete AFTER DELETE ON magazines BEGIN "
+        "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); END",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_update AFTER UPDATE ON magazines BEGIN "
+        "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO magazines_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    ],
+}
+for _dialect, _statements in _magazine_search_ddl.items():
+    for _statement in _statements:
+        event.listen(Magazine.__table__, 'after_create', DDL(_statement).execute_if(dialect=_dialect))
+event.listen(Magazine.__table__, 'after_drop', DDL("DROP TABLE IF EXISTS magazines_fts").execute_if(dialect='sqlite'))
 
 class Plan(Base):
     __tablename__ = 'plans'
@@ -50,6 +84,88 @@ class Plan(Base):
 # half_yearly_plan = Plan(title='Half-yearly', description='Renewal period of 6 months', renewal_period=6)
 # annual_plan = Plan(title='Annual', description='Renewal period of 12 months', renewal_period=12)
 
+class CacheVersion(Base):
+    __tablename__ = 'cache_versions'
+    # Bumped by a trigger on every write to a table that workers cache in
+    # memory, so each worker can tell its copy is stale (see db/cache_versions.py).
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# Reloaded in full whenever they change.
+CACHED_TABLES = (Plan.__table__,)
+
+event.listen(CacheVersion.__table__, 'after_create', DDL(
+    "INSERT INTO cache_versions (name, version) VALUES "
+    + ", ".join(f"('{name}', 0)" for name in [table.name for table in CACHED_TABLES] + ['magazines'])
+))
+_bump_cache_version = "UPDATE cache_versions SET version = version + 1 WHERE name = '{table}'"
+for _table in CACHED_TABLES:
+    event.listen(_table, 'after_create', DDL(
+        "CREATE OR REPLACE FUNCTION bump_cache_version() RETURNS trigger LANGUAGE plpgsql AS $$ "
+        "BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = TG_TABLE_NAME; RETURN NULL; END $$"
+    ).execute_if(dialect='postgresql'))
+    event.listen(_table, 'after_create', DDL(
+        f"CREATE TRIGGER {_table.name}_cache_version AFTER INSERT OR UPDATE OR DELETE ON {_table.name} "
+        "FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version()"
+    ).execute_if(dialect='postgresql'))
+    for _op in ('INSERT', 'UPDATE', 'DELETE'):
+        event.listen(_table, 'after_create', DDL(
+            f"CREATE TRIGGER IF NOT EXISTS {_table.name}_cache_version_{_op.lower()} AFTER {_op} ON {_table.name} "
+            f"BEGIN {_bump_cache_version.format(table=_table.name)}; END"
+        ).execute_if(dialect='sqlite'))
+
+
+class MagazineIndexChange(Base):
+    __tablename__ = 'magazine_index_changes'
+    # Name changes for the typeahead index (search.py), written by the triggers
+    # below; name is NULL for a deleted magazine. version is the magazines row
+    # of cache_versions after the change's bump, so it has no gaps.
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    magazine_id = Column(Integer, nullable=False)
+    name = Column(String(100), nullable=True)
+
+
+# Older changes are deleted; an index further behind than this reloads.
+MAGAZINE_INDEX_CHANGES_KEPT = 1000
+
+# Only inserts, deletes and renames: other columns are not in the index. The
+# bump comes first: its row lock orders concurrent writers, so versions
+# commit in order.
+_record_magazine_index_change = (
+    "UPDATE cache_versions SET version = version + 1 WHERE name = 'magazines'; "
+    "INSERT INTO magazine_index_changes (version, magazine_id, name) "
+    "SELECT version, {id}, {name} FROM cache_versions WHERE name = 'magazines'; "
+    "DELETE FROM magazine_index_changes WHERE version <= "
+    f"(SELECT version FROM cache_versions WHERE name = 'magazines') - {MAGAZINE_INDEX_CHANGES_KEPT};"
+)
+event.listen(Magazine.__table__, 'after_create', DDL(
+    "CREATE OR REPLACE FUNCTION record_magazine_index_change() RETURNS trigger LANGUAGE plpgsql AS $$ "
+    "BEGIN IF TG_OP = 'DELETE' THEN "
+    + _record_magazine_index_change.format(id="OLD.id", name="NULL")
+    + " ELSE "
+    + _record_magazine_index_change.format(id="NEW.id", name="NEW.name")
+    + " END IF; RETURN NULL; END $$"
+).execute_if(dialect='postgresql'))
+for _ddl in (
+    "CREATE TRIGGER magazines_index_change AFTER INSERT OR DELETE ON magazines "
+    "FOR EACH ROW EXECUTE FUNCTION record_magazine_index_change()",
+    "CREATE TRIGGER magazines_index_rename AFTER UPDATE OF name ON magazines "
+    "FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name) EXECUTE FUNCTION record_magazine_index_change()",
+):
+    event.listen(Magazine.__table__, 'after_create', DDL(_ddl).execute_if(dialect='postgresql'))
+for _trigger, _event, _values in (
+    ("insert", "AFTER INSERT", dict(id="NEW.id", name="NEW.name")),
+    ("rename", "AFTER UPDATE OF name", dict(id="NEW.id", name="NEW.name")),
+    ("delete", "AFTER DELETE", dict(id="OLD.id", name="NULL")),
+):
+    _when = " WHEN OLD.name IS NOT NEW.name" if _trigger == "rename" else ""
+    event.listen(Magazine.__table__, 'after_create', DDL(
+        f"CREATE TRIGGER IF NOT EXISTS magazines_index_{_trigger} {_event} ON magazines{_when} "
+        f"BEGIN {_record_magazine_index_change.format(**_values)} END"
+    ).execute_if(dialect='sqlite'))
+
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
 
@@ -61,7 +177,81 @@ class Subscription(Base):
     price_at_renewal = Column(Integer, nullable=False, default=0)
     next_renewal_date = Column(Date, nullable=False, default='2021-01-01')
     is_active = Column(Boolean, nullable=False, default=True)
+    version = Column(Integer, nullable=False, default=1)
 
     user = relationship("User", backref="subscriptions")
     magazine = relationship("Magazine", backref="subscriptions")
-    plan = relationship("Plan", backref="subscriptions")
\ No newline at end of file
+    plan = relationship("Plan", backref="subscriptions")
+
+    __table_args__ = (
+        # Serves "my active subscriptions", ordered by id for pagination.
+        Index('ix_subscriptions_user_id_is_active_id', 'user_id', 'is_active', 'id'),
+    )
+
+
+class SubscriptionRollup(Base):
+    __tablename__ = 'subscription_rollups'
+
+    # Maintained by db/rollups.py in the same transaction as every
+    # subscription write, and reconciled periodically against subscriptions.
+    magazine_id = Column(Integer, primary_key=True)
+    plan_id = Column(Integer, primary_key=True)
+    active_subscribers = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0.0)
+    monthly_revenue = Column(Float, nullable=False, default=0.0)
+
+
+class SubscriptionChange(Base):
+    __tablename__ = 'subscription_changes'
+    # One row per subscription mutation, written in the same transaction; seq
+    # is the cursor of GET /subscriptions/changes. It is assigned after the
+    # write commits, by sequence_changes() (see db/changes.py).
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, nullable=True, unique=True)
+    subscription_id = Column(Integer, ForeignKey('subscriptions.id'), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    op = Column(String(20), nullable=False)
+    changed_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        Index('ix_subscription_changes_unsequenced', 'id',
+              postgresql_where=seq.is_(None), sqlite_where=seq.is_(None)),
+    )
+
+
+class PasswordResetDelivery(Base):
+    __tablename__ = 'password_reset_deliveries'
+
+    id = Column(Integer, primary_key=True)
+    email = Column(String(100), nullable=False)
+    # Not a foreign key: with sharding the user may live on another shard.
+    user_id = Column(Integer, nullable=True)
+    status = Column(String(20), nullable=False, default='pending')
+    requested_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String(200), nullable=True)
+
+    __table_args__ = (
+        Index('ix_password_reset_deliveries_status_id', 'status', 'id'),
+        Index('ix_password_reset_deliveries_email_sent_at', 'email', 'sent_at'),
+        Index('ix_password_reset_deliveries_requested_at', 'requested_at'),
+    )
+
+
+class IdAllocation(Base):
+    __tablename__ = 'id_allocations'
+    # Next free id per sequence when users and subscriptions are sharded; only
+    # the first shard's copy is used (see db/sharding.py).
+    name = Column(String(50), primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+
+class UserDirectory(Base):
+    __tablename__ = 'user_directory'
+    # Which user holds each username and email when users are sharded, so
+    # both stay unique across shards; only the first shard's copy is used
+    # (see db/sharding.py).
+    user_id = Column(Integer, primary_key=True)
+    username = Column(String(50), unique=True, nullable=False)
+    email = Column(String(100), unique=True, nullable=False)
@@ -0,0 +1,117 @@
+import calendar
+import threading
+from datetime import date
+from types import MappingProxyType
+from typing import List, Optional
+
+from models import Plan
+
+
+class PlanEntry:
+    """Immutable snapshot of a row from the plans table."""
+
+    __slots__ = ("id", "title", "description", "renewal_period")
+
+    def __init__(self, id: int, title: str, description: str, renewal_period: int):
+        if renewal_period == 0:
+            raise ValueError(f"Plan {title!r} has a renewal period of zero")
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "title", title)
+        object.__setattr__(self, "description", description)
+        object.__setattr__(self, "renewal_period", renewal_period)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("PlanEntry is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("PlanEntry is immutable")
+
+    def __repr__(self):
+        return f"PlanEntry(id={self.id}, title={self.title!r}, renewal_period={self.renewal_period})"
+
+
+def add_months(start: date, months: int) -> date:
+    month_index = start.month - 1 + months
+    year = start.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start.day, calendar.monthrange(year, month)[1])
+    return start.replace(year=year, month=month, day=day)
+
+
+class PlanRegistry:
+    """In-memory copy of the plans table.
+
+    The whole mapping is swapped on every change, so readers never see a
+    partially loaded registry and never need a lock or a database session.
+    """
+
+    __slots__ = ("_plans", "_write_lock", "loaded")
+
+    def __init__(self):
+        self._plans = MappingProxyType({})
+        self._write_lock = threading.Lock()
+        self.loaded = False
+
+    def load(self, db):
+        # Runs at startup, from the CLI and from the cache refresher (see
+        # db/cache_versions.py), never per request. The lock keeps the swap
+        # from interleaving with a put() or discard().
+        plans = self._query(db)
+        with self._write_lock:
+            self._plans = plans
+            self.loaded = True
+
+    @staticmethod
+    def _query(db):
+        rows = db.query(Plan.id, Plan.title, Plan.description, Plan.renewal_period).order_by(Plan.id).all()
+        return MappingProxyType({row.id: PlanEntry(*row) for row in rows})
+
+    def get_or_load(self, db, plan_id: int) -> Optional[PlanEntry]:
+        """The plan, read from the database if it is not in the registry.
+
+        For writes that must not miss a plan another worker created since
+        the last refresh (see db/cache_versions.py).
+        """
+        plan = self.get(plan_id)
+        if plan is None:
+            row = db.query(Plan.id, Plan.title, Plan.description, Plan.renewal_period).filter(Plan.id == plan_id).first()
+            if row is not None:
+                plan = PlanEntry(*row)
+                self.put(plan)
+        return plan
+
+    def put(self, plan: PlanEntry):
+        with self._write_lock:
+            plans = dict(self._plans)
+            plans[plan.id] = plan
+            self._plans = MappingProxyType(plans)
+
+    def discard(self, plan_id: int):
+        with self._write_lock:
+            plans = dict(self._plans)
+            plans.pop(plan_id, None)
+            self._plans = MappingProxyType(plans)
+
+    def clear(self):
+        with self._write_lock:
+            self._plans = MappingProxyType({})
+            self.loaded = False
+
+    def get(self, plan_id: int) -> Optional[PlanEntry]:
+        return self._plans.get(plan_id)
+
+    def all(self) -> List[PlanEntry]:
+        return list(self._plans.values())
+
+    def next_renewal_date(self, plan_id: int, start: date) -> date:
+        plan = self._plans[plan_id]
+        return add_months(start, plan.renewal_period)
+
+    def __contains__(self, plan_id):
+        return plan_id in self._plans
+
+    def __len__(self):
+        return len(self._plans)
+
+
+plan_registry = PlanRegistry()
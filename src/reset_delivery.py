@@ -0,0 +1,239 @@
+"""Password reset email delivery.
+
+`POST /users/reset-password` only inserts a row into password_reset_deliveries.
+Workers drain that queue in batches, resolve the users with one query per
+batch, skip repeat requests within the dedupe window and send the remaining
+messages over pooled SMTP connections. With sharding on, the queue lives on
+the first shard and users are resolved through its user directory. Handled
+rows are deleted once they are RESET_DELIVERY_RETENTION_DAYS old.
+
+Try it locally against an SMTP debugging server:
+
+    python -m aiosmtpd -n -l localhost:1025
+    SMTP_HOST=localhost SMTP_PORT=1025 uvicorn main:app
+"""
+import asyncio
+import os
+import queue
+import smtplib
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from sqlalchemy import delete, insert, select
+
+from auth import create_refresh_token
+from models import PasswordResetDelivery
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "0") == "1"
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+MAIL_FROM = os.getenv("MAIL_FROM", "no-reply@magazines.local")
+
+RESET_DELIVERY_WORKERS = int(os.getenv("RESET_DELIVERY_WORKERS", "1"))
+RESET_DELIVERY_BATCH_SIZE = int(os.getenv("RESET_DELIVERY_BATCH_SIZE", "50"))
+RESET_DEDUPE_WINDOW = timedelta(minutes=int(os.getenv("RESET_DEDUPE_MINUTES", "15")))
+RESET_MAX_ATTEMPTS = 5
+# Must be longer than the dedupe window, which looks at the sent rows.
+RESET_DELIVERY_RETENTION_DAYS = float(os.getenv("RESET_DELIVERY_RETENTION_DAYS", "7"))
+PRUNE_INTERVAL_SECONDS = 3600.0
+POLL_INTERVAL_SECONDS = 1.0
+
+
+def enqueue_reset(db, email: str):
+    # A single INSERT, whether or not the email belongs to a user, so the
+    # endpoint takes the same time either way.
+    db.execute(insert(PasswordResetDelivery).values(
+        email=email, status="pending", requested_at=datetime.utcnow(), attempts=0,
+    ))
+    db.commit()
+
+
+def prune_deliveries(db, retention_days: float = RESET_DELIVERY_RETENTION_DAYS):
+    """Delete handled queue rows older than the retention window; returns how many."""
+    result = db.execute(delete(PasswordResetDelivery).where(
+        PasswordResetDelivery.status != "pending",
+        PasswordResetDelivery.requested_at < datetime.utcnow() - timedelta(days=retention_days),
+    ))
+    db.commit()
+    return result.rowcount
+
+
+def smtp_connect():
+    connection = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10)
+    if SMTP_STARTTLS:
+        connection.starttls()
+    if SMTP_USERNAME:
+        connection.login(SMTP_USERNAME, SMTP_PASSWORD)
+    return connection
+
+
+class SMTPConnectionPool:
+    def __init__(self, connect=smtp_connect, size: int = SMTP_POOL_SIZE):
+        self._connect = connect
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._slots.put(None)
+
+    @contextmanager
+    def connection(self):
+        self._slots.get()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except (OSError, smtplib.SMTPException):
+                # Only keep connections that are known to be healthy.
+                self._discard(connection)
+                raise
+            self._idle.put_nowait(connection)
+        finally:
+            self._slots.put(None)
+
+    def _discard(self, connection):
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def build_message(email: str, username: str):
+    token = create_refresh_token({"sub": username})
+    message = EmailMessage()
+    message["From"] = MAIL_FROM
+    message["To"] = email
+    message["Subject"] = "Reset your password"
+    message.set_content(f"Hi {username},\n\nUse this token to reset your password:\n\n{token}\n")
+    return message
+
+
+class ResetDeliveryWorker:
+    def __init__(self, shards_scope, pool: SMTPConnectionPool, batch_size: int = RESET_DELIVERY_BATCH_SIZE,
+                 dedupe_window: timedelta = RESET_DEDUPE_WINDOW):
+        # shards_scope() yields a Shards object (see db/sharding.py).
+        self.shards_scope = shards_scope
+        self.pool = pool
+        self.batch_size = batch_size
+        self.dedupe_window = dedupe_window
+
+    def drain_once(self):
+        """Process one batch; returns the number of queue rows handled."""
+        with self.shards_scope() as shards:
+            db = shards.catalog
+            batch = db.scalars(
+                select(PasswordResetDelivery)
+                .where(PasswordResetDelivery.status == "pending")
+                .order_by(PasswordResetDelivery.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not batch:
+                return 0
+
+            now = datetime.utcnow()
+            emails = {delivery.email for delivery in batch}
+            directory_db, directory = shards.directory()
+            users = {row.email: row for row in directory_db.execute(
+                select(directory.c.user_id, directory.c.email, directory.c.username).where(directory.c.email.in_(emails))
+            )}
+            recently_sent = set(db.scalars(
+                select(PasswordResetDelivery.email).where(
+                    PasswordResetDelivery.email.in_(emails),
+                    PasswordResetDelivery.status == "sent",
+                    PasswordResetDelivery.sent_at >= now - self.dedupe_window,
+                )
+            ))
+
+            to_send = []
+            for delivery in batch:
+                user = users.get(delivery.email)
+                if user is None:
+                    delivery.status, delivery.error = "skipped", "Unknown email"
+                elif delivery.email in recently_sent:
+                    delivery.status, delivery.error = "skipped", "Duplicate within dedupe window"
+                else:
+                    delivery.user_id = user.user_id
+                    recently_sent.add(delivery.email)
+                    to_send.append((delivery, build_message(user.email, user.username)))
+
+            self._send(to_send)
+            db.commit()
+            return len(batch)
+
+    def _send(self, to_send):
+        if not to_send:
+            return
+        # Counted up front, so that a failure to connect or anything else that
+        # stops the batch uses up an attempt of every delivery in it.
+        for delivery, _ in to_send:
+            delivery.attempts += 1
+        try:
+            with self.pool.connection() as connection:
+                for delivery, message in to_send:
+                    connection.send_message(message)
+                    delivery.status, delivery.sent_at = "sent", datetime.utcnow()
+        except Exception as e:
+            # The delivery that raised and everything after it stay pending
+            # unless they have run out of attempts.
+            for delivery, _ in to_send:
+                if delivery.status == "pending":
+                    delivery.error = str(e)[:200]
+                    if delivery.attempts >= RESET_MAX_ATTEMPTS:
+                        delivery.status = "failed"
+
+    def prune(self):
+        with self.shards_scope() as shards:
+            return prune_deliveries(shards.catalog)
+
+    async def run(self, stop: asyncio.Event, poll_interval: float = POLL_INTERVAL_SECONDS,
+                  prune_interval: float = PRUNE_INTERVAL_SECONDS):
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time() + prune_interval
+        while not stop.is_set():
+            if loop.time() >= next_prune:
+                next_prune = loop.time() + prune_interval
+                try:
+                    await asyncio.to_thread(self.prune)
+                except Exception as e:
+                    print(f"Pruning password reset deliveries failed: {e}")
+            try:
+                handled = await asyncio.to_thread(self.drain_once)
+            except Exception as e:
+                print(f"Password reset delivery failed: {e}")
+                handled = 0
+            if handled < self.batch_size:
+                try:
+                    await asyncio.wait_for(stop.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+
+@asynccontextmanager
+async def delivery_workers(shards_scope, workers: int = RESET_DELIVERY_WORKERS):
+    """Runs the delivery workers for the lifetime of the app if SMTP_HOST is set."""
+    if not SMTP_HOST or workers <= 0:
+        yield []
+        return
+    pool = SMTPConnectionPool()
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(ResetDeliveryWorker(shards_scope, pool).run(stop)) for _ in range(workers)]
+    try:
+        yield tasks
+    finally:
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pool.close()
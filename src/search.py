@@ -0,0 +1,217 @@
+import bisect
+import re
+import threading
+
+from sqlalchemy import func, literal_column, select, text
+
+from models import MAGAZINE_SEARCH_DOCUMENT, CacheVersion, Magazine, MagazineIndexChange
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(value: str):
+    return " ".join(_WORD.findall(value.casefold()))
+
+
+class _Node:
+    __slots__ = ("children", "entries")
+
+    def __init__(self, entries=None):
+        self.children = {}
+        # Sorted (key, id) pairs. A node without children is a bucket holding
+        # every key below it; otherwise only keys that end at this node.
+        self.entries = entries or []
+
+
+class PrefixTrie:
+    """Maps normalized keys to ids; looks them up by prefix.
+
+    A burst trie: keys sit in small sorted buckets that split into child
+    nodes once they hold more than bucket_size entries. That keeps the node
+    count (and memory) far below one node per character while lookups stay a
+    walk down the prefix plus a bisect.
+    """
+
+    def __init__(self, bucket_size: int = 64, max_depth: int = 32):
+        self.bucket_size = bucket_size
+        self.max_depth = max_depth
+        self._root = _Node()
+
+    def _walk(self, key: str):
+        node, depth = self._root, 0
+        while node.children and depth < len(key):
+            child = node.children.get(key[depth])
+            if child is None:
+                return node, depth, False
+            node, depth = child, depth + 1
+        return node, depth, True
+
+    def insert(self, key: str, item_id: int):
+        node, depth, found = self._walk(key)
+        if not found:
+            child = _Node()
+            node.children[key[depth]] = child
+            node, depth = child, depth + 1
+        bisect.insort(node.entries, (key, item_id))
+        if not node.children and len(node.entries) > self.bucket_size and depth < self.max_depth:
+            self._burst(node, depth)
+
+    def _burst(self, node: _Node, depth: int):
+        entries, node.entries = node.entries, []
+        for key, item_id in entries:
+            if len(key) == depth:
+                node.entries.append((key, item_id))
+            else:
+                node.children.setdefault(key[depth], _Node()).entries.append((key, item_id))
+
+    def remove(self, key: str, item_id: int):
+        node, _, found = self._walk(key)
+        if not found:
+            return
+        index = bisect.bisect_left(node.entries, (key, item_id))
+        if index < len(node.entries) and node.entries[index] == (key, item_id):
+            del node.entries[index]
+
+    def search(self, prefix: str, limit: int):
+        node, depth, found = self._walk(prefix)
+        if not found:
+            return []
+        ids = {}
+        if depth < len(prefix):
+            # Stopped in a bucket: its matches are a contiguous sorted run.
+            index = bisect.bisect_left(node.entries, (prefix,))
+            for key, item_id in node.entries[index:]:
+                if not key.startswith(prefix) or len(ids) >= limit:
+                    break
+                ids.setdefault(item_id, None)
+            return list(ids)
+        # Every key below this node matches; visit them in key order.
+        stack = [node]
+        while stack and len(ids) < limit:
+            node = stack.pop()
+            for _, item_id in node.entries:
+                ids.setdefault(item_id, None)
+                if len(ids) >= limit:
+                    break
+            stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return list(ids)
+
+
+class MagazineSearchIndex:
+    """Typeahead over magazine names, kept current by the magazine endpoints.
+
+    Every word of a name starts a key, so "week" completes "Tech Weekly".
+    Writes made by other workers are applied by update(), from the name
+    changes the magazines triggers record (see models.py).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trie = PrefixTrie()
+        self._names = {}
+        # The last recorded name change this index has seen.
+        self.version = 0
+        self.loaded = False
+
+    def load(self, db):
+        # Read before the names: a change that lands in between is applied
+        # again by the next update(), which is harmless.
+        version = db.scalar(select(CacheVersion.version).where(CacheVersion.name == "magazines")) or 0
+        trie = PrefixTrie()
+        names = dict(db.execute(select(Magazine.id, Magazine.name)).all())
+        for magazine_id, name in names.items():
+            for key in self._keys(name):
+                trie.insert(key, magazine_id)
+        with self._lock:
+            self._trie, self._names, self.version, self.loaded = trie, names, version, True
+
+    def update(self, db):
+        """Apply the name changes recorded since the last load or update."""
+        changes = db.execute(
+            select(MagazineIndexChange.version, MagazineIndexChange.magazine_id, MagazineIndexChange.name)
+            .where(MagazineIndexChange.version > self.version)
+            .order_by(MagazineIndexChange.version)
+        ).all()
+        if changes and changes[0].version != self.version + 1:
+            # Some were pruned already (MAGAZINE_INDEX_CHANGES_KEPT).
+            self.load(db)
+            return
+        for change in changes:
+            if change.name is None:
+                self.discard(change.magazine_id)
+            else:
+                self.put(change.magazine_id, change.name)
+        if changes:
+            self.version = changes[-1].version
+
+    def clear(self):
+        with self._lock:
+            self._trie, self._names, self.version, self.loaded = PrefixTrie(), {}, 0, False
+
+    def put(self, magazine_id: int, name: str):
+        with self._lock:
+            self._remove(magazine_id)
+            self._names[magazine_id] = name
+            for key in self._keys(name):
+                self._trie.insert(key, magazine_id)
+
+    def discard(self, magazine_id: int):
+        with self._lock:
+            self._remove(magazine_id)
+
+    def complete(self, prefix: str, limit: int = 10):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            ids = self._trie.search(prefix, limit)
+            return [{"id": magazine_id, "name": self._names[magazine_id]} for magazine_id in ids]
+
+    def _remove(self, magazine_id: int):
+        name = self._names.pop(magazine_id, None)
+        if name is not None:
+            for key in self._keys(name):
+                self._trie.remove(key, magazine_id)
+
+    @staticmethod
+    def _keys(name: str):
+        words = normalize(name).split(" ")
+        return {" ".join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+magazine_index = MagazineSearchIndex()
+
+
+def _fts5_query(q: str):
+    # Quote each word so user input cannot inject FTS5 syntax; the trailing *
+    # lets the last word match as a prefix.
+    words = _WORD.findall(q)
+    return " ".join(f'"{word}"' for word in words[:-1]) + (f' "{words[-1]}"*' if words else "")
+
+
+def search_magazines(db, q: str, limit: int = 20):
+    """Ranked full-text search over magazine names and descriptions."""
+    if not _WORD.search(q):
+        return []
+    if db.get_bind().dialect.name == "postgresql":
+        # Spelled exactly like the ix_magazines_search expression so the
+        # planner can use the index.
+        document = literal_column(MAGAZINE_SEARCH_DOCUMENT)
+        query = func.plainto_tsquery(literal_column("'english'"), q)
+        rank = func.greatest(func.ts_rank(document, query), func.similarity(Magazine.name, q))
+        stmt = (
+            select(Magazine)
+            .where(document.bool_op("@@")(query) | Magazine.name.bool_op("%")(q))
+            .order_by(rank.desc(), Magazine.id)
+            .limit(limit)
+        )
+        return db.scalars(stmt).all()
+
+    stmt = (
+        select(Magazine)
+        .from_statement(text(
+            "SELECT magazines.* FROM magazines_fts JOIN magazines ON magazines.id = magazines_fts.rowid "
+            "WHERE magazines_fts MATCH :q ORDER BY bm25(magazines_fts), magazines.id LIMIT :limit"
+        ))
+    )
+    return db.scalars(stmt, {"q": _fts5_query(q), "limit": limit}).all()
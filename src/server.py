@@ -0,0 +1,154 @@
+"""Production server entrypoint.
+
+Usage (from src/):
+
+    python -m server --bind 0.0.0.0:8000
+
+Runs gunicorn with uvicorn workers. The app is imported and its caches are
+warmed once in the master before it forks, so workers share those pages
+copy-on-write. Each worker gets a SQLAlchemy pool sized from
+DB_CONNECTION_BUDGET, the number of Postgres connections the whole server
+may hold to each database; with SHARD_URLS set, every shard's pool is sized
+the same way.
+
+Reloading:
+    kill -HUP <master pid>    restart workers gracefully with new settings.
+                              Old workers finish in-flight requests, up to
+                              --graceful-timeout.
+    kill -USR2 <master pid>   start a new master on new code. Then send
+                              WINCH and QUIT to the old master. Use this when
+                              the code changes, because a preloaded app is
+                              not re-imported on HUP.
+    --reload                  single-process uvicorn with autoreload, for
+                              development only.
+"""
+import argparse
+import gc
+import importlib.util
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+try:
+    from uvicorn_worker import UvicornWorker
+except ImportError:
+    from uvicorn.workers import UvicornWorker
+
+APP = "main:app"
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "90"))
+# Share of each worker's connections held in the pool; the rest is overflow.
+POOL_SHARE = 0.75
+
+
+def default_workers():
+    # Uvicorn workers are async, so one per core keeps them busy without
+    # oversubscribing the CPUs.
+    return int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+
+def pool_settings(workers: int, budget: int = DB_CONNECTION_BUDGET):
+    per_worker = max(budget // workers, 1)
+    pool_size = max(int(per_worker * POOL_SHARE), 1)
+    return pool_size, max(per_worker - pool_size, 0)
+
+
+def resolve_loop(loop: str):
+    if loop == "auto":
+        return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    return loop
+
+
+def resolve_http(http: str):
+    if http == "auto":
+        return "httptools" if importlib.util.find_spec("httptools") else "h11"
+    return http
+
+
+def worker_class(loop: str, http: str):
+    config = {**UvicornWorker.CONFIG_KWARGS, "loop": resolve_loop(loop), "http": resolve_http(http)}
+    return type("TunedUvicornWorker", (UvicornWorker,), {"CONFIG_KWARGS": config})
+
+
+def post_fork(server, worker):
+    from db.database import engine
+    from db.sharding import shard_router
+
+    # Connections inherited from the master must not be used by the child.
+    engine.dispose(close=False)
+    if shard_router is not None:
+        shard_router.dispose_pools(close=False)
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict, preload: bool = True):
+        self.options = options
+        self.preload = preload
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import main
+
+        if self.preload:
+            main.warm_caches()
+            main.engine.dispose()
+            if main.shard_router is not None:
+                main.shard_router.dispose_pools()
+            # Keep the loaded objects out of the collector so it does not
+            # touch (and copy) their pages in every worker.
+            gc.freeze()
+        return main.app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the magazine API")
+    parser.add_argument("--bind", default=os.getenv("BIND", "0.0.0.0:8000"))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--loop", choices=["auto", "uvloop", "asyncio"], default="auto")
+    parser.add_argument("--http", choices=["auto", "httptools", "h11"], default="auto")
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    parser.add_argument("--timeout", type=int, default=60)
+    parser.add_argument("--keepalive", type=int, default=5)
+    parser.add_argument("--max-requests", type=int, default=0)
+    parser.add_argument("--reload", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    pool_size, max_overflow = pool_settings(args.workers)
+    # database.py reads these when the app is imported.
+    os.environ.setdefault("DB_POOL_SIZE", str(pool_size))
+    os.environ.setdefault("DB_MAX_OVERFLOW", str(max_overflow))
+
+    if args.reload:
+        import uvicorn
+
+        host, _, port = args.bind.rpartition(":")
+        uvicorn.run(APP, host=host or "0.0.0.0", port=int(port), reload=True,
+                    loop=resolve_loop(args.loop), http=resolve_http(args.http))
+        return
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": worker_class(args.loop, args.http),
+        "preload_app": args.preload,
+        "graceful_timeout": args.graceful_timeout,
+        "timeout": args.timeout,
+        "keepalive": args.keepalive,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "post_fork": post_fork,
+    }
+    Server(options, preload=args.preload).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Request coalescing for hot reads.
+
+Concurrent calls with the same key share one execution of the underlying
+lookup: the first caller (the leader) runs it and everyone who arrives while
+it is in flight waits for and receives the same result or exception, unless
+the caller says the exception belongs to the leader alone (`retry`). Nothing
+is cached once the call completes.
+
+Results are handed to several callers, possibly on different threads and
+sessions, so lookups must return plain data (dicts, tuples), never ORM
+instances bound to the leader's session.
+"""
+import asyncio
+import os
+import threading
+import time
+
+SINGLEFLIGHT_TIMEOUT_SECONDS = float(os.getenv("SINGLEFLIGHT_TIMEOUT_SECONDS", "5"))
+
+# Every group by name, for the metrics endpoint.
+groups = {}
+
+
+class _Stats:
+    __slots__ = ("calls", "executions", "coalesced", "errors", "timeouts")
+
+    def __init__(self):
+        self.calls = self.executions = self.coalesced = self.errors = self.timeouts = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls across threads (sync endpoints, workers)."""
+
+    def __init__(self, name: str, timeout: float = SINGLEFLIGHT_TIMEOUT_SECONDS):
+        self.name = name
+        self.timeout = timeout
+        self.stats = _Stats()
+        self._lock = threading.Lock()
+        self._calls = {}
+        groups[name] = self
+
+    def do(self, key, fn, timeout: float = None, retry=None):
+        """Run fn() once for all concurrent callers with this key.
+
+        Callers that join an in-flight call wait at most `timeout` seconds
+        in all and then raise TimeoutError; the leader always runs fn to
+        completion. A caller that joined a call failing with an error for
+        which retry(error) is true does not raise it but calls again.
+        """
+        expires = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            with self._lock:
+                self.stats.calls += 1
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self.stats.executions += 1
+                else:
+                    self.stats.coalesced += 1
+
+            if leader:
+                try:
+                    call.result = fn()
+                except Exception as e:
+                    call.error = e
+                finally:
+                    with self._lock:
+                        self.stats.errors += call.error is not None
+                        if self._calls.get(key) is call:
+                            del self._calls[key]
+                    call.done.set()
+            elif not call.done.wait(max(expires - time.monotonic(), 0)):
+                with self._lock:
+                    self.stats.timeouts += 1
+                raise TimeoutError(f"{self.name}: timed out waiting for in-flight call {key!r}")
+            elif call.error is not None and retry is not None and retry(call.error):
+                continue
+
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def forget(self, key):
+        """Make later callers start a new call instead of joining the current one.
+
+        Writers call this after committing so that readers arriving after the
+        write cannot be handed a result read before it.
+        """
+        with self._lock:
+            self._calls.pop(key, None)
+
+
+class AsyncSingleFlight:
+    """Coalesces concurrent coroutines on one event loop."""
+
+    def __init__(self, name: str, timeout: float = SINGLEFLIGHT_TIMEOUT_SECONDS):
+        self.name = name
+        self.timeout = timeout
+        self.stats = _Stats()
+        self._calls = {}
+        groups[name] = self
+
+    async def do(self, key, fn, timeout: float = None):
+        """Await fn() once for all concurrent callers with this key.
+
+        The shared call runs as its own task, so a caller that times out or is
+        cancelled does not cancel it for the others.
+        """
+        self.stats.calls += 1
+        task = self._calls.get(key)
+        if task is None:
+            self.stats.executions += 1
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.stats.coalesced += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise TimeoutError(f"{self.name}: timed out waiting for in-flight call {key!r}") from None
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats.errors += 1
+
+    def forget(self, key):
+        self._calls.pop(key, None)
+
+
+def stats():
+    return {name: group.stats.as_dict() for name, group in sorted(groups.items())}
@@ -5,10 +5,19 @@ from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+# Tests number the change log (sequence_changes) and refresh the caches
+# themselves; a background poll would land in whichever request's query
+# count is being recorded.
+os.environ.setdefault("CHANGE_FEED_POLL_SECONDS", "3600")
+os.environ.setdefault("CACHE_REFRESH_SECONDS", "3600")
+
 from main import app
 from models import Base
 from db.database import get_db
+from plans import plan_registry
+from search import magazine_index
 
+from .query_counter import BudgetedTestClient, recorder
 from .utils import create_user, login_user
 
 # Define a SQLite URL for testing
@@ -35,6 +44,8 @@ Base.metadata.create_all(bind=engine)
 def refresh_db():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    plan_registry.clear()
+    magazine_index.clear()
 
 @pytest.fixture(scope="function", autouse=True)
 def setup_and_teardown():
@@ -43,12 +54,18 @@ def setup_and_teardown():
     yield
     # Optionally, you can add teardown code here if needed
 
-# Fixture for the test client
+# Fixture for the test client; every request is checked against the query
+# budget declared on its route in main.py.
 @pytest.fixture(scope="module")
 def client():
-    with TestClient(app) as c:
+    with BudgetedTestClient(app) as c:
         yield c
 
+@pytest.fixture(scope="function")
+def query_counter():
+    with recorder.recording():
+        yield recorder
+
 @pytest.fixture(scope="function")
 def unique_email():
     return f"user{random.randint(1000, 9999)}@example.com"
@@ -0,0 +1,102 @@
+import functools
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.routing import Match
+
+from db.query_budget import get_query_budget
+
+
+class QueryRecorder:
+    """Records the SQL statements issued on any engine while active."""
+
+    def __init__(self):
+        self.statements = []
+        self._depth = 0
+        event.listen(Engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._depth:
+            self.statements.append(statement)
+
+    @contextmanager
+    def recording(self):
+        start = len(self.statements)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                # Keep only what the outermost caller may still inspect.
+                del self.statements[:start]
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def report(self, statements=None):
+        statements = self.statements if statements is None else statements
+        return "\n".join(f"  {i}. {' '.join(statement.split())}" for i, statement in enumerate(statements, start=1))
+
+
+recorder = QueryRecorder()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def check_budget(label, budget, statements):
+    if budget is not None and len(statements) > budget:
+        raise QueryBudgetExceeded(
+            f"{label} issued {len(statements)} SQL statements, budget is {budget}:\n{recorder.report(statements)}"
+        )
+
+
+@contextmanager
+def assert_max_queries(budget, label="block"):
+    start = len(recorder.statements)
+    with recorder.recording():
+        yield recorder
+        check_budget(label, budget, recorder.statements[start:])
+
+
+def max_queries(budget):
+    """Decorator form of assert_max_queries for whole test functions."""
+    def decorator(test):
+        @functools.wraps(test)
+        def wrapper(*args, **kwargs):
+            with assert_max_queries(budget, label=test.__name__):
+                return test(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def find_route(app, method, path):
+    scope = {"type": "http", "method": method.upper(), "path": path}
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+class BudgetedTestClient(TestClient):
+    """TestClient that enforces each route's declared query budget."""
+
+    def request(self, method, url, *args, **kwargs):
+        start = len(recorder.statements)
+        with recorder.recording():
+            response = super().request(method, url, *args, **kwargs)
+            statements = recorder.statements[start:]
+            route = find_route(self.app, method, response.request.url.path)
+            if route is not None:
+                budget = get_query_budget(route.endpoint)
+                label = f"{method.upper()} {route.path}"
+                if budget is ...:
+                    raise QueryBudgetExceeded(f"{label} has no declared query budget")
+                check_budget(label, budget, statements)
+        return response
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from analytics import export, queries
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine
+
+def test_snapshots_export_incrementally_and_answer_reports(client, unique_username, unique_email, tmp_path):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "analytics")
+
+    def subscribe():
+        response = client.post("/subscriptions/", json={
+            "user_id": 1,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        }, headers=headers)
+        return response.json()["id"]
+
+    ids = [subscribe() for _ in range(3)]
+    directory = str(tmp_path)
+    first = export.export([TestingSessionLocal], directory, batch_size=2)
+    assert [row["active_subscriptions"] for row in queries.plan_mix(directory)] == [3]
+
+    client.delete(f"/subscriptions/{ids[0]}", headers=headers)
+    subscribe()
+    second = export.export([TestingSessionLocal], directory, batch_size=2)
+    assert second["shards"]["0"]["seq"] > first["shards"]["0"]["seq"]
+    # The second run only appended what changed.
+    assert len(second["shards"]["0"]["parts"]["subscriptions"]) == 2
+    assert len(queries.load(directory, "subscriptions")) == 5
+    assert len(queries.current_subscriptions(directory)) == 4
+
+    mix = queries.plan_mix(directory)
+    assert mix == [{"plan_id": plan["id"], "title": plan["title"], "active_subscriptions": 3, "revenue": 30.0, "share": 1.0}]
+    [month] = queries.churn(directory)
+    assert (month["started"], month["cancelled"]) == (4, 1)
+    assert queries.cohorts(directory)[0]["active_users"] == 1
+
+    client.delete(f"/users/deactivate/{username}", headers=headers)
+    export.export([TestingSessionLocal], directory)
+    assert queries.cohorts(directory)[0]["active_users"] == 0
+
+    full = export.export([TestingSessionLocal], directory, full=True)
+    assert len(full["shards"]["0"]["parts"]["subscriptions"]) == 1
+    assert sorted(os.listdir(tmp_path / "subscriptions")) == [os.path.basename(full["shards"]["0"]["parts"]["subscriptions"][0])]
+    assert queries.plan_mix(directory) == mix
+
+def test_incremental_snapshots_are_compacted(client, unique_username, unique_email, tmp_path):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "compaction")
+    directory = str(tmp_path)
+
+    for _ in range(4):
+        client.post("/subscriptions/", json={
+            "user_id": 1,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        }, headers=headers)
+        manifest = export.export([TestingSessionLocal], directory, compact_files=2)
+        assert len(manifest["shards"]["0"]["parts"]["subscription_changes"]) <= 2
+
+    assert len(os.listdir(tmp_path / "subscription_changes")) <= 2
+    assert len(queries.load(directory, "subscription_changes")) == 4
+    assert [row["active_subscriptions"] for row in queries.plan_mix(directory)] == [4]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from dataloader import DataLoader
+
+def test_loads_in_one_tick_share_one_batch():
+    calls = []
+
+    async def batch_load(ids):
+        calls.append(ids)
+        return {id: {"id": id} for id in ids if id != 3}
+
+    async def run():
+        loader = DataLoader(batch_load, max_batch_size=2)
+        first = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1), loader.load(3))
+        # Cached for the loader's lifetime.
+        second = await loader.load_many([2, 1])
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == [{"id": 1}, {"id": 2}, {"id": 1}, None]
+    assert second == [{"id": 2}, {"id": 1}]
+    assert calls == [[1, 2], [3]]
+
+def test_batches_run_one_at_a_time():
+    running, overlapped = [], []
+
+    async def batch_load(ids):
+        running.append(ids)
+        overlapped.append(len(running) > 1)
+        await asyncio.sleep(0.01)
+        running.remove(ids)
+        return {id: id for id in ids}
+
+    async def run():
+        loader = DataLoader(batch_load, max_batch_size=2)
+        return await loader.load_many(range(5))
+
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
+    assert overlapped == [False, False, False]
+
+def test_failed_batch_is_not_cached():
+    calls = []
+
+    async def batch_load(ids):
+        calls.append(ids)
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+        return {id: id for id in ids}
+
+    async def run():
+        loader = DataLoader(batch_load)
+        with pytest.raises(RuntimeError):
+            await loader.load_many([1, 2])
+        return await loader.load(1)
+
+    assert asyncio.run(run()) == 1
+    assert calls == [[1, 2], [1]]
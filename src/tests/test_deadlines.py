@@ -0,0 +1,98 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, exc
+
+import deadlines
+from deadlines import DeadlineQueuePool, deadline_scope
+
+def exceeded(client, route):
+    return client.get("/metrics/deadlines").json().get(route, {}).get("exceeded", 0)
+
+def test_expired_client_deadline_returns_504(client):
+    before = exceeded(client, "GET /magazines/")
+    response = client.get("/magazines/", headers={"X-Request-Timeout": "0"})
+    assert response.status_code == 504, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert exceeded(client, "GET /magazines/") == before + 1
+
+    assert client.get("/magazines/", headers={"X-Request-Timeout": "5"}).status_code == 200
+
+def test_transactions_do_not_start_after_the_deadline(client):
+    before = exceeded(client, "POST /users/register")
+    response = client.post("/users/register", json={
+        "username": "late",
+        "email": "late@example.com",
+        "password": "secret"
+    }, headers={"X-Request-Timeout": "0.000001"})
+    assert response.status_code == 504, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert exceeded(client, "POST /users/register") == before + 1
+
+def test_change_feed_has_no_deadline(client):
+    response = client.get("/subscriptions/changes", headers={"X-Request-Timeout": "0"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_pool_checkout_gives_up_at_the_deadline(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/pool.db", poolclass=DeadlineQueuePool, pool_size=1, max_overflow=0, pool_timeout=30)
+    held = engine.connect()
+    try:
+        start = time.monotonic()
+        with deadline_scope(0.2):
+            with pytest.raises(exc.TimeoutError) as error:
+                engine.connect()
+            assert deadlines.is_deadline_error(error.value)
+        assert time.monotonic() - start < 2
+        assert engine.pool.timeout() == 30
+    finally:
+        held.close()
+        engine.dispose()
+
+class FakeCursor:
+    """Runs "SET ...; SELECT ..." the way the driver does: the rows come from
+    the last result with psycopg2, and from the first with psycopg 3."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.executed = []
+        self.rows = None
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement)
+        results = [[] if part.startswith("SET ") else [(1,)] for part in statement.split("; ")]
+        self.rows = results[-1] if self.driver == "psycopg2" else results[0]
+
+    def fetchall(self):
+        return self.rows
+
+def run_first_statements(driver, parameters):
+    cursor = FakeCursor(driver)
+    conn = SimpleNamespace(info={}, dialect=SimpleNamespace(name="postgresql", driver=driver))
+    with deadline_scope(2):
+        deadlines._apply_statement_timeout(None, None, conn)
+    rows = []
+    for statement in ("SELECT 1", "SELECT 1"):
+        cursor.execute(*deadlines._send_statement_timeout(conn, cursor, statement, parameters, None, False))
+        rows.append(cursor.fetchall())
+    return cursor.executed, rows
+
+@pytest.mark.parametrize("parameters", [(), {"id": 1}])
+def test_statement_timeout_is_sent_with_the_first_statement(parameters):
+    executed, rows = run_first_statements("psycopg2", parameters)
+    assert rows == [[(1,)], [(1,)]]
+    # One round trip for the first statement; later ones go out unchanged.
+    assert len(executed) == 2 and executed[1] == "SELECT 1"
+    assert executed[0].startswith("SET LOCAL statement_timeout = ") and executed[0].endswith("; SELECT 1")
+    assert 1900 <= int(executed[0].split("= ")[1].split(";")[0]) <= 2000
+
+@pytest.mark.parametrize("parameters", [(), {"id": 1}])
+def test_statement_timeout_has_its_own_round_trip_on_psycopg3(parameters):
+    executed, rows = run_first_statements("psycopg", parameters)
+    assert rows == [[(1,)], [(1,)]]
+    assert len(executed) == 3 and executed[0].startswith("SET LOCAL statement_timeout = ")
+    assert executed[1:] == ["SELECT 1", "SELECT 1"]
+
+def test_statement_timeout_is_postgres_only():
+    conn = SimpleNamespace(info={}, dialect=SimpleNamespace(name="sqlite", driver="pysqlite"))
+    with deadline_scope(2):
+        deadlines._apply_statement_timeout(None, None, conn)
+    assert deadlines._send_statement_timeout(conn, None, "SELECT 1", (), None, False) == ("SELECT 1", ())
@@ -0,0 +1,66 @@
+import pytest
+
+import diagnostics
+from models import Magazine
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_magazine
+
+@pytest.fixture
+def tracing():
+    diagnostics.enable()
+    yield
+    diagnostics.disable()
+
+def test_diagnostics_are_disabled_by_default(client):
+    assert client.get("/debug/memory/requests").status_code == 404
+    assert client.post("/debug/memory/snapshots").status_code == 404
+
+def test_memory_snapshot_diff(client, tracing):
+    response = client.post("/debug/memory/snapshots", params={"limit": 5})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    snapshot = response.json()
+    assert len(snapshot["top"]) == 5
+
+    retained = [bytearray(1024) for _ in range(1000)]
+    response = client.get(f"/debug/memory/snapshots/{snapshot['id']}/diff")
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    grown = [row for row in response.json()["diff"] if "test_diagnostics.py" in row["location"]]
+    assert grown[0]["size_diff"] >= 1024 * 1000
+    del retained
+
+    assert client.get("/debug/memory/snapshots/999/diff").status_code == 404
+
+def test_request_memory_and_session_counts(client, tracing, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    create_magazine(client, headers, "memory")
+    for _ in range(3):
+        client.get("/magazines/")
+
+    for i in range(3):
+        client.get(f"/no-such-page/{i}")
+
+    stats = client.get("/debug/memory/requests").json()
+    assert stats["GET /magazines/"]["requests"] == 3
+    assert stats["GET /magazines/"]["peak_max"] > 0
+    assert stats[diagnostics.UNMATCHED]["requests"] == 3
+    assert not any("no-such-page" in key for key in stats)
+
+    # Request sessions are gone once the requests finish.
+    assert client.get("/debug/memory/sessions").json()["sessions"] == 0
+
+    db = TestingSessionLocal()
+    magazine = db.query(Magazine).one()
+    sessions = client.get("/debug/memory/sessions").json()
+    assert sessions["sessions"] == 1
+    assert sessions["sessions_in_transaction"] == 1
+    assert sessions["identity_map"] == {"Magazine": 1}
+
+    # An instance kept after its session closed.
+    db.close()
+    del db
+    sessions = client.get("/debug/memory/sessions").json()
+    assert sessions["sessions"] == 0
+    assert sessions["detached_instances"] == {"Magazine": 1}
+    del magazine
@@ -0,0 +1,71 @@
+import pytest
+
+from load_shedding import CRITICAL, NORMAL, SHEDDABLE, UNMATCHED, AdaptiveLimiter, limiter
+from .utils import create_user
+
+def test_priorities_share_the_limit():
+    limits = AdaptiveLimiter(initial=10)
+    assert all(limits.try_acquire(SHEDDABLE) for _ in range(5))
+    assert not limits.try_acquire(SHEDDABLE)
+    assert all(limits.try_acquire(NORMAL) for _ in range(5))
+    assert not limits.try_acquire(NORMAL)
+    assert all(limits.try_acquire(CRITICAL) for _ in range(5))
+    assert not limits.try_acquire(CRITICAL)
+    assert limits.stats()["shed"] == {SHEDDABLE: 1, NORMAL: 1, CRITICAL: 1}
+
+def test_limit_backs_off_when_latency_rises_and_recovers():
+    limits = AdaptiveLimiter(initial=10, minimum=2, slack=0.01)
+
+    def complete(latency, requests=10):
+        for _ in range(requests):
+            assert limits.try_acquire(NORMAL)
+        for _ in range(requests):
+            limits.release("GET /magazines/", latency)
+
+    complete(0.005)
+    assert limits.limit > 10
+    grown = limits.limit
+
+    # Queueing: twice the baseline and over the slack.
+    complete(0.1)
+    assert limits.limit == pytest.approx(grown * 0.9)
+    for _ in range(100):
+        complete(0.1, requests=2)
+    assert limits.limit == 2
+
+    complete(0.005, requests=2)
+    assert limits.limit > 2
+
+    # Slow routes are judged against their own baseline.
+    slow = AdaptiveLimiter(initial=10)
+    for _ in range(20):
+        assert slow.try_acquire(NORMAL)
+        slow.release("POST /users/login", 0.3)
+    assert slow.limit == 10
+
+def test_overloaded_requests_are_shed_with_retry_after(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "shedpassword")
+    saved = limiter.in_flight
+    limiter.in_flight = int(limiter.limit)
+    try:
+        response = client.get("/magazines/")
+        assert response.status_code == 503, f"Response status code: {response.status_code}, Response body: {response.text}"
+        assert response.headers["Retry-After"] == "1"
+        assert client.get("/subscriptions/").headers["Retry-After"] == "2"
+        # So do sign-ups.
+        response = client.post("/users/register", json={"username": "shed", "email": "shed@example.com", "password": "secret"})
+        assert response.status_code == 503, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+        # Signing in and the change feed still work.
+        response = client.post("/users/login", json={"username": username, "password": "shedpassword"})
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        assert client.get("/subscriptions/changes").status_code == 200
+        assert client.get("/metrics/concurrency").json()["shed"][NORMAL] >= 1
+    finally:
+        limiter.in_flight = saved
+
+def test_unmatched_paths_share_one_baseline(client):
+    for i in range(20):
+        assert client.get(f"/no-such-page/{i}").status_code == 404
+    assert not any("no-such-page" in route for route in limiter._baselines)
+    assert UNMATCHED in limiter._baselines
@@ -1,4 +1,7 @@
 import pytest
+from sqlalchemy import delete, update
+from models import Magazine, MagazineIndexChange
+from search import MagazineSearchIndex
 from .utils import create_user, login_user, create_plan, create_magazine
 
 def test_create_magazine(client, unique_username, unique_email):
@@ -43,6 +46,31 @@ def test_update_magazine(client, unique_username, unique_email):
     assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
     assert response.json()["name"] == f"Updated Tech Weekly {name_suffix}"
 
+def test_update_magazine_with_stale_version(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    magazine = create_magazine(client, headers, "occ")
+    response = client.get(f"/magazines/{magazine['id']}", headers=headers)
+    original_etag = response.headers["ETag"]
+    payload = {key: response.json()[key] for key in (
+        "name", "description", "base_price", "discount_quarterly", "discount_half_yearly", "discount_annual")}
+
+    response = client.put(f"/magazines/{magazine['id']}", json={**payload, "base_price": 7.0},
+                          headers={**headers, "If-Match": original_etag})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.headers["ETag"] != original_etag
+
+    # A second writer still holding the original version loses the race.
+    response = client.put(f"/magazines/{magazine['id']}", json={**payload, "base_price": 8.0},
+                          headers={**headers, "If-Match": original_etag})
+    assert response.status_code == 412, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.put(f"/magazines/{magazine['id']}", json={**payload, "base_price": 8.0, "version": 1},
+                          headers=headers)
+    assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert client.get(f"/magazines/{magazine['id']}", headers=headers).json()["base_price"] == 7.0
+
 def test_delete_magazine(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "adminpassword")
     token = login_user(client, username, "adminpassword")
@@ -57,3 +85,151 @@ def test_delete_magazine(client, unique_username, unique_email):
     # Verify magazine is deleted
     response = client.get(f"/magazines/{magazine['id']}", headers=headers)
     assert response.status_code == 404, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_search_magazines(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    tech = create_magazine(client, headers, "search")
+    response = client.post("/magazines/", json={
+        "name": "Garden Life",
+        "description": "Seasonal planting and tech-free weekends",
+        "base_price": 4.0,
+        "discount_quarterly": 0.1,
+        "discount_half_yearly": 0.2,
+        "discount_annual": 0.3
+    }, headers=headers)
+    garden = response.json()
+
+    response = client.get("/magazines/search", params={"q": "weekly tech"}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert [magazine["id"] for magazine in response.json()] == [tech["id"]]
+
+    response = client.get("/magazines/search", params={"q": "plant"}, headers=headers)
+    assert [magazine["id"] for magazine in response.json()] == [garden["id"]]
+
+    # Updates and deletes keep the full-text index in sync.
+    client.delete(f"/magazines/{garden['id']}", headers=headers)
+    response = client.get("/magazines/search", params={"q": "plant"}, headers=headers)
+    assert response.json() == []
+
+def test_autocomplete_magazines(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    magazine = create_magazine(client, headers, "autocomplete")
+    response = client.get("/magazines/autocomplete", params={"prefix": "tech w"}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json() == [{"id": magazine["id"], "name": magazine["name"]}]
+
+    response = client.get("/magazines/autocomplete", params={"prefix": "WEEK"}, headers=headers)
+    assert [match["id"] for match in response.json()] == [magazine["id"]]
+
+    client.put(f"/magazines/{magazine['id']}", json={
+        "name": "Science Monthly",
+        "description": "An updated science magazine",
+        "base_price": 6.0,
+        "discount_quarterly": 0.15,
+        "discount_half_yearly": 0.25,
+        "discount_annual": 0.35
+    }, headers=headers)
+    assert client.get("/magazines/autocomplete", params={"prefix": "tech"}, headers=headers).json() == []
+    assert client.get("/magazines/autocomplete", params={"prefix": "sci"}, headers=headers).json()[0]["id"] == magazine["id"]
+
+def test_autocomplete_after_buckets_split():
+    index = MagazineSearchIndex()
+    names = {i: f"{chr(ord('a') + i // 10)}mag {i % 10}" for i in range(100)}
+    for magazine_id, name in names.items():
+        index.put(magazine_id, name)
+    # More than bucket_size keys, so the root has split; "z" is a new child.
+    index.put(100, "Zebra Weekly")
+
+    assert index.complete("zeb") == [{"id": 100, "name": "Zebra Weekly"}]
+    assert index.complete("weekly") == [{"id": 100, "name": "Zebra Weekly"}]
+    for magazine_id, name in names.items():
+        assert {"id": magazine_id, "name": name} in index.complete(name)
+    assert [match["id"] for match in index.complete("c", limit=20)] == list(range(20, 30))
+
+def test_autocomplete_magazines_written_by_another_worker(client, unique_username, unique_email):
+    from main import catalog_caches
+    from .conftest import TestingSessionLocal
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    magazine = create_magazine(client, headers, "refresh")
+    with TestingSessionLocal() as db:
+        catalog_caches.load(db)
+        # Another worker's write: the table changes, this index does not.
+        db.execute(update(Magazine).where(Magazine.id == magazine["id"]).values(name="Quarterly Review"))
+        db.commit()
+    assert client.get("/magazines/autocomplete", params={"prefix": "quarterly"}).json() == []
+
+    with TestingSessionLocal() as db:
+        assert catalog_caches.refresh(db) == ["magazines"]
+    response = client.get("/magazines/autocomplete", params={"prefix": "quarterly"})
+    assert response.json() == [{"id": magazine["id"], "name": "Quarterly Review"}]
+
+    with TestingSessionLocal() as db:
+        db.execute(update(Magazine).where(Magazine.id == magazine["id"]).values(base_price=20))
+        db.commit()
+        # Not in the index: nothing to refresh.
+        assert catalog_caches.refresh(db) == []
+        db.execute(delete(Magazine).where(Magazine.id == magazine["id"]))
+        db.commit()
+        assert catalog_caches.refresh(db) == ["magazines"]
+    assert client.get("/magazines/autocomplete", params={"prefix": "quarterly"}).json() == []
+
+def test_magazine_index_applies_changes_without_reloading(client, unique_username, unique_email, monkeypatch):
+    from .conftest import TestingSessionLocal
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    kept, renamed = create_magazine(client, headers, "kept"), create_magazine(client, headers, "renamed")
+    index = MagazineSearchIndex()
+    with TestingSessionLocal() as db:
+        index.load(db)
+        db.execute(update(Magazine).where(Magazine.id == renamed["id"]).values(name="Monthly Digest"))
+        db.commit()
+        monkeypatch.setattr(index, "load", lambda db: pytest.fail("reloaded the whole index"))
+        index.update(db)
+    assert index.complete("monthly") == [{"id": renamed["id"], "name": "Monthly Digest"}]
+    assert index.complete("tech") == [{"id": kept["id"], "name": kept["name"]}]
+
+def test_magazine_index_reloads_when_changes_were_pruned(client, unique_username, unique_email):
+    from .conftest import TestingSessionLocal
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    magazine, other = create_magazine(client, headers, "pruned"), create_magazine(client, headers, "other")
+    index = MagazineSearchIndex()
+    with TestingSessionLocal() as db:
+        index.load(db)
+        db.execute(update(Magazine).where(Magazine.id == magazine["id"]).values(name="Annual Almanac"))
+        db.execute(update(Magazine).where(Magazine.id == other["id"]).values(name="Weekly Almanac"))
+        db.execute(delete(MagazineIndexChange).where(MagazineIndexChange.version == index.version + 1))
+        db.commit()
+        index.update(db)
+    assert index.complete("annual") == [{"id": magazine["id"], "name": "Annual Almanac"}]
+
+def test_get_magazines_by_ids(client, unique_username, unique_email, query_counter):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    magazines = [create_magazine(client, headers, f"batch{i}") for i in range(3)]
+    ids = [magazine["id"] for magazine in magazines]
+
+    start = query_counter.count
+    response = client.get("/magazines/batch", params={"ids": ",".join(map(str, ids + [9999]))})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert query_counter.count - start == 1
+    batch = response.json()
+    assert {id: item["name"] for id, item in batch["items"].items()} == {str(magazine["id"]): magazine["name"] for magazine in magazines}
+    assert batch["missing"] == [9999]
+
+    response = client.post("/magazines/batch", json={"ids": ids[:2]})
+    assert sorted(response.json()["items"]) == sorted(str(id) for id in ids[:2])
+
+    assert client.get("/magazines/batch", params={"ids": "1,x"}).status_code == 422
+    assert client.post("/magazines/batch", json={"ids": list(range(1000))}).status_code == 422
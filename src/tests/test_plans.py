@@ -1,5 +1,7 @@
 import pytest
-from .utils import create_user, login_user
+from sqlalchemy import insert, update
+from models import Plan
+from .utils import create_user, login_user, create_magazine
 
 def test_create_plan(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "adminpassword")
@@ -80,3 +82,73 @@ def test_create_plan_with_zero_renewal_period(client, unique_username, unique_em
         "renewal_period": 0
     }, headers=headers)
     assert response.status_code == 422, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_plan_registry_reloads_on_write(client, unique_username, unique_email):
+    from plans import plan_registry
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/plans/", json={
+        "title": "Annual",
+        "description": "Annual subscription plan",
+        "renewal_period": 12
+    }, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    plan_id = response.json()["id"]
+    assert plan_registry.get(plan_id).renewal_period == 12
+
+    response = client.delete(f"/plans/{plan_id}", headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert plan_id not in plan_registry
+
+def test_plans_written_by_another_worker(client, unique_username, unique_email):
+    from main import catalog_caches
+    from .conftest import TestingSessionLocal
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    magazine = create_magazine(client, headers, "worker")
+    with TestingSessionLocal() as db:
+        catalog_caches.load(db)
+        # Another worker's write: the table changes, this registry does not.
+        plan_id = db.execute(insert(Plan).values(title="Weekly", description="Weekly plan", renewal_period=1).returning(Plan.id)).scalar()
+        db.commit()
+    assert client.get(f"/plans/{plan_id}").status_code == 404
+
+    # Subscription writes read a plan they have not seen from the database.
+    response = client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan_id,
+        "price": 10.0
+    }, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    with TestingSessionLocal() as db:
+        db.execute(update(Plan).where(Plan.id == plan_id).values(title="Weekly Plus"))
+        db.commit()
+        assert catalog_caches.refresh(db) == ["plans"]
+        assert catalog_caches.refresh(db) == []
+    assert client.get(f"/plans/{plan_id}").json()["title"] == "Weekly Plus"
+
+def test_plan_entry_is_immutable():
+    from plans import PlanEntry
+    plan = PlanEntry(1, "Monthly", "Monthly subscription plan", 1)
+    with pytest.raises(AttributeError):
+        plan.renewal_period = 0
+    with pytest.raises(ValueError):
+        PlanEntry(2, "Invalid Plan", "Plan with zero renewal period", 0)
+
+def test_get_plans_by_ids(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    plan = client.post("/plans/", json={
+        "title": "Monthly",
+        "description": "Monthly subscription plan",
+        "renewal_period": 1
+    }, headers=headers).json()
+
+    response = client.get("/plans/batch", params={"ids": f"{plan['id']},{plan['id']},9999"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json() == {"items": {str(plan["id"]): plan}, "missing": [9999]}
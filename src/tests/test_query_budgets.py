@@ -0,0 +1,50 @@
+import pytest
+from fastapi.routing import APIRoute
+from sqlalchemy import text
+
+from main import app
+from db.query_budget import get_query_budget
+from .query_counter import QueryBudgetExceeded, assert_max_queries, max_queries
+from .conftest import engine
+from .utils import create_user, login_user, create_plan, create_magazine
+
+def test_every_route_declares_a_query_budget():
+    missing = [
+        f"{sorted(route.methods)} {route.path}"
+        for route in app.routes
+        if isinstance(route, APIRoute) and get_query_budget(route.endpoint) is ...
+    ]
+    assert not missing, f"Routes without a query budget: {missing}"
+
+def test_query_budget_violation_lists_statements():
+    with pytest.raises(QueryBudgetExceeded) as excinfo:
+        with assert_max_queries(1):
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                connection.execute(text("SELECT 2"))
+    assert "issued 2 SQL statements, budget is 1" in str(excinfo.value)
+    assert "SELECT 2" in str(excinfo.value)
+
+@max_queries(0)
+def test_plan_reads_do_not_touch_the_database(client):
+    response = client.get("/plans/")
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_query_counter_fixture(client, query_counter, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "budget")
+
+    before = query_counter.count
+    response = client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    # The INSERT, the rollup upsert and the change log entry.
+    assert query_counter.count - before == 3, query_counter.report()
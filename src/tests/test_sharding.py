@@ -0,0 +1,244 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+from db.database import get_db
+from db.sharding import HashRing, ShardRouter, Shards, get_shards, sync_directory, user_directory
+from main import app
+from models import Magazine, Plan, Subscription, User
+from .utils import create_magazine, create_plan
+
+@pytest.fixture
+def router(tmp_path):
+    router = ShardRouter.from_urls([f"sqlite:///{tmp_path}/shard{i}.db" for i in range(3)], block_size=10)
+    router.create_all()
+    yield router
+    router.dispose()
+
+@pytest.fixture
+def sharded_client(router):
+    def override_get_shards():
+        shards = Shards(router)
+        try:
+            yield shards
+        finally:
+            shards.close()
+
+    def override_get_db():
+        db = router.session_factories[0]()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_get_db = app.dependency_overrides[get_db]
+    app.dependency_overrides[get_shards] = override_get_shards
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        with TestClient(app) as client:
+            yield client
+    finally:
+        app.dependency_overrides.pop(get_shards)
+        app.dependency_overrides[get_db] = previous_get_db
+
+def rows_on(router, shard, stmt):
+    with router.session_factories[shard]() as db:
+        return db.execute(stmt).all()
+
+def test_hash_ring_moves_few_keys_when_a_shard_is_added():
+    before, after = HashRing(4), HashRing(5)
+    moved = [key for key in range(10000) if before.shard_for(key) != after.shard_for(key)]
+    # Ideally 1/5 of the keys move, all of them to the new shard.
+    assert 0.1 < len(moved) / 10000 < 0.3
+    assert {after.shard_for(key) for key in moved} == {4}
+
+def test_users_and_subscriptions_live_on_the_owning_shard(router, sharded_client):
+    plan = create_plan(sharded_client, {})
+    magazine = create_magazine(sharded_client, {}, "sharded")
+    for shard in range(3):
+        assert rows_on(router, shard, select(Plan.id)) == [(plan["id"],)]
+        assert rows_on(router, shard, select(Magazine.name)) == [(magazine["name"],)]
+
+    user_ids = []
+    for i in range(12):
+        response = sharded_client.post("/users/register", json={"username": f"reader{i}", "email": f"reader{i}@example.com", "password": "secret"})
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        user_ids.append(response.json()["id"])
+    assert len(set(user_ids)) == 12
+    assert len({router.shard_for_user(user_id) for user_id in user_ids}) > 1
+
+    subscription_ids = []
+    for user_id in user_ids:
+        response = sharded_client.post("/subscriptions/", json={
+            "user_id": user_id,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        })
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        subscription_ids.append(response.json()["id"])
+
+    for user_id in user_ids:
+        shard = router.shard_for_user(user_id)
+        assert rows_on(router, shard, select(User.id).where(User.id == user_id)) == [(user_id,)]
+        assert len(rows_on(router, shard, select(Subscription.id).where(Subscription.user_id == user_id))) == 1
+
+    # Point lookups and writes find the owning shard.
+    response = sharded_client.put(f"/subscriptions/{subscription_ids[0]}", json={
+        "user_id": user_ids[0],
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 12.0,
+        "next_renewal_date": "2024-12-31"
+    })
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert sharded_client.get(f"/subscriptions/{subscription_ids[0]}").json()["is_active"] is False
+    assert sharded_client.delete(f"/subscriptions/{subscription_ids[1]}").status_code == 200
+
+    report = sharded_client.get("/reports/subscriptions").json()
+    assert report[0]["active_subscribers"] == 11
+    assert report[0]["revenue"] == 112.0
+
+def test_list_subscriptions_merges_pages_across_shards(router, sharded_client):
+    plan = create_plan(sharded_client, {})
+    magazine = create_magazine(sharded_client, {}, "merge")
+    user_ids = [
+        sharded_client.post("/users/register", json={"username": f"merge{i}", "email": f"merge{i}@example.com", "password": "secret"}).json()["id"]
+        for i in range(6)
+    ]
+    for user_id in user_ids * 2:
+        sharded_client.post("/subscriptions/", json={
+            "user_id": user_id,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        })
+
+    seen, after = [], None
+    while True:
+        params = {"limit": 5} if after is None else {"limit": 5, "after": after}
+        page = sharded_client.get("/subscriptions/", params=params).json()
+        if not page:
+            break
+        seen.extend(item["id"] for item in page)
+        after = page[-1]["id"]
+    assert len(seen) == 12
+    assert seen == sorted(seen)
+
+def test_usernames_and_emails_are_unique_across_shards(router, sharded_client):
+    first = sharded_client.post("/users/register", json={"username": "taken", "email": "taken@example.com", "password": "secret"})
+    assert first.status_code == 200, f"Response status code: {first.status_code}, Response body: {first.text}"
+    # Later ids land on other shards, whose own constraints would allow these.
+    for i in range(6):
+        response = sharded_client.post("/users/register", json={"username": "taken", "email": f"other{i}@example.com", "password": "secret"})
+        assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+        response = sharded_client.post("/users/register", json={"username": f"other{i}", "email": "taken@example.com", "password": "secret"})
+        assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert sum(len(rows_on(router, shard, select(User.id))) for shard in range(3)) == 1
+
+    # A failed claim leaves nothing behind, so the names can still be used.
+    response = sharded_client.post("/users/register", json={"username": "other0", "email": "other0@example.com", "password": "secret"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert sharded_client.post("/users/login", json={"username": "taken", "password": "secret"}).status_code == 200
+
+    sync_directory(router)
+    assert sorted(rows_on(router, 0, select(user_directory.c.username))) == [("other0",), ("taken",)]
+
+def test_bulk_import_and_reset_delivery_span_shards(router, sharded_client):
+    from main import background_shards
+    from reset_delivery import ResetDeliveryWorker, SMTPConnectionPool
+    from .test_users import FakeSMTP
+
+    sharded_client.post("/users/register", json={"username": "existing", "email": "existing@example.com", "password": "secret"})
+    ndjson_data = "".join(
+        f'{{"username": "imported{i}", "email": "imported{i}@example.com", "password": "secret"}}\n' for i in range(12)
+    ) + '{"username": "existing", "email": "again@example.com", "password": "secret"}\n'
+    response = sharded_client.post("/users/import", files={"file": ("users.ndjson", ndjson_data, "application/x-ndjson")})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    report = response.json()
+    assert report["imported"] == 12
+    assert [error["error"] for error in report["errors"]] == ["Username already exists: existing"]
+
+    # Imported users get allocated ids and live on the shard that owns them.
+    imported = [row for shard in range(3) for row in rows_on(router, shard, select(User.id, User.username).where(User.username.like("imported%")))]
+    assert len(imported) == 12
+    for user_id, _ in imported:
+        assert rows_on(router, router.shard_for_user(user_id), select(User.id).where(User.id == user_id)) == [(user_id,)]
+    assert len({router.shard_for_user(user_id) for user_id, _ in imported}) > 1
+
+    for i in range(12):
+        sharded_client.post("/users/reset-password", params={"email": f"imported{i}@example.com"})
+    connections = []
+
+    def connect():
+        connections.append(FakeSMTP())
+        return connections[-1]
+
+    worker = ResetDeliveryWorker(background_shards, SMTPConnectionPool(connect, size=1))
+    assert worker.drain_once() == 12
+    assert sorted(message["To"] for message in connections[0].sent) == sorted(f"imported{i}@example.com" for i in range(12))
+
+def test_reconciliation_and_change_feed_span_shards(router, sharded_client):
+    from db.changes import sequence_changes
+    from db.rollups import reconcile_shards, rollups
+    from sqlalchemy import update
+
+    plan = create_plan(sharded_client, {})
+    magazine = create_magazine(sharded_client, {}, "feed")
+    user_ids = [
+        sharded_client.post("/users/register", json={"username": f"feed{i}", "email": f"feed{i}@example.com", "password": "secret"}).json()["id"]
+        for i in range(6)
+    ]
+    subscription_ids = [
+        sharded_client.post("/subscriptions/", json={
+            "user_id": user_id,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        }).json()["id"]
+        for user_id in user_ids
+    ]
+
+    Shards(router).scatter(sequence_changes)
+    feed = sharded_client.get("/subscriptions/changes").json()
+    assert sorted(change["subscription"]["id"] for change in feed["changes"]) == sorted(subscription_ids)
+    assert len(feed["next"].split(",")) == 3
+    assert sharded_client.get("/subscriptions/changes", params={"since": feed["next"]}).json()["changes"] == []
+
+    # Paging with a small limit still sees every change once.
+    seen, cursor = [], "0"
+    while page := sharded_client.get("/subscriptions/changes", params={"since": cursor, "limit": 4}).json()["changes"]:
+        seen.extend(change["subscription"]["id"] for change in page)
+        cursor = page[-1]["cursor"]
+    assert sorted(seen) == sorted(subscription_ids)
+
+    sharded_client.delete(f"/subscriptions/{subscription_ids[-1]}")
+    Shards(router).scatter(sequence_changes)
+    changes = sharded_client.get("/subscriptions/changes", params={"since": feed["next"]}).json()["changes"]
+    assert [(change["op"], change["subscription"]["id"]) for change in changes] == [("cancelled", subscription_ids[-1])]
+    assert sharded_client.get("/subscriptions/changes", params={"since": "0,0,0,0"}).status_code == 422
+
+    drifted = router.shard_for_user(user_ids[-1])
+    with router.session_factories[drifted]() as db:
+        db.execute(update(rollups).values(active_subscribers=99))
+        db.commit()
+    shards = Shards(router)
+    try:
+        assert reconcile_shards(shards) == 1
+    finally:
+        shards.close()
+    assert sharded_client.get("/reports/subscriptions").json()[0]["active_subscribers"] == 5
+
+def test_first_shard_reuses_the_app_engine(tmp_path):
+    from db.database import DATABASE_URL, engine
+
+    router = ShardRouter.from_urls([DATABASE_URL, f"sqlite:///{tmp_path}/shard1.db"])
+    try:
+        assert router.engines[0] is engine
+        assert router.engines[1] is not engine
+    finally:
+        router.executor.shutdown()
+        router.engines[1].dispose()
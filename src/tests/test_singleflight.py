@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from singleflight import AsyncSingleFlight, SingleFlight
+
+def test_concurrent_calls_share_one_execution():
+    group = SingleFlight("test-shared")
+    release = threading.Event()
+    executions = []
+
+    def lookup():
+        executions.append(1)
+        release.wait(5)
+        return {"id": 1}
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(group.do, "key", lookup) for _ in range(8)]
+        while group.stats.calls < 8:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert results == [{"id": 1}] * 8
+    assert len(executions) == 1
+    assert group.stats.as_dict() == {"calls": 8, "executions": 1, "coalesced": 7, "errors": 0, "timeouts": 0}
+
+    # Nothing is cached once the call has completed.
+    assert group.do("key", lambda: {"id": 2}) == {"id": 2}
+
+def test_errors_reach_every_waiter():
+    group = SingleFlight("test-errors")
+    release = threading.Event()
+
+    def lookup():
+        release.wait(5)
+        raise ValueError("database unavailable")
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(group.do, "key", lookup) for _ in range(2)]
+        while group.stats.calls < 2:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+    assert group.stats.errors == 1
+
+def test_waiters_time_out():
+    group = SingleFlight("test-timeout")
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(group.do, "key", lambda: release.wait(5))
+        while group.stats.calls < 1:
+            time.sleep(0.01)
+        with pytest.raises(TimeoutError):
+            group.do("key", lambda: None, timeout=0.01)
+        release.set()
+        assert leader.result() is True
+    assert group.stats.timeouts == 1
+
+def test_waiters_retry_errors_that_belong_to_the_leader():
+    group = SingleFlight("test-retry")
+    release = threading.Event()
+
+    def leader_lookup():
+        release.wait(5)
+        raise ValueError("leader's deadline")
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(group.do, "key", leader_lookup, retry=lambda e: isinstance(e, ValueError))
+        while group.stats.calls < 1:
+            time.sleep(0.01)
+        waiter = pool.submit(group.do, "key", lambda: {"id": 1}, retry=lambda e: isinstance(e, ValueError))
+        while group.stats.calls < 2:
+            time.sleep(0.01)
+        release.set()
+        with pytest.raises(ValueError):
+            leader.result()
+        assert waiter.result() == {"id": 1}
+    assert group.stats.executions == 2
+
+def test_shared_reads_wait_no_longer_than_the_deadline():
+    from deadlines import DeadlineExceeded, deadline_scope
+    from main import _shared_read
+    group = SingleFlight("test-deadline")
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(group.do, "key", lambda: release.wait(5))
+        while group.stats.calls < 1:
+            time.sleep(0.01)
+        started = time.monotonic()
+        with deadline_scope(0.05), pytest.raises(DeadlineExceeded):
+            _shared_read(group, "key", lambda: None)
+        assert time.monotonic() - started < group.timeout
+        release.set()
+        assert leader.result() is True
+
+def test_async_calls_share_one_execution():
+    group = AsyncSingleFlight("test-async")
+    executions = []
+
+    async def lookup():
+        executions.append(1)
+        await asyncio.sleep(0.01)
+        return "plans"
+
+    async def run():
+        return await asyncio.gather(*(group.do("key", lookup) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["plans"] * 5
+    assert len(executions) == 1
+    assert group.stats.coalesced == 4
+
+def test_singleflight_metrics(client):
+    response = client.get("/magazines/")
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.get("/metrics/singleflight")
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["magazines"]["calls"] >= 1
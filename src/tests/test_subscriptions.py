@@ -98,3 +98,316 @@ def test_delete_subscription(client, unique_username, unique_email):
     response = client.get(f"/subscriptions/{subscription_id}", headers=headers)
     assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
     assert not response.json()["is_active"], f"Subscription is not marked as inactive: {response.json()}"
+
+def test_create_subscription_computes_renewal_date(client, unique_username, unique_email):
+    from datetime import date
+    from plans import add_months
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "renewal_sub")
+
+    response = client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0
+    }, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    expected = add_months(date.today(), plan["renewal_period"])
+    assert response.json()["next_renewal_date"].startswith(expected.isoformat())
+
+def test_create_subscription_unknown_plan(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    magazine = create_magazine(client, headers, "unknown_plan_sub")
+
+    response = client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": 999,
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }, headers=headers)
+    assert response.status_code == 404, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_update_subscription_replaces_active_subscription(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "replace_sub")
+    payload = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    response = client.post("/subscriptions/", json=payload, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    old_id = response.json()["id"]
+
+    response = client.put(f"/subscriptions/{old_id}", json={**payload, "price": 12.0}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    new_subscription = response.json()
+    assert new_subscription["id"] != old_id
+    assert new_subscription["is_active"]
+
+    response = client.get(f"/subscriptions/{old_id}", headers=headers)
+    assert not response.json()["is_active"]
+
+    # The old subscription is no longer active, so it cannot be modified again.
+    response = client.put(f"/subscriptions/{old_id}", json=payload, headers=headers)
+    assert response.status_code == 404, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_update_subscription_with_stale_version(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "occ_sub")
+    payload = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    subscription_id = client.post("/subscriptions/", json=payload, headers=headers).json()["id"]
+    response = client.get(f"/subscriptions/{subscription_id}", headers=headers)
+    assert response.headers["ETag"] == '"1"'
+
+    response = client.put(f"/subscriptions/{subscription_id}", json=payload, headers={**headers, "If-Match": '"2"'})
+    assert response.status_code == 412, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.put(f"/subscriptions/{subscription_id}", json={**payload, "version": 2}, headers=headers)
+    assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    response = client.put(f"/subscriptions/{subscription_id}", json={**payload, "version": 1}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.headers["ETag"] == '"1"'
+    assert client.get(f"/subscriptions/{subscription_id}", headers=headers).json()["version"] == 2
+
+def test_get_my_subscriptions(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    user_id = 1  # The first user in a fresh database
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "my_subs")
+    ids = []
+    for owner in (user_id, user_id, user_id, user_id + 1):
+        response = client.post("/subscriptions/", json={
+            "user_id": owner,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        }, headers=headers)
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        ids.append(response.json()["id"])
+    client.delete(f"/subscriptions/{ids[1]}", headers=headers)
+
+    response = client.get("/users/me/subscriptions", params={"limit": 1}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == [ids[0]]
+    assert page["items"][0]["magazine"]["name"] == magazine["name"]
+    assert page["items"][0]["plan"]["title"] == plan["title"]
+
+    response = client.get("/users/me/subscriptions", params={"limit": 1, "after": page["next_after"]}, headers=headers)
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == [ids[2]]
+    assert page["next_after"] is None
+
+def test_get_subscriptions_expands_magazines_and_plans(client, unique_username, unique_email, query_counter):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazines = [create_magazine(client, headers, f"expand{i}") for i in range(3)]
+    for magazine in magazines * 2:
+        client.post("/subscriptions/", json={
+            "user_id": 1,
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 10.0,
+            "next_renewal_date": "2024-12-31"
+        }, headers=headers)
+
+    assert "magazine" not in client.get("/subscriptions/").json()[0]
+
+    start = query_counter.count
+    response = client.get("/subscriptions/", params={"expand": "magazine,plan"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    # One query for the page and one for all six rows' magazines.
+    assert query_counter.count - start == 2
+    items = response.json()
+    assert [item["magazine"]["name"] for item in items] == [magazine["name"] for magazine in magazines * 2]
+    assert {item["plan"]["title"] for item in items} == {plan["title"]}
+
+    assert client.get("/subscriptions/", params={"expand": "user"}).status_code == 422
+    # A page's magazines must fit in one IN batch.
+    assert client.get("/subscriptions/", params={"limit": 1000, "expand": "magazine"}).status_code == 422
+
+def test_get_my_subscriptions_requires_token(client):
+    response = client.get("/users/me/subscriptions", headers={"Authorization": "Bearer invalid"})
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_subscription_report_tracks_writes(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "rollup")
+    payload = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    ids = [client.post("/subscriptions/", json=payload, headers=headers).json()["id"] for _ in range(3)]
+    client.put(f"/subscriptions/{ids[0]}", json={**payload, "price": 12.0}, headers=headers)
+    client.delete(f"/subscriptions/{ids[1]}", headers=headers)
+    # Cancelling an inactive subscription does not count it twice.
+    client.delete(f"/subscriptions/{ids[1]}", headers=headers)
+
+    response = client.get("/reports/subscriptions", params={"magazine_id": magazine["id"]}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json() == [{
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "active_subscribers": 2,
+        "revenue": 22.0,
+        "monthly_revenue": 22.0,
+    }]
+
+def test_reconcile_subscription_rollups(client, unique_username, unique_email):
+    from db.rollups import reconcile, rollups
+    from sqlalchemy import update
+    from .conftest import TestingSessionLocal
+
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "reconcile")
+    client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }, headers=headers)
+    expected = client.get("/reports/subscriptions", headers=headers).json()
+
+    db = TestingSessionLocal()
+    try:
+        assert reconcile(db) == 0
+        db.execute(update(rollups).values(active_subscribers=5, revenue=0))
+        db.commit()
+        assert reconcile(db) == 1
+    finally:
+        db.close()
+    assert client.get("/reports/subscriptions", headers=headers).json() == expected
+
+def sequence_feed():
+    # What the change poller does once per CHANGE_FEED_POLL_SECONDS.
+    from db.changes import sequence_changes
+    from .conftest import TestingSessionLocal
+    with TestingSessionLocal() as db:
+        sequence_changes(db)
+
+def test_subscription_change_feed(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "changes")
+    payload = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    first_id = client.post("/subscriptions/", json=payload, headers=headers).json()["id"]
+    sequence_feed()
+    response = client.get("/subscriptions/changes", headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    feed = response.json()
+    assert [(change["op"], change["subscription"]["id"]) for change in feed["changes"]] == [("created", first_id)]
+
+    second_id = client.put(f"/subscriptions/{first_id}", json=payload, headers=headers).json()["id"]
+    client.delete(f"/subscriptions/{second_id}", headers=headers)
+    sequence_feed()
+
+    # Only the changes after the client's cursor come back.
+    response = client.get("/subscriptions/changes", params={"since": feed["next"]}, headers=headers)
+    changes = response.json()["changes"]
+    assert [(change["op"], change["subscription"]["id"]) for change in changes] == [
+        ("replaced", first_id), ("created", second_id), ("cancelled", second_id),
+    ]
+    assert [change["seq"] for change in changes] == sorted(change["seq"] for change in changes)
+    next_seq = response.json()["next"]
+
+    response = client.get("/subscriptions/changes", params={"since": next_seq, "mode": "longpoll", "timeout": 0.1}, headers=headers)
+    assert response.json() == {"changes": [], "next": next_seq}
+
+    response = client.get("/subscriptions/changes", params={"mode": "sse", "timeout": 0.1}, headers=headers)
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block for block in response.text.split("\n\n") if block.startswith("id:")]
+    assert [event.splitlines()[0] for event in events] == [f"id: {change_id}" for change_id in range(1, 5)]
+
+def test_change_log_is_numbered_after_commit_and_pruned(client, unique_username, unique_email):
+    from datetime import datetime, timedelta
+    from sqlalchemy import select, update
+    from db.changes import changes, prune_changes, sequence_changes
+    from .conftest import TestingSessionLocal
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "retention")
+    payload = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    ids = [client.post("/subscriptions/", json=payload, headers=headers).json()["id"] for _ in range(3)]
+    with TestingSessionLocal() as db:
+        # Writers leave the numbering to sequence_changes(), and so do readers.
+        assert client.get("/subscriptions/changes").json()["changes"] == []
+        assert db.execute(select(changes.c.seq)).scalars().all() == [None, None, None]
+        assert sequence_changes(db) == 3
+        assert sequence_changes(db) == 0
+        assert db.execute(select(changes.c.seq).order_by(changes.c.id)).scalars().all() == [1, 2, 3]
+
+    cursor = client.get("/subscriptions/changes", params={"limit": 1}).json()["next"]
+    with TestingSessionLocal() as db:
+        db.execute(update(changes).values(changed_at=datetime.utcnow() - timedelta(days=2)))
+        db.commit()
+        # The newest change stays, so seqs never restart.
+        assert prune_changes(db, retention_days=1) == 2
+    assert client.get("/subscriptions/changes", params={"since": cursor}).status_code == 410
+    feed = client.get("/subscriptions/changes").json()
+    assert [(change["seq"], change["subscription"]["id"]) for change in feed["changes"]] == [(3, ids[2])]
+
+    client.delete(f"/subscriptions/{ids[2]}", headers=headers)
+    sequence_feed()
+    changes_after = client.get("/subscriptions/changes", params={"since": feed["next"]}).json()["changes"]
+    assert [(change["seq"], change["op"]) for change in changes_after] == [(4, "cancelled")]
@@ -39,6 +39,18 @@ def test_register_user(client, unique_username, unique_email):
     })
     assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
 
+    response = client.post("/users/register", json={
+        "username": unique_username,
+        "email": f"other{unique_email}",
+        "password": "testpassword"
+    })
+    assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_register_user_requires_an_email(client, unique_username):
+    for email in ({}, {"email": None}):
+        response = client.post("/users/register", json={"username": unique_username, "password": "testpassword", **email})
+        assert response.status_code == 422, f"Response status code: {response.status_code}, Response body: {response.text}"
+
 def test_login_user(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "loginpassword")
     response = client.post("/users/login", json={
@@ -102,3 +114,142 @@ def test_token_expiry(client, unique_username, unique_email):
     # Verify token has expired
     response = client.get("/users/me", headers=headers)
     assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_bulk_import_users_csv(client, unique_username, unique_email):
+    username, email = create_user(client, unique_username, unique_email, "importpassword")
+    csv_data = "\n".join([
+        "username,email,password,address,phone",
+        "reader1,reader1@example.com,secret,,",
+        "reader2,reader2@example.com,secret,1 Main St,555-0100",
+        "reader1,other@example.com,secret,,",
+        f"{username},fresh@example.com,secret,,",
+        f"reader3,{email},secret,,",
+        "reader4,not-an-email,secret,,",
+    ])
+    response = client.post(
+        "/users/import",
+        files={"file": ("users.csv", csv_data, "text/csv")},
+        params={"batch_size": 2},
+    )
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    report = response.json()
+    assert report["imported"] == 2
+    assert [error["row"] for error in report["errors"]] == [4, 5, 6, 7]
+
+    response = client.post("/users/login", json={"username": "reader2", "password": "secret"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_bulk_import_users_ndjson(client):
+    ndjson_data = "\n".join([
+        '{"username": "reader5", "email": "reader5@example.com", "password": "secret"}',
+        '{"username": "reader6"',
+        '{"username": "reader7", "email": "reader7@example.com", "password": "secret"}',
+    ])
+    response = client.post("/users/import", files={"file": ("users.ndjson", ndjson_data, "application/x-ndjson")})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    report = response.json()
+    assert report["imported"] == 2
+    assert report["errors"][0]["row"] == 2
+
+    for batch_size in (0, -1):
+        response = client.post("/users/import", params={"batch_size": batch_size},
+                               files={"file": ("users.ndjson", ndjson_data, "application/x-ndjson")})
+        assert response.status_code == 422, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_bulk_import_cli_rejects_empty_batches(tmp_path):
+    import bulk_import
+    path = tmp_path / "users.csv"
+    path.write_text("username,email,password\n")
+    with pytest.raises(SystemExit) as exit:
+        bulk_import.main([str(path), "--batch-size", "0"])
+    assert exit.value.code == 2
+
+
+class FakeSMTP:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+    def quit(self):
+        pass
+
+
+def test_reset_password_delivery_is_batched_and_deduplicated(client, unique_username, unique_email):
+    from main import background_shards
+    from reset_delivery import ResetDeliveryWorker, SMTPConnectionPool
+
+    username, email = create_user(client, unique_username, unique_email, "resetpassword")
+    for address in (email, email, "nobody@example.com"):
+        response = client.post("/users/reset-password", params={"email": address})
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    connections = []
+
+    def connect():
+        connections.append(FakeSMTP())
+        return connections[-1]
+
+    worker = ResetDeliveryWorker(background_shards, SMTPConnectionPool(connect, size=1))
+    assert worker.drain_once() == 3
+    assert worker.drain_once() == 0
+
+    assert len(connections) == 1
+    sent = connections[0].sent
+    assert [message["To"] for message in sent] == [email]
+    assert username in sent[0].get_content()
+
+    # A new request inside the dedupe window is not sent again.
+    client.post("/users/reset-password", params={"email": email})
+    assert worker.drain_once() == 1
+    assert len(sent) == 1
+
+def test_reset_delivery_gives_up_when_smtp_is_unreachable(client, unique_username, unique_email):
+    from datetime import datetime, timedelta
+    from sqlalchemy import func, select, update
+    from main import background_shards
+    from models import PasswordResetDelivery
+    from reset_delivery import RESET_MAX_ATTEMPTS, ResetDeliveryWorker, SMTPConnectionPool
+    from .conftest import TestingSessionLocal
+
+    _, email = create_user(client, unique_username, unique_email, "resetpassword")
+    client.post("/users/reset-password", params={"email": email})
+
+    def connect():
+        raise ConnectionRefusedError("SMTP server down")
+
+    worker = ResetDeliveryWorker(background_shards, SMTPConnectionPool(connect, size=1))
+    for _ in range(RESET_MAX_ATTEMPTS):
+        assert worker.drain_once() == 1
+    # Every failed connection used up an attempt, so the row is not retried forever.
+    assert worker.drain_once() == 0
+    with TestingSessionLocal() as db:
+        delivery = db.scalars(select(PasswordResetDelivery)).one()
+        assert (delivery.status, delivery.attempts) == ("failed", RESET_MAX_ATTEMPTS)
+
+        db.execute(update(PasswordResetDelivery).values(requested_at=datetime.utcnow() - timedelta(days=30)))
+        db.commit()
+    assert worker.prune() == 1
+    with TestingSessionLocal() as db:
+        assert db.scalar(select(func.count()).select_from(PasswordResetDelivery)) == 0
+
+def test_get_users_by_ids(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "batchpassword")
+    token = login_user(client, username, "batchpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    user_id = client.post("/users/register", json={
+        "username": f"{username}_other",
+        "email": f"other_{unique_email}",
+        "password": "batchpassword"
+    }).json()["id"]
+
+    assert client.get("/users/batch", params={"ids": str(user_id)}).status_code == 401
+    response = client.get("/users/batch", params={"ids": f"{user_id},9999"}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json() == {
+        "items": {str(user_id): {"id": user_id, "username": f"{username}_other", "is_active": True}},
+        "missing": [9999],
+    }